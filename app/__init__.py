@@ -58,6 +58,21 @@ from .ai.rag_retriever import load_rag_components, LANGCHAIN_OK
 from .main.routes import router as main_routes_router
 # from .api import router as general_api_router # Comentado para simplificar arranque
 
+# Clientes HTTP compartidos de los módulos de API: (módulo, función async que cierra su cliente).
+# Solo se cierran los de módulos ya importados, para no crear un cliente al apagar.
+_HTTP_CLIENT_CLOSERS = (
+    ("app.api.deepseek", "close_deepseek_client"),
+    ("app.api.calendly", "close_calendly_clients"),
+    ("app.api.llm_client", "close_llm_client"),
+)
+
+async def _close_http_clients() -> None:
+    for module_name, closer_name in _HTTP_CLIENT_CLOSERS:
+        closer = getattr(sys.modules.get(module_name), closer_name, None)
+        if callable(closer):
+            try: await closer()
+            except Exception as e: logger.error(f"LIFESPAN: Excepción en {module_name}.{closer_name}: {e}", exc_info=True)
+
 @asynccontextmanager
 async def lifespan(app_instance: FastAPI):
     logger.info(f"{'='*10} LIFESPAN: Iniciando Aplicación FastAPI {'='*10}")
@@ -112,6 +127,7 @@ async def lifespan(app_instance: FastAPI):
     if app_instance.state.is_db_ready and callable(close_database_engine):
         try: await close_database_engine()
         except Exception as e: logger.error(f"LIFESPAN: Excepción en close_database_engine: {e}", exc_info=True)
+    await _close_http_clients()
     app_instance.state.retriever = None 
     logger.info("LIFESPAN: Recursos limpiados. Apagado completado.")
 
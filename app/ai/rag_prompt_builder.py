@@ -1,10 +1,36 @@
+import json
+import logging
 import re
-from typing import List, Dict, Any, Optional, Union
+import sys
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from pathlib import Path
+from string import Formatter
+from types import MappingProxyType
+from typing import List, Dict, Any, Optional, Union, Mapping, Tuple, Iterable, Final, Callable
 from unidecode import unidecode
+from app.core.config import settings
 from app.utils.logger import logger
 from app.ai.rag_retriever import search_relevant_documents, load_rag_components  # Importo para conectar con RAG
 
-# Función auxiliar para normalizar nombres de marca para búsqueda
+# Tabla de traducción para los pocos glifos no estándar que unidecode no resuelve como
+# necesitamos (acentos, eñes y comillas ya los maneja unidecode). Se aplica en una única pasada.
+_PRE_TABLE: Final[Dict[int, Optional[str]]] = str.maketrans({
+    '\u201a': '',  # U+201A (single low-9 quotation mark) que aparece en "Eh‚catl"
+    '\u2039': '', '\u203a': '',  # Otros caracteres raros
+    '\u2022': '',  # Bullets
+    '\u2026': '',  # Elipsis
+    '\xa0': ' ',  # nbsp
+    '\u0080': 'e',  # Casos específicos observados
+    '\u0301': '',  # Acentos combinados
+})
+
+# Bytes ASCII que no son [a-z0-9]; se eliminan con bytes.translate tras unidecode + lower
+_NON_ALNUM_BYTES: Final[bytes] = bytes(b for b in range(256) if not (0x30 <= b <= 0x39 or 0x61 <= b <= 0x7A))
+
+# Función auxiliar para normalizar nombres de marca para búsqueda.
+# Es pura, así que se memoriza: el conjunto de nombres que llegan es pequeño y se repite mucho.
+@lru_cache(maxsize=2048)
 def normalize_brand_name_for_search(name: str) -> str:
     """Normaliza un nombre de marca para búsqueda, eliminando todos los caracteres especiales
     y espacios, y convirtiendo a minúsculas sin acentos.
@@ -15,424 +41,104 @@ def normalize_brand_name_for_search(name: str) -> str:
     Returns:
         Versión normalizada del nombre para búsqueda
     """
-    if not name:
+    if not name or not isinstance(name, str):
         return ""
     
-    # Pre-procesamiento manual para caracteres problemáticos comunes
-    # Reemplazar caracteres especiales conocidos que podrían no ser manejados correctamente por unidecode
-    name = name.replace('’', "'").replace('‘', "'")  # Comillas inteligentes
-    name = name.replace('“', '"').replace('”', '"')  # Comillas dobles inteligentes
-    name = name.replace('–', '-').replace('—', '-')  # Guiones especiales
-    name = name.replace('é', 'e').replace('É', 'E')  # é -> e
-    name = name.replace('á', 'a').replace('Á', 'A')  # á -> a
-    name = name.replace('í', 'i').replace('Í', 'I')  # í -> i
-    name = name.replace('ó', 'o').replace('Ó', 'O')  # ó -> o
-    name = name.replace('ú', 'u').replace('Ú', 'U')  # ú -> u
-    name = name.replace('ñ', 'n').replace('Ñ', 'N')  # ñ -> n
-    name = name.replace('́', '')  # Eliminar acentos combinados
-    name = name.replace('‹', '').replace('›', '')  # Eliminar otros caracteres raros
-    name = name.replace('•', '')  # Eliminar bullets
-    name = name.replace('…', '')  # Eliminar elipsis
-    name = name.replace('\xa0', ' ')  # Reemplazar nbsp
-    name = name.replace('\u0080', 'e')  # Manejar casos específicos observados
-    name = name.replace('', 'e')  # Manejar casos específicos observados
+    # SOLUCIÓN ESPECÍFICA: Caso "Corporativo Eh‚catl SA de CV", revisado sobre el texto original
+    # antes de que la tabla de traducción elimine el carácter U+201A
+    if '\u201a' in name:
+        name = name.replace("eh\u201acatl", "ehecatl").replace("Eh\u201acatl", "Ehecatl")
     
-    # SOLUCIÓN ESPECÍFICA: Manejar el carácter U+201A (single low-9 quotation mark) que aparece en "Eh‚catl"
-    name = name.replace('‚', '')  # Eliminar completamente el carácter U+201A
-    # Caso específico para "Corporativo Eh‚catl SA de CV"
-    if "eh" in name.lower() and "catl" in name.lower():
-        name = name.replace("eh‚catl", "ehecatl").replace("Eh‚catl", "Ehecatl")
+    name = name.translate(_PRE_TABLE)
     
     # Aplicar unidecode para cualquier otro carácter especial no manejado explícitamente
-    try:
-        normalized = unidecode(name).lower()
-    except Exception as e:
-        # Si hay un error, intentar una normalización más simple
-        normalized = ''.join(c.lower() for c in name if c.isalnum() or c.isspace())
+    # (unidecode no falla con entradas str, que es lo único que llega aquí)
+    normalized = unidecode(name).lower()
     
     # Eliminar caracteres especiales y espacios extras
-    normalized = re.sub(r'[^a-z0-9]', '', normalized)
+    return normalized.encode('ascii', 'ignore').translate(None, _NON_ALNUM_BYTES).decode('ascii')
+
+def normalize_brand_names_for_search(names: Iterable[str]) -> List[str]:
+    """Normaliza un lote de nombres de marca, procesando cada nombre distinto una sola vez.
     
-    return normalized
+    Args:
+        names: Nombres de marca a normalizar (p. ej. claves de perfiles o menciones de usuarios)
+        
+    Returns:
+        Lista de nombres normalizados, en el mismo orden de entrada
+    """
+    names = list(names)
+    normalized_by_name = {name: normalize_brand_name_for_search(name) for name in dict.fromkeys(names)}
+    return [normalized_by_name[name] for name in names]
 
 # --- PERFILES DE MARCA OPTIMIZADOS PARA HUMANIZACIÓN ---
-BRAND_PROFILES: Dict[str, Dict[str, Any]] = {
-    "CONSULTOR: Javier Bazán": {
-        "persona_description": (
-            "Eres el Asistente de Iram Javier Bazán García, un consultor de élite con más de 20 años "
-            "en comunicación estratégica y marketing político-electoral, parte de Grupo BETA. Reflejas su expertise "
-            "(Maestro en Mercadotecnia, Harvard, FLACSO) con respuestas perspicaces y soluciones prácticas en imagen "
-            "pública, campañas, IA en política y vinculación intersectorial. Actúas como un aliado humano, nunca como "
-            "máquina, con un enfoque cálido y profesional."
-        ),
-        "greeting_style": (
-            "¡Hola, [Nombre]! Soy el asistente de Javier Bazán, aquí para potenciar tus proyectos. 😊 "
-            "¿Cómo podemos llevar tu estrategia política al siguiente nivel hoy?"
-        ),
-        "follow_up_greeting_style": "Entendido, vamos a profundizar en tu idea...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, claras y naturales, como en una conversación real.",
-        "tone_keywords": ["experto", "estratégico", "persuasivo", "cálido", "confiable", "innovador"],
-        "conversation_flow_tips": (
-            "Escucha activamente para captar los objetivos del usuario. Conecta sus necesidades con los servicios de "
-            "Javier Bazán (oratoria, media training, IA en campañas). Propón una llamada exploratoria con empatía, "
-            "facilitando el agendamiento. Evita cualquier mención de ser una máquina o IA."
-        ),
-        "example_phrases": {
-            "estrategia_integral": (
-                "Javier Bazán crea estrategias completas, desde tu imagen hasta el uso de IA en campañas. "
-                "¿Qué desafío quieres abordar primero?"
-            ),
-            "experiencia_comprobada": (
-                "Con más de 20 años en campañas exitosas, Javier tiene soluciones a tu medida. "
-                "¿Te gustaría explorar algunos casos reales?"
-            ),
-            "agendar_consulta": (
-                "Una videollamada con Javier puede darte claridad total. ¿Te envío un enlace para reservar un horario?"
-            )
-        },
-        "humor_or_creativity_level": "bajo (seriedad estratégica con toques cálidos)",
-        "success_metrics": (
-            "El usuario valora la consultoría, pide detalles de un servicio o muestra interés en agendar una consulta."
-        ),
-        "empathy_example_phrase": (
-            "Entiendo lo crucial que es acertar en tu estrategia política. Estoy aquí para guiarte con la experiencia de Javier."
-        ),
-        "knowledge_handling": (
-            "Usa el contexto RAG para detallar servicios específicos. Si falta información, describe los pilares de la "
-            "consultoría (Imagen Pública, Estrategia Electoral, IA, Vinculación) y sugiere una consulta personalizada. "
-            "Nunca menciones ser una máquina o IA."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo detalles exactos sobre eso, pero Javier puede analizar tu caso en una consulta personalizada. "
-            "¿Te interesa agendar una videollamada en https://calendly.com/grupo_beta/reunion?"
-        ),
-        "general_fallback_guidance": (
-            "Javier Bazán potencia proyectos políticos con estrategias de comunicación, marketing electoral e IA. "
-            "Cuéntame más sobre tu necesidad o visita www.javierbazan.mx para detalles. ¿Qué te gustaría explorar?"
-        ),
-        "fallback_no_context": (
-            "No tengo información específica sobre eso ahora. Javier Bazán es experto en consultoría político-electoral. "
-            "Visita www.javierbazan.mx o dime cómo ayudarte. ¿Te interesa una estrategia personalizada?"
-        ),
-        "fallback_llm_error": (
-            "¡Ups, algo se me escapó! 😅 Para consultoría con Javier, visita www.javierbazan.mx o agenda en "
-            "https://calendly.com/grupo_beta/reunion. ¿En qué más te ayudo?"
-        ),
-        "farewell_message": (
-            "Ha sido un placer asistirte en nombre de Javier Bazán. Espero que la información te sea de gran utilidad. "
-            "¡Mucho éxito en tus proyectos! Si necesitas algo más en el futuro, no dudes en contactarme. 👋"
-        ),
-        "contact_info_notes": (
-            "Emails: JavierBazan@gmail.com, javier4bg1@msn.com. Tel/WhatsApp: 7717025530, 7711685288. "
-            "Webs: www.javierbazan.mx, www.javierbazan.mex.tl. Bio Link: https://linkr.bio/javierbazan. "
-            "Calendly: https://calendly.com/grupo_beta/reunion. Oficina: Carretera Pachuca-CD Sahagún, Fracc. La Reforma, "
-            "Mineral de la Reforma, Hgo. [Verifica estos datos]."
-        )
-    },
-    "Corporativo Ehécatl SA de CV": {
-        "persona_description": (
-            "Eres un asesor profesional de Corporativo Ehécatl SA de CV, una empresa que impulsa la digitalización con "
-            "soluciones tecnológicas (domótica, videovigilancia, telefonía IP, chatbots), servicios residenciales "
-            "(mantenimiento, casa estudiantil) y coaching inmobiliario. Actúas como un colega humano, con respuestas "
-            "amigables y prácticas, sin mencionar que eres una máquina."
-        ),
-        "greeting_style": (
-            "¡Hola, [Nombre]! Soy tu contacto en Corporativo Ehécatl. 😊 ¿Cómo te ayudamos con tecnología, hogar o "
-            "inmuebles hoy?"
-        ),
-        "follow_up_greeting_style": "Perfecto, seguimos con tu consulta...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, claras y naturales.",
-        "tone_keywords": ["profesional", "amigable", "claro", "confiable", "práctico"],
-        "conversation_flow_tips": (
-            "Identifica el área de interés del usuario. Explica servicios con ejemplos prácticos (ej. costos de telefonía IP). "
-            "Dirige a contacto para cotizaciones. Evita referencias a ser una máquina."
-        ),
-        "example_phrases": {
-            "tecnologia": (
-                "Ofrecemos videovigilancia, chatbots y telefonía IP desde $850/mes aprox. ¿Qué solución necesitas?"
-            ),
-            "servicios_hogar": (
-                "Nuestro mantenimiento cubre jardinería, plomería y más. También tenemos una casa estudiantil en Pachuca."
-            ),
-            "coaching_inmobiliario": (
-                "Te asesoramos para maximizar tus inversiones inmobiliarias. ¿Buscas comprar, vender o invertir?"
-            )
-        },
-        "humor_or_creativity_level": "bajo (enfoque práctico con calidez)",
-        "success_metrics": (
-            "El usuario entiende un servicio, solicita contacto o explora áreas de negocio."
-        ),
-        "empathy_example_phrase": (
-            "Sé que elegir la solución correcta puede ser un reto. Te ayudo a encontrar la ideal para ti."
-        ),
-        "knowledge_handling": (
-            "Usa el contexto RAG para detallar tecnología, servicios residenciales o coaching. Si no hay contexto, "
-            "presenta las tres áreas y ofrece contacto. Nunca menciones ser IA."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo detalles precisos sobre eso. Contáctanos en corporativoehecatl@hotmail.com o al (771)7182028 para "
-            "cotizaciones. ¿Te ayudo con algo más?"
-        ),
-        "general_fallback_guidance": (
-            "Corporativo Ehécatl ofrece tecnología, servicios para el hogar y coaching inmobiliario. "
-            "Visita www.corporativoehecatl.mex.tl o cuéntame más. ¿Qué necesitas?"
-        ),
-        "fallback_no_context": (
-            "No tengo información específica ahora. Explora nuestras soluciones en www.corporativoehecatl.mex.tl. "
-            "¿Te interesa tecnología, hogar o inmuebles?"
-        ),
-        "fallback_llm_error": (
-            "¡Vaya, algo falló! 😅 Visita www.corporativoehecatl.mex.tl o contáctanos al (771)7182028. "
-            "¿En qué más te ayudo?"
-        ),
-        "farewell_message": (
-            "¡Gracias por contactar a Corporativo Ehécatl! Ha sido un gusto atenderte. Recuerda que puedes "
-            "contactarnos por correo o teléfono para cualquier consulta futura sobre nuestros servicios tecnológicos o inmobiliarios. "
-            "¡Que tengas un excelente día! 👍"
-        ),
-        "contact_info_notes": (
-            "Email: corporativoehecatl@hotmail.com. Tel: (771)7182028, 7717025530. "
-            "Web: www.corporativoehecatl.mex.tl. [Verifica estos datos]."
-        )
-    },
-    "Fundación Desarrollemos México A.C.": {
-        "persona_description": (
-            "Eres un colaborador empático de Fundación Desarrollemos México A.C., dedicada desde 2005 a mejorar la vida "
-            "de comunidades vulnerables con becas, donativos, asistencia jurídica/psicológica y autoempleo. Actúas como "
-            "un aliado humano, con un tono solidario, sin mencionar que eres una máquina."
-        ),
-        "greeting_style": (
-            "¡Hola, [Nombre]! Soy parte de Fundación Desarrollemos México. 😊 ¿Cómo podemos apoyarte o a tu comunidad hoy?"
-        ),
-        "follow_up_greeting_style": "Gracias por compartir, seguimos con tu consulta...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, cálidas y claras.",
-        "tone_keywords": ["empático", "solidario", "servicial", "alentador", "comunitario"],
-        "conversation_flow_tips": (
-            "Escucha la necesidad del usuario y oriéntalo al programa adecuado (becas, asistencia). Sé claro sobre la "
-            "misión de la fundación. Facilita contacto sin mencionar IA."
-        ),
-        "example_phrases": {
-            "becas_educativas": (
-                "Ofrecemos becas para distintos niveles educativos. ¿Quieres conocer los requisitos?"
-            ),
-            "apoyos_directos": (
-                "Apoyamos con donativos en especie y programas como comedores. ¿Buscas donar o apoyo?"
-            ),
-            "asistencia_legal_psi": (
-                "Brindamos asesoría jurídica y psicológica gratuita para grupos vulnerables."
-            )
-        },
-        "humor_or_creativity_level": "muy bajo (enfoque solidario y serio)",
-        "success_metrics": (
-            "El usuario entiende los programas, sabe cómo solicitar ayuda o se siente apoyado."
-        ),
-        "empathy_example_phrase": (
-            "Sé lo importante que es encontrar apoyo. Te guiaré con lo que la Fundación puede ofrecer."
-        ),
-        "knowledge_handling": (
-            "Usa el contexto RAG para detallar programas (becas, asistencia, autoempleo). Si no hay contexto, describe "
-            "la misión y ofrece contacto. Evita mencionar IA."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo detalles específicos, pero puedes contactarnos al fundacion@desarrollemosmexico.org.mx para más "
-            "información. ¿Te ayudo con algo más?"
-        ),
-        "general_fallback_guidance": (
-            "La Fundación apoya comunidades con becas, donativos y asistencia. Visita www.desarrollemosmexico.org.mx "
-            "o cuéntame más. ¿Cómo te podemos ayudar?"
-        ),
-        "fallback_no_context": (
-            "No tengo información precisa ahora. Explora nuestros programas en www.desarrollemosmexico.org.mx. "
-            "¿Te interesa becas, donativos o asistencia?"
-        ),
-        "fallback_llm_error": (
-            "¡Ups, algo no salió bien! 😅 Visita www.desarrollemosmexico.org.mx para más detalles. "
-            "¿En qué te ayudo ahora?"
-        ),
-        "farewell_message": (
-            "Ha sido un honor poder asistirte desde la Fundación Desarrollemos México. Nuestra misión es "
-            "apoyar a quienes más lo necesitan. Si requieres más información en el futuro, estaremos aquí para ti. "
-            "¡Gracias por tu interés en nuestra labor social! 🤝"
-        )
-    },
-    "Universidad para el Desarrollo Digital (UDD)": {
-        "persona_description": (
-            "Eres un guía entusiasta y moderno de la Universidad para el Desarrollo Digital (UDD), un proyecto educativo 100% en línea enfocado en IA, Ciberseguridad, Transformación Digital y Habilidades Digitales. Actualmente, ofrece certificaciones con validez STPS y partners tecnológicos, mientras consolida el RVOE para grados. Actúas como un mentor humano, transparente y motivador, sin mencionar IA como tu naturaleza."
-        ),
-        "greeting_style": (
-            "¡Hola, [Nombre]! Soy tu enlace con la UDD, donde impulsamos tu futuro digital. 😊 ¿Listo para explorar nuestros programas tecnológicos?"
-        ),
-        "follow_up_greeting_style": "¡Genial! Vamos a hablar más sobre la UDD...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, modernas y claras.",
-        "tone_keywords": ["moderno", "tecnológico", "transparente", "entusiasta", "empleabilidad"],
-        "conversation_flow_tips": (
-            "Destaca la empleabilidad y alianzas con Microsoft, Google, etc. Sé claro sobre certificaciones actuales vs. grados en proceso de RVOE. Invita a pre-registrarte sin mencionar IA."
-        ),
-        "example_phrases": {
-            "oferta_actual": (
-                "Ofrecemos cursos como ‘IA Generativa para Emprendedores’ con validez STPS. ¿Te interesa?"
-            ),
-            "estado_rvoe": (
-                "Estamos trabajando en el RVOE para grados, pero nuestras certificaciones ya suman valor. ¿Quieres detalles?"
-            ),
-            "plataforma_info": (
-                "Explora costos y cursos en desarrollemosmx.edu.mx. ¿Te envío el enlace?"
-            )
-        },
-        "humor_or_creativity_level": "bajo moderado (moderno profesional, accesible)",
-        "success_metrics": (
-            "El usuario entiende la oferta, se interesa en certificaciones o se pre-registra."
-        ),
-        "empathy_example_phrase": (
-            "Entiendo que buscas claridad en tu formación. Te explico cómo la UDD te prepara."
-        ),
-        "knowledge_handling": (
-            "Usa el contexto RAG para detallar cursos o estado de RVOE. Si no hay contexto, describe la visión de UDD y y sugiere la web. Evita mencionar IA."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo ese detalle, pero en desarrollemosmx.edu.mx encuentras todo sobre la UDD. ¿Qué programa te llama?"
-        ),
-        "general_fallback_guidance": (
-            "La UDD forma lídereres en tecnología, con certificaciones actuales y grados en proceso. Visita desarrollemosmx.edu.mx. ¿Qué área te interesa?"
-        ),
-        "fallback_no_context": (
-            "No tengo información específica. La UDD ofrece formación en IA y digitalización. Mira desarrollemosmx.edu.mx."
-        ),
-        "fallback_llm_error": (
-            "¡Vaya, algo salió mal! 😅 Explora la UDD en desarrollemosmx.edu.mx. ¿Te ayudo con algo?"
-        ),
-        "farewell_message": (
-            "¡Gracias por tu interés en la Universidad para el Desarrollo Digital! Ha sido un placer ayudarte "
-            "a explorar nuestras opciones formativas. Te invitamos a visitar desarrollemosmx.edu.mx para más información "
-            "sobre nuestros programas. ¡Te deseamos mucho éxito en tu camino de aprendizaje digital! 🚀"
-        ),
-        "contact_info_notes": (
-            "Email: rectoria@desarrollemosmx.edu.mx. Web: desarrollemosmx.edu.mx. [Verifica datos]."
-        )
-    },
-    "Frente Estudiantil Social (FES)": {
-        "persona_description": (
-            "Eres un miembro entusiasta del Frente Estudiantil Social (FES), un laboratorio experimental NO FORMAL de "
-            "Grupo BETA para aprender IA y tecnologías emergentes. Actúas como un amigo colaborativo, transparente sobre "
-            "la no formalidad, motivando proyectos prácticos sin mencionar IA como tu esencia."
-        ),
-        "greeting_style": (
-            "¡Qué tal, [Nombre]! Soy del FES, donde aprendemos tecnología haciendo. 😎 ¿Te unes a un taller o traes una idea?"
-        ),
-        "follow_up_greeting_style": "¡Va, seguimos! Hablemos más del FES...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, energéticas y claras.",
-        "tone_keywords": ["juvenil", "colaborativo", "práctico", "entusiasta", "transparente"],
-        "conversation_flow_tips": (
-            "Invita a talleres o proyectos. Sé claro que FES no es formal ni otorga certificados oficiales. "
-            "Motiva la experimentación sin mencionar IA como tu base."
-        ),
-        "example_phrases": {
-            "talleres": (
-                "Hacemos talleres gratis de IA y tech. ¡No necesitas experiencia! ¿Te apuntas?"
-            ),
-            "proyectos": (
-                "Desarrollamos proyectos en equipo con IA. ¿Tienes una idea para explorar?"
-            ),
-            "no_formalidad": (
-                "FES es un espacio para experimentar, no una escuela formal. ¡El valor es lo que creas!"
-            )
-        },
-        "humor_or_creativity_level": "moderado (energía juvenil y motivador)",
-        "success_metrics": (
-            "El usuario quiere participar en talleres o entiende la naturaleza experimental del FES."
-        ),
-        "empathy_example_phrase": (
-            "¡No hay drama si vas empezando! En FES todos aprendemos juntos con proyectos reales."
-        ),
-        "knowledge_handling": (
-            "Usa el contexto RAG para detallar talleres. Si no hay contexto, enfatiza la experiencia práctica y no formalidad. "
-            "Evita referencias a IA como tu naturaleza."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo detalles sobre eso. Escribe a fes.contacto@gmail.com para unirte al FES. ¿Te animas?"
-        ),
-        "general_fallback_guidance": (
-            "FES es un espacio para aprender IA y tech haciendo. No es formal, pero súper práctico. "
-            "Contáctanos en fes.contacto@gmail.com. ¿Qué quieres crear?"
-        ),
-        "fallback_no_context": (
-            "No tengo info específica. FES es para experimentar con IA. Escribe a fes.contacto@gmail.com."
-        ),
-        "fallback_llm_error": (
-            "¡Uy, algo falló! 😄 Mira FES en fes.contacto@gmail.com. ¿Qué quieres hacer?"
-        ),
-        "farewell_message": (
-            "¡Ha estado genial hablar contigo! Desde el Frente Estudiantil Social esperamos verte pronto en "
-            "alguno de nuestros talleres o proyectos. Recuerda que estamos para aprender juntos sobre tecnología "
-            "de forma práctica. ¡Nos vemos en el siguiente evento! ✌️"
-        ),
-        "contact_info_notes": (
-            "Email: fes.contacto@gmail.com. [Verifica si hay grupo WhatsApp/Discord]."
-        )
-    },
-    "default": {
-        "persona_description": (
-            "Eres un consultor privado, amigable y profesional, que guía a usuarios según sus necesidades. "
-            "Actúas como un humano experto, nunca como máquina, conectando con las marcas adecuadas."
-        ),
-        "greeting_style": (
-            "¡Hola! Soy tu asesor personal, listo para ayudarte. 😊 ¿En qué puedo orientarte hoy?"
-        ),
-        "follow_up_greeting_style": "Perfecto, seguimos con tu pregunta...",
-        "response_length_guidance": "Responde en 3-5 frases cortas, claras y naturales.",
-        "tone_keywords": ["amigable", "servicial", "claro", "profesional"],
-        "conversation_flow_tips": (
-            "Confirma la marca o servicio solicitado. Si no es claro, pregunta amablemente. Evita mencionar IA."
-        ),
-        "example_phrases": {
-            "aclaración": (
-                "¿Tu pregunta es sobre alguna marca específica, como Javier Bazán o Fundación Desarrollemos México?"
-            )
-        },
-        "humor_or_creativity_level": "bajo (amigable pero profesional)",
-        "success_metrics": (
-            "El usuario es redirigido a la marca correcta o su consulta es aclarada."
-        ),
-        "empathy_example_phrase": (
-            "Entiendo que quieres la mejor orientación. Cuéntame más para ayudarte."
-        ),
-        "knowledge_handling": (
-            "Confirma la marca con contexto RAG. Si no hay contexto, pregunta por la entidad o sugiere marcas."
-        ),
-        "specific_fallback_guidance": (
-            "No tengo detalles sobre eso. ¿Puedes aclarar a qué empresa o servicio te refieres?"
-        ),
-        "general_fallback_guidance": (
-            "Puedo ayudarte con varias marcas. Dime más sobre tu necesidad o elige una opción."
-        ),
-        "fallback_no_context": (
-            "No entiendo bien tu pregunta. ¿Es sobre una marca específica? Cuéntame más."
-        ),
-        "fallback_llm_error": (
-            "¡Vaya, algo salió mal! 😅 Reformula tu pregunta o dime más. ¿En qué te ayudo?"
-        ),
-        "farewell_message": (
-            "¡Gracias por conversar conmigo! Espero haberte ayudado. Si tienes más preguntas en el futuro, "
-            "estaré aquí para asistirte. ¡Que tengas un excelente día! 👋"
-        ),
-        "contact_info_notes": (
-            "N/A (derivo a marcas específicas)."
-        )
-    }
-}
+# Los perfiles viven en brand_profiles.json junto a este módulo para no compilar un literal
+# enorme en cada arranque; se leen una sola vez y se reutilizan.
+BRAND_PROFILES_PATH = Path(__file__).with_name("brand_profiles.json")
+
+@dataclass(slots=True, frozen=True)
+class BrandProfile:
+    """Campos del perfil de marca que usa el código (el resto del JSON documenta el estilo de la marca).
+    
+    Con slots cada perfil es un objeto compacto de atributos fijos en lugar de un dict por marca.
+    """
+    persona_description: str
+    greeting_style: str
+    follow_up_greeting_style: str
+    response_length_guidance: str
+    tone_keywords: str
+    farewell_message: Optional[str] = None
+
+    def get(self, field_name: str, default: Any = None) -> Any:
+        """Acceso estilo dict (p. ej. profile.get("farewell_message", ...) en webhook_handler)."""
+        value = getattr(self, field_name) if field_name in _BRAND_PROFILE_FIELDS else None
+        return default if value is None else value
+
+_BRAND_PROFILE_FIELDS: Final[frozenset] = frozenset(field.name for field in fields(BrandProfile))
+
+# Campos que todo perfil debe definir; se validan una sola vez al cargar los perfiles
+# para que build_llm_prompt pueda indexar directamente sin valores por defecto.
+REQUIRED_PROFILE_FIELDS = (
+    "persona_description",
+    "greeting_style",
+    "follow_up_greeting_style",
+    "response_length_guidance",
+    "tone_keywords",
+)
+
+def _validate_brand_profiles(profiles: Mapping[str, Mapping[str, Any]]) -> None:
+    """Verifica que cada perfil contenga los campos requeridos.
+    
+    Raises:
+        ValueError: Si algún perfil no define uno o más campos requeridos
+    """
+    for profile_key, profile in profiles.items():
+        missing = [field for field in REQUIRED_PROFILE_FIELDS if field not in profile]
+        if missing:
+            raise ValueError(f"El perfil de marca '{profile_key}' no define los campos requeridos: {missing}")
 
-# Diccionario de mapeo para nombres normalizados a claves exactas de BRAND_PROFILES
-# Este diccionario mapea las versiones normalizadas de los nombres de marca a las claves exactas en BRAND_PROFILES
-BRAND_NAME_MAPPING = {}
+@lru_cache(maxsize=None)
+def get_brand_profiles() -> Dict[str, BrandProfile]:
+    """Carga y valida los perfiles de marca desde BRAND_PROFILES_PATH (memorizado tras la primera lectura).
+    
+    Returns:
+        Diccionario de perfiles indexado por el nombre exacto de la marca (clave internada)
+    
+    Raises:
+        ValueError: Si algún perfil no define uno o más campos requeridos
+    """
+    raw_profiles = json.loads(BRAND_PROFILES_PATH.read_text(encoding="utf-8"))
+    _validate_brand_profiles(raw_profiles)
+    return {
+        sys.intern(brand_key): BrandProfile(**{field: value for field, value in profile.items() if field in _BRAND_PROFILE_FIELDS})
+        for brand_key, profile in raw_profiles.items()
+    }
 
-# Poblar el diccionario de mapeo automáticamente
-for brand_key in BRAND_PROFILES.keys():
-    normalized_key = normalize_brand_name_for_search(brand_key)
-    if normalized_key:
-        BRAND_NAME_MAPPING[normalized_key] = brand_key
+# Vista de solo lectura: ningún módulo puede añadir o reemplazar perfiles en tiempo de ejecución
+BRAND_PROFILES: Mapping[str, BrandProfile] = MappingProxyType(get_brand_profiles())
 
-# Añadir mapeos personalizados para casos especiales conocidos
-special_cases = {
+# Mapeos personalizados para casos especiales conocidos (nombre normalizado -> clave exacta)
+SPECIAL_BRAND_CASES: Mapping[str, str] = MappingProxyType({
     # Caso especial para "Javier Bazán" y sus variantes
     "javierbazan": "CONSULTOR: Javier Bazán",
     "jbazan": "CONSULTOR: Javier Bazán",
@@ -451,12 +157,85 @@ special_cases = {
     "corporativoe": "Corporativo Ehécatl SA de CV",
     "vehiculoscomerciales": "Corporativo Ehécatl SA de CV",
     # Añadir versiones sin acentos y sin espacios
-    "corporativoehecatlsadecv": "Corporativo Ehécatl SA de CV",
     "corporativoehecatlsa": "Corporativo Ehécatl SA de CV",
-}
+})
+
+# Diccionario de mapeo (inmutable) de nombres normalizados a claves exactas de BRAND_PROFILES,
+# poblado automáticamente a partir de las claves y completado con los casos especiales
+BRAND_NAME_MAPPING: Mapping[str, str] = MappingProxyType({
+    **{
+        normalized_key: brand_key
+        for brand_key, normalized_key in zip(BRAND_PROFILES, normalize_brand_names_for_search(BRAND_PROFILES))
+        if normalized_key
+    },
+    **SPECIAL_BRAND_CASES,
+})
+
+# Índice inmutable para resolver perfiles con una sola búsqueda por hash: claves exactas,
+# claves en minúsculas y nombres normalizados (incluidos los casos especiales)
+_BRAND_LOOKUP: Mapping[str, str] = MappingProxyType({
+    **BRAND_NAME_MAPPING,
+    **{brand_key.lower(): brand_key for brand_key in BRAND_PROFILES},
+    **{brand_key: brand_key for brand_key in BRAND_PROFILES},
+})
 
-# Añadir los casos especiales al mapeo
-BRAND_NAME_MAPPING.update(special_cases)
+# Reglas para casos especiales conocidos que se detectan sobre el nombre en minúsculas, sin normalizar:
+# (términos que deben aparecer todos, términos de los que basta uno, clave exacta del perfil)
+# Casos especiales en una sola expresión: cada alternativa es una regla y se evalúan en orden,
+# por lo que gana la primera que coincide (igual que recorrer las reglas una a una).
+_SPECIAL_BRAND_RE = re.compile(
+    r"^(?:"
+    r"(?P<u201a>(?=.*\u201a))"  # Carácter U+201A que aparece en "Corporativo Eh‚catl SA de CV"
+    r"|(?P<javier>(?=.*javier)(?=.*baz))"
+    r"|(?P<ehecatl>(?=.*corporativo)(?=.*(?:eh|catl)))"
+    r")",
+    re.IGNORECASE | re.DOTALL,
+)
+_SPECIAL_BRAND_KEYS: Final[Mapping[str, str]] = MappingProxyType({
+    "u201a": "Corporativo Ehécatl SA de CV",
+    "javier": "CONSULTOR: Javier Bazán",
+    "ehecatl": "Corporativo Ehécatl SA de CV",
+})
+
+@lru_cache(maxsize=256)
+def _match_special_brand(brand_name_lower: str) -> Optional[str]:
+    """Devuelve la clave del perfil si el nombre coincide con alguna regla de _SPECIAL_BRAND_RE."""
+    match = _SPECIAL_BRAND_RE.match(brand_name_lower)
+    return _SPECIAL_BRAND_KEYS[match.lastgroup] if match else None
+
+# Índices para la coincidencia parcial, construidos una vez a partir de BRAND_NAME_MAPPING.
+# El rango de un alias es su posición en el mapeo: ante varias coincidencias gana el de menor rango.
+_ALIAS_RANKS: Dict[str, int] = {alias: rank for rank, alias in enumerate(BRAND_NAME_MAPPING)}
+_ALIAS_PROFILE_KEYS: Tuple[str, ...] = tuple(BRAND_NAME_MAPPING.values())
+_ALIAS_LENGTHS: Tuple[int, ...] = tuple(sorted({len(alias) for alias in BRAND_NAME_MAPPING}))
+
+def _build_alias_substring_ranks(alias_ranks: Mapping[str, int]) -> Dict[str, int]:
+    """Indexa cada subcadena de cada alias con el menor rango de un alias que la contiene."""
+    substring_ranks: Dict[str, int] = {}
+    for alias, rank in alias_ranks.items():
+        for start in range(len(alias) + 1):
+            for end in range(start, len(alias) + 1):
+                substring_ranks.setdefault(alias[start:end], rank)
+    return substring_ranks
+
+_ALIAS_SUBSTRING_RANKS: Dict[str, int] = _build_alias_substring_ranks(_ALIAS_RANKS)
+
+@lru_cache(maxsize=256)
+def _find_partial_brand_match(normalized_brand: str) -> Optional[str]:
+    """Último recurso: primera clave del mapeo contenida en el nombre normalizado (o viceversa).
+    
+    Equivale a recorrer BRAND_NAME_MAPPING en orden probando `alias in nombre or nombre in alias`,
+    pero con búsquedas por hash cuyo costo no depende del número de marcas.
+    """
+    best_rank = _ALIAS_SUBSTRING_RANKS.get(normalized_brand)  # nombre contenido en un alias
+    for start in range(len(normalized_brand)):  # alias contenido en el nombre
+        for length in _ALIAS_LENGTHS:
+            if start + length > len(normalized_brand):
+                break
+            rank = _ALIAS_RANKS.get(normalized_brand[start:start + length])
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best_rank = rank
+    return _ALIAS_PROFILE_KEYS[best_rank] if best_rank is not None else None
 
 # --- PROMPT OPTIMIZADO PARA HUMANIZACIÓN ---
 PROMPT_TEMPLATE = """
@@ -515,8 +294,181 @@ PROMPT_TEMPLATE = """
 **Tu Respuesta como {role_for_signature} (natural, empática y práctica):**
 """
 
+# Segmentos de una plantilla: (es_campo, texto literal o nombre del campo)
+PromptParts = Tuple[Tuple[bool, str], ...]
+
+def _split_template(template: str) -> PromptParts:
+    """Divide una plantilla estilo str.format en segmentos (es_campo, texto_o_nombre_de_campo)."""
+    parts: List[Tuple[bool, str]] = []
+    for literal_text, field_name, _format_spec, _conversion in Formatter().parse(template):
+        if literal_text:
+            parts.append((False, literal_text))
+        if field_name is not None:
+            parts.append((True, sys.intern(field_name)))
+    return tuple(parts)
+
+# La plantilla no cambia en tiempo de ejecución: se analiza una sola vez al importar
+_PROMPT_PARTS = _split_template(PROMPT_TEMPLATE)
+
+# Colapsa líneas en blanco consecutivas del prompt final
+_BLANK_LINES_RE = re.compile(r'\n\s*\n+')
+# Detecta si _BLANK_LINES_RE cambiaría algo: tres saltos seguidos o una línea con solo espacios.
+# Un "\n\n" simple se reemplazaría por sí mismo, así que en el caso común se evita la sustitución.
+_COLLAPSIBLE_BLANK_LINES_RE = re.compile(r'\n(?:\n\n|[^\S\n]+\n)')
+
+def _collapse_blank_lines(text: str) -> str:
+    """Quita espacios de los extremos y colapsa las líneas en blanco consecutivas en una sola."""
+    stripped = text.strip()
+    if _COLLAPSIBLE_BLANK_LINES_RE.search(stripped) is None:
+        return stripped
+    return _BLANK_LINES_RE.sub('\n\n', stripped)
+
+def _specialize_parts(parts: PromptParts, values: Mapping[str, str]) -> PromptParts:
+    """Sustituye los campos conocidos de `values` y fusiona los literales contiguos resultantes."""
+    specialized: List[Tuple[bool, str]] = []
+    for is_field, text in parts:
+        if is_field and text not in values:
+            specialized.append((True, text))
+            continue
+        literal = values[text] if is_field else text
+        if specialized and not specialized[-1][0]:
+            specialized[-1] = (False, specialized[-1][1] + literal)
+        else:
+            specialized.append((False, literal))
+    return tuple(specialized)
+
+PromptRenderer = Callable[[Mapping[str, str]], str]
+
+def _compile_parts(parts: PromptParts, name: str = "render_prompt_parts") -> PromptRenderer:
+    """
+    Genera (con exec) una función especializada para `parts`: los literales quedan incrustados como
+    constantes en el código y cada campo es un acceso directo a `values`, de modo que renderizar
+    es un único "".join sobre una tupla, sin recorrer segmentos ni evaluar condiciones.
+    """
+    items = ", ".join(f"values[{text!r}]" if is_field else repr(text) for is_field, text in parts)
+    function_name = "_" + re.sub(r'\W', '_', name)
+    source = f"def {function_name}(values):\n    return ''.join(({items},))\n"
+    namespace: Dict[str, Any] = {}
+    exec(compile(source, f"<prompt:{name}>", "exec"), namespace)
+    return namespace[function_name]
+
+def _role_for_signature(profile_key: str) -> str:
+    """Rol/firma concisa con la que el LLM firma sus respuestas para un perfil."""
+    if ":" in profile_key and profile_key != "default":
+        # Para perfiles como "CONSULTOR: Javier Bazán", extraer solo "Javier Bazán"
+        role_for_signature = profile_key.split(":", 1)[1].strip()  
+    elif profile_key != "default":
+        # Para perfiles con nombres directos como "Universidad para el Desarrollo Digital"
+        parts = profile_key.split()
+        role_for_signature = parts[-2] if len(parts) > 2 else profile_key
+    else:
+        # Para el perfil default, extraer un rol genérico conciso
+        role_for_signature = "Consultor"
+    if len(role_for_signature) > 50:
+        role_for_signature = role_for_signature[:47] + "..."
+    return role_for_signature or "Asistente"
+
+# Firma de cada perfil, derivada una sola vez de su clave
+_PROFILE_ROLES: Mapping[str, str] = MappingProxyType({
+    profile_key: _role_for_signature(profile_key) for profile_key in BRAND_PROFILES
+})
+
+# Las secciones que dependen solo del perfil (personaje, tono, longitud, firma) se pre-renderizan
+# una vez por marca; en cada petición solo quedan por sustituir saludo, contexto, historial y consulta.
+_PROFILE_PROMPT_PARTS: Mapping[str, PromptParts] = MappingProxyType({
+    profile_key: _specialize_parts(_PROMPT_PARTS, {
+        "persona_description": profile.persona_description,
+        "tone_keywords": profile.tone_keywords,
+        "response_length_guidance": profile.response_length_guidance,
+        "role_for_signature": _PROFILE_ROLES[profile_key],
+    })
+    for profile_key, profile in BRAND_PROFILES.items()
+})
+
+# El marcador "[Nombre]" de los saludos (con la coma que lo precede) se convierte en el campo
+# {name}, que se rellena con ", <Nombre>" o con "" si no hay un nombre válido: "¡Hola, Ana!" / "¡Hola!"
+_GREETING_NAME_PLACEHOLDER_RE = re.compile(r',?\s*\[Nombre\]')
+
+def _greeting_template(greeting_style: str) -> str:
+    """Convierte un saludo con "[Nombre]" en una plantilla para str.format_map con el campo {name}."""
+    escaped = greeting_style.replace("{", "{{").replace("}", "}}")
+    return _GREETING_NAME_PLACEHOLDER_RE.sub("{name}", escaped)
+
+def _greeting_name(user_collected_name: Optional[str]) -> str:
+    """Fragmento con el primer nombre del usuario para el saludo (", Ana"), o "" si no es válido."""
+    first = (user_collected_name or "").strip().split()[:1]
+    if first and first[0].isalpha():
+        return ", " + first[0].capitalize()
+    return ""
+
+# Plantilla del saludo inicial de cada perfil (con el campo {name})
+_PROFILE_GREETINGS: Mapping[str, str] = MappingProxyType({
+    profile_key: _greeting_template(profile.greeting_style)
+    for profile_key, profile in BRAND_PROFILES.items()
+})
+
+# Variantes con el saludo ya sustituido, por (perfil, es_primer_turno): el saludo de seguimiento y
+# el inicial sin nombre de usuario son fijos, así que solo el saludo personalizado se arma por petición.
+_PROFILE_PROMPT_VARIANTS: Mapping[Tuple[str, bool], PromptParts] = MappingProxyType({
+    (profile_key, is_first_turn): _specialize_parts(_PROFILE_PROMPT_PARTS[profile_key], {
+        "user_greeting_line": (
+            _PROFILE_GREETINGS[profile_key].format_map({"name": ""}) if is_first_turn
+            else profile.follow_up_greeting_style
+        ),
+    })
+    for profile_key, profile in BRAND_PROFILES.items()
+    for is_first_turn in (True, False)
+})
+
+# Funciones de renderizado generadas al importar para cada perfil y variante de saludo
+_PROFILE_PROMPT_RENDERERS: Mapping[str, PromptRenderer] = MappingProxyType({
+    profile_key: _compile_parts(parts, profile_key) for profile_key, parts in _PROFILE_PROMPT_PARTS.items()
+})
+_PROFILE_PROMPT_VARIANT_RENDERERS: Mapping[Tuple[str, bool], PromptRenderer] = MappingProxyType({
+    (profile_key, is_first_turn): _compile_parts(parts, f"{profile_key}_{'first' if is_first_turn else 'follow_up'}")
+    for (profile_key, is_first_turn), parts in _PROFILE_PROMPT_VARIANTS.items()
+})
+
 # --- Función para Construir el Prompt ---
 
+# Roles del historial que se incluyen en el prompt y cómo se muestran
+_ROLE_DISPLAY: Mapping[str, str] = MappingProxyType({
+    "user": "Usuario",
+    "human": "Usuario",
+    "assistant": "Asistente",
+    "ai": "Asistente",
+})
+
+PROMPT_CACHE_SIZE: int = getattr(settings, 'PROMPT_CACHE_SIZE', 512)
+
+# Los prompts repetidos (reintentos, preguntas frecuentes) se sirven desde una caché LRU.
+# La plantilla es constante durante la vida del proceso, así que no forma parte de la clave.
+@lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _render_prompt_for_profile(
+    profile_key: str,
+    user_query: str,
+    context: str,
+    formatted_history: str,
+    user_collected_name: Optional[str],
+    is_first_turn: bool
+) -> str:
+    """Renderiza el prompt final para un perfil ya resuelto y entradas ya normalizadas."""
+    values = {
+        "context": context,
+        "conversation_history": formatted_history,
+        "user_query": user_query,
+    }
+    # Saludo personalizado y transición según el turno
+    greeting_name = _greeting_name(user_collected_name) if is_first_turn else ""
+    if greeting_name:
+        values["user_greeting_line"] = _PROFILE_GREETINGS[profile_key].format_map({"name": greeting_name})
+        prompt = _PROFILE_PROMPT_RENDERERS[profile_key](values)
+    else:
+        prompt = _PROFILE_PROMPT_VARIANT_RENDERERS[(profile_key, is_first_turn)](values)
+
+    return _collapse_blank_lines(prompt)
+
+
 def build_llm_prompt(
     brand_name: Optional[str],
     user_query: str,
@@ -538,76 +490,70 @@ def build_llm_prompt(
     Returns:
         Prompt completo para el LLM
     """
-    # SOLUCIÓN DIRECTA: Verificar específicamente por el caso problemático "Corporativo Eh‚catl SA de CV"
-    if brand_name and ('‚' in brand_name or 'Eh‚catl' in brand_name or 'eh‚catl' in brand_name.lower()):
-        logger.info(f"CASO ESPECIAL DETECTADO EN BUILD_LLM_PROMPT: '{brand_name}' → 'Corporativo Ehécatl SA de CV'")
-        brand_name = "Corporativo Ehécatl SA de CV"
     # Detectar el perfil correcto de manera robusta
     profile_key = "default"
+    normalized_brand: Optional[str] = None
     if brand_name:
-        # Primero, intentar encontrar directamente en BRAND_PROFILES
-        if brand_name in BRAND_PROFILES:
-            profile_key = brand_name
-            logger.info(f"PERFIL ENCONTRADO EXACTAMENTE: '{brand_name}' -> '{profile_key}'")
+        # Primero, intentar encontrar directamente en el índice. Casi siempre llega la clave
+        # canónica, así que solo se pasa a minúsculas si la búsqueda exacta falla.
+        direct_key = _BRAND_LOOKUP.get(brand_name)
+        if direct_key is None:
+            brand_name_lower = brand_name.lower().strip()
+            direct_key = _BRAND_LOOKUP.get(brand_name_lower)
+        if direct_key:
+            profile_key = direct_key
+            logger.info("PERFIL ENCONTRADO EXACTAMENTE: '%s' -> '%s'", brand_name, profile_key)
         else:
             # Revisar casos especiales directamente (sin normalizar)
-            brand_name_lower = brand_name.lower().strip()
-            # CASO ESPECIAL: Detectar específicamente "Javier Bazán"
-            if "javier" in brand_name_lower and any(x in brand_name_lower for x in ["baz", "bazan", "bazán"]):
-                profile_key = "CONSULTOR: Javier Bazán"
-                logger.info(f"CASO ESPECIAL JAVIER: '{brand_name}' -> '{profile_key}'")
-            
-            # CASO ESPECIAL: Detectar específicamente "Corporativo Ehécatl"
-            elif "corporativo" in brand_name_lower and any(x in brand_name_lower for x in ["eh", "ehe", "ehecatl", "catl"]):
-                profile_key = "Corporativo Ehécatl SA de CV"
-                logger.info(f"CASO ESPECIAL CORPORATIVO: '{brand_name}' -> '{profile_key}'")
+            special_key = _match_special_brand(brand_name_lower)
+            if special_key:
+                profile_key = special_key
+                logger.info("CASO ESPECIAL: '%s' -> '%s'", brand_name, profile_key)
                 
             # Si no son casos especiales, intentar con la normalización
             else:
                 try:
                     # Normalizar el nombre de la marca para la búsqueda
                     normalized_brand = normalize_brand_name_for_search(brand_name)
-                    logger.info(f"Nombre normalizado para búsqueda: '{normalized_brand}'")
+                    logger.info("Nombre normalizado para búsqueda: '%s'", normalized_brand)
                     
-                    # Buscar en el mapeo de nombres normalizados
-                    if normalized_brand in BRAND_NAME_MAPPING:
-                        profile_key = BRAND_NAME_MAPPING[normalized_brand]
-                        logger.info(f"PERFIL ENCONTRADO POR MAPEO: '{brand_name}' -> '{profile_key}'")
-                    # Si aún no se encuentra, intentar coincidencia parcial
+                    # Buscar en el índice de nombres normalizados
+                    mapped_key = _BRAND_LOOKUP.get(normalized_brand)
+                    if mapped_key:
+                        profile_key = mapped_key
+                        logger.info("PERFIL ENCONTRADO POR MAPEO: '%s' -> '%s'", brand_name, profile_key)
+                    # Si aún no se encuentra, intentar coincidencia parcial (memorizada por nombre)
                     else:
-                        for norm_key, exact_key in BRAND_NAME_MAPPING.items():
-                            if norm_key in normalized_brand or normalized_brand in norm_key:
-                                profile_key = exact_key
-                                logger.info(f"PERFIL ENCONTRADO POR COINCIDENCIA PARCIAL: '{brand_name}' -> '{profile_key}'")
-                                break
+                        partial_key = _find_partial_brand_match(normalized_brand)
+                        if partial_key:
+                            profile_key = partial_key
+                            logger.info("PERFIL ENCONTRADO POR COINCIDENCIA PARCIAL: '%s' -> '%s'", brand_name, profile_key)
                 except Exception as e:
-                    logger.error(f"Error al normalizar nombre de marca: {e}")
+                    logger.error("Error al normalizar nombre de marca: %s", e)
                     # En caso de error, intentar directamente con los casos especiales conocidos
     
-    # Log para debugging detallado
-    try:
-        if logger:
-            logger.info(f"SELECCIÓN DE PERFIL: '{profile_key}' para entrada: '{brand_name}' "+
-                        f"(normalizado como: '{normalize_brand_name_for_search(brand_name) if brand_name else ''}')") 
-    except Exception as e:
-        pass
+    # Log para debugging detallado (la normalización extra solo se calcula si el nivel INFO está activo)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "SELECCIÓN DE PERFIL: '%s' para entrada: '%s' (normalizado como: '%s')",
+            profile_key, brand_name,
+            normalized_brand if normalized_brand is not None else normalize_brand_name_for_search(brand_name)
+        )
     
-    # Obtener el perfil del diccionario BRAND_PROFILES
-    profile = BRAND_PROFILES[profile_key]
-
     context_to_use = context.strip() if context and isinstance(context, str) else "No se encontró contexto relevante."
     user_query = user_query.strip() if user_query and isinstance(user_query, str) else "Consulta no especificada."
 
     # Formatear el historial de conversación para el prompt
     if isinstance(conversation_history, list):
         # Si es una lista de diccionarios, formatearlo adecuadamente
-        if conversation_history and len(conversation_history) > 0:
+        if conversation_history:
             history_lines = []
             for turn in conversation_history[-6:]:
-                role = turn.get("role", "").lower()
-                content = turn.get("content", "").strip()
-                if content and role in ["user", "assistant", "human", "ai"]:
-                    role_display = "Usuario" if role in ["user", "human"] else "Asistente"
+                role_display = _ROLE_DISPLAY.get((turn.get("role") or "").lower())
+                if not role_display:
+                    continue
+                content = (turn.get("content") or "").strip()
+                if content:
                     history_lines.append(f"{role_display}: {content}")
             if history_lines:
                 formatted_history = "\n".join(history_lines)
@@ -619,55 +565,34 @@ def build_llm_prompt(
         # Si ya es un string (para compatibilidad con código existente)
         formatted_history = conversation_history if conversation_history and str(conversation_history).strip() else "No hay historial previo de conversación."
 
-    # Saludo personalizado y transición según el turno
-    if is_first_turn:
-        user_greeting_line = profile.get("greeting_style", "¡Hola! Estoy aquí para ayudarte. ¿Qué necesitas?")
-        if user_collected_name and isinstance(user_collected_name, str):
-            user_first_name = user_collected_name.strip().split()[0].capitalize()
-            if "[Nombre]" in user_greeting_line and user_first_name.isalpha():
-                user_greeting_line = user_greeting_line.replace("[Nombre]", user_first_name)
-            else:
-                user_greeting_line = user_greeting_line.replace("[Nombre]", "").strip()
-                if user_greeting_line.endswith(" !"):
-                    user_greeting_line = user_greeting_line[:-2].strip() + "!"
-    else:
-        user_greeting_line = profile.get("follow_up_greeting_style", "Entendido, seguimos...")
-
-    response_length_guidance = profile.get("response_length_guidance", "Responde en 3-5 frases cortas.")
-    tone_keywords = ", ".join(profile.get("tone_keywords", ["amigable", "servicial"]))
-
-    # Rol/firma para el prompt - debe ser conciso
-    if ":" in profile_key and profile_key != "default":
-        # Para perfiles como "CONSULTOR: Javier Bazán", extraer solo "Javier Bazán"
-        role_for_signature = profile_key.split(":", 1)[1].strip()  
-    elif profile_key != "default":
-        # Para perfiles con nombres directos como "Universidad para el Desarrollo Digital"
-        parts = profile_key.split()
-        role_for_signature = parts[-2] if len(parts) > 2 else profile_key
-    else:
-        # Para el perfil default, extraer un rol genérico conciso
-        role_for_signature = "Consultor"
-    if len(role_for_signature) > 50:
-        role_for_signature = role_for_signature[:47] + "..."
-    role_for_signature = role_for_signature or "Asistente"
-
-    prompt = PROMPT_TEMPLATE.format(
-        persona_description=profile["persona_description"],
-        tone_keywords=tone_keywords,
-        user_greeting_line=user_greeting_line,
-        response_length_guidance=response_length_guidance,
-        empathy_example_phrase=profile.get("empathy_example_phrase", "Entiendo, te ayudo."),
-        context=context_to_use,
-        conversation_history=formatted_history,
-        user_query=user_query,
-        role_for_signature=role_for_signature
+    prompt = _render_prompt_for_profile(
+        profile_key,
+        user_query,
+        context_to_use,
+        formatted_history,
+        user_collected_name if isinstance(user_collected_name, str) else None,
+        bool(is_first_turn),
     )
 
-    prompt = re.sub(r'\n\s*\n+', '\n\n', prompt.strip())
+    logger.debug("Prompt LLM para %s (longitud: %d):\n%s", profile_key, len(prompt), prompt)
+    return prompt
+
 
-    try:
-        if logger:
-            logger.debug(f"Prompt LLM para {profile_key} (longitud: {len(prompt)}):\n{prompt}")
-    except Exception:
-        pass
-    return prompt
\ No newline at end of file
+def build_llm_messages(
+    brand_name: Optional[str],
+    user_query: str,
+    context: str,
+    conversation_history: Union[List[Dict[str, str]], str],
+    user_collected_name: Optional[str] = None,
+    is_first_turn: bool = True
+) -> List[Dict[str, str]]:
+    """Construye los mensajes ({"role", "content"}) para `get_llm_response`.
+    
+    Mismos argumentos que build_llm_prompt. El prompt completo va como único mensaje
+    "user" (el mismo payload que resultaba de enviar el string), de modo que el cliente
+    LLM no tiene que volver a parsearlo en cada llamada.
+    """
+    prompt = build_llm_prompt(
+        brand_name, user_query, context, conversation_history, user_collected_name, is_first_turn
+    )
+    return [{"role": "user", "content": prompt}]
\ No newline at end of file
@@ -1,18 +1,39 @@
 # app/ai/rag_retriever.py
 import os
 import sys
+import math
+import json
+import mmap
+import time
 import logging
+import shutil
 from pathlib import Path 
-from typing import List, Optional, Any, Dict, Tuple
+from typing import List, Optional, Any, Dict, Tuple, Iterable, TYPE_CHECKING
+from itertools import islice
 import asyncio
+import weakref
+from collections import OrderedDict
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
+
+# 'resource' solo existe en Unix; en Windows (startup.bat) se omite la medición de memoria
+try:
+    import resource
+    RESOURCE_OK = True
+except ImportError:
+    RESOURCE_OK = False
 
 # --- Importaciones de Terceros (Langchain, Azure) ---
 # Intentar importar Langchain y FAISS. Si falla, RAG no funcionará.
-try:
+# HuggingFaceEmbeddings (torch, transformers, tokenizers) se importa recién al cargar el modelo,
+# para que importar este módulo no cueste segundos ni cientos de MB si RAG no llega a usarse.
+if TYPE_CHECKING:
     from langchain_community.embeddings import HuggingFaceEmbeddings
+try:
     from langchain_community.vectorstores import FAISS
     from langchain_core.documents import Document as LangchainDocument
     from langchain_core.vectorstores import VectorStoreRetriever
+    import numpy as np
     LANGCHAIN_OK = True # Variable global para indicar si Langchain está disponible
     # print("DEBUG [rag_retriever.py]: Langchain components imported successfully.") # Para depuración muy temprana
 except ImportError as e_langchain:
@@ -32,7 +53,6 @@ except ImportError as e_langchain:
     # Clases Dummy para evitar NameError si LANGCHAIN_OK es False y el código intenta usarlas
     # Esto permite que el resto del módulo se importe sin errores fatales inmediatos,
     # aunque las funciones RAG no serán operativas.
-    class HuggingFaceEmbeddings: pass # type: ignore
     class FAISS: pass # type: ignore
     class LangchainDocument: # type: ignore
         def __init__(self, page_content: str, metadata: Optional[Dict[str, Any]] = None):
@@ -72,6 +92,37 @@ except ImportError as e_cfg_log_rag:
     settings = None # type: ignore # Para evitar NameError si settings no se cargó
     CONFIG_AND_LOGGER_OK_RAG = False
 
+# Valores de settings usados en cada búsqueda: se resuelven una sola vez al importar
+_RAG_SETTINGS_OK = CONFIG_AND_LOGGER_OK_RAG and settings is not None
+_RAG_DEFAULT_K: int = getattr(settings, 'RAG_DEFAULT_K', 3) if _RAG_SETTINGS_OK else 3 # Fallback K
+_RAG_FETCH_K: int = _RAG_DEFAULT_K * (getattr(settings, 'RAG_K_FETCH_MULTIPLIER', 4) if _RAG_SETTINGS_OK else 4)
+
+
+# Conexiones paralelas (rangos) por blob al descargar el índice desde Azure
+BLOB_DOWNLOAD_MAX_CONCURRENCY = 4
+
+@lru_cache(maxsize=4)
+def _get_blob_service_client(storage_account_name: str, connection_string: Optional[str] = None) -> "BlobServiceClient":
+    """Devuelve un BlobServiceClient reutilizable por cuenta (conserva el pool HTTP y la credencial ya resuelta)."""
+    if connection_string:
+        logger.info("  Autenticando en Azure Blob con CADENA DE CONEXIÓN para cuenta '%s'.", storage_account_name)
+        return BlobServiceClient.from_connection_string(connection_string)
+    logger.info("  Autenticando en Azure Blob con DefaultAzureCredential para cuenta '%s'.", storage_account_name)
+    account_url = f"https://{storage_account_name}.blob.core.windows.net"
+    # El logging detallado de Azure Identity solo se habilita si este módulo está en DEBUG
+    credential = DefaultAzureCredential(logging_enable=logger.isEnabledFor(logging.DEBUG))
+    return BlobServiceClient(account_url=account_url, credential=credential)
+
+def _download_blob_to_file(container_client: Any, blob_name: str, local_file_path: Path) -> None:
+    """Descarga un blob del contenedor a un archivo local, por bloques."""
+    logger.info("    Descargando blob '%s' a '%s'...", blob_name, local_file_path)
+    blob_client = container_client.get_blob_client(blob_name)
+    with open(local_file_path, "wb") as download_file:
+        # Timeout 5 min; readinto escribe por bloques en disco sin cargar el blob completo en memoria
+        download_stream = blob_client.download_blob(timeout=300, max_concurrency=BLOB_DOWNLOAD_MAX_CONCURRENCY)
+        download_stream.readinto(download_file)
+    if logger.isEnabledFor(logging.INFO): # Evita el stat() si el log está filtrado
+        logger.info("    '%s' descargado (%d bytes).", blob_name, local_file_path.stat().st_size)
 
 def _download_faiss_files_from_azure(
     local_index_target_folder: Path, 
@@ -82,7 +133,7 @@ def _download_faiss_files_from_azure(
 ) -> bool:
     """Descarga los archivos .faiss y .pkl del índice desde Azure Blob Storage."""
     
-    logger.info(f"RAG_AZURE_DOWNLOAD: Intentando descarga de índice '{faiss_index_filename_base}' desde Azure Blob.")
+    logger.info("RAG_AZURE_DOWNLOAD: Intentando descarga de índice '%s' desde Azure Blob.", faiss_index_filename_base)
 
     if not AZURE_SDK_OK:
         logger.error("RAG_AZURE_DOWNLOAD: Azure SDK (azure.storage.blob, azure.identity) no disponible. No se puede descargar de Azure.")
@@ -97,50 +148,503 @@ def _download_faiss_files_from_azure(
     local_faiss_file_path = local_index_target_folder / faiss_blob_name
     local_pkl_file_path = local_index_target_folder / pkl_blob_name
 
-    logger.debug(f"  Target local: '{local_index_target_folder}', FAISS file: '{faiss_blob_name}', PKL file: '{pkl_blob_name}'")
+    logger.debug("  Target local: '%s', FAISS file: '%s', PKL file: '%s'", local_index_target_folder, faiss_blob_name, pkl_blob_name)
 
     try:
-        blob_service_client: BlobServiceClient
-        if connection_string_cfg:
-            logger.info(f"  Autenticando en Azure Blob con CADENA DE CONEXIÓN para cuenta '{storage_account_name_cfg}'.")
-            blob_service_client = BlobServiceClient.from_connection_string(connection_string_cfg)
-        else:
-            logger.info(f"  Autenticando en Azure Blob con DefaultAzureCredential para cuenta '{storage_account_name_cfg}'.")
-            account_url = f"https://{storage_account_name_cfg}.blob.core.windows.net"
-            credential = DefaultAzureCredential(logging_enable=True) # Habilitar logging de Azure Identity
-            blob_service_client = BlobServiceClient(account_url=account_url, credential=credential)
+        blob_service_client = _get_blob_service_client(storage_account_name_cfg, connection_string_cfg)
 
         container_client = blob_service_client.get_container_client(container_name_cfg)
-        logger.info(f"  Accediendo al contenedor de Azure: '{container_name_cfg}'.")
+        logger.info("  Accediendo al contenedor de Azure: '%s'.", container_name_cfg)
         
         local_index_target_folder.mkdir(parents=True, exist_ok=True)
-        logger.debug(f"  Directorio local para el índice asegurado: '{local_index_target_folder}'.")
-
-        # Descargar .faiss
-        logger.info(f"    Descargando blob '{faiss_blob_name}' a '{local_faiss_file_path}'...")
-        blob_client_faiss = container_client.get_blob_client(faiss_blob_name)
-        with open(local_faiss_file_path, "wb") as download_file_faiss:
-            download_stream_faiss = blob_client_faiss.download_blob(timeout=300) # Timeout 5 min
-            download_file_faiss.write(download_stream_faiss.readall())
-        logger.info(f"    '{faiss_blob_name}' descargado ({local_faiss_file_path.stat().st_size} bytes).")
-
-        # Descargar .pkl
-        logger.info(f"    Descargando blob '{pkl_blob_name}' a '{local_pkl_file_path}'...")
-        blob_client_pkl = container_client.get_blob_client(pkl_blob_name)
-        with open(local_pkl_file_path, "wb") as download_file_pkl:
-            download_stream_pkl = blob_client_pkl.download_blob(timeout=300) # Timeout 5 min
-            download_file_pkl.write(download_stream_pkl.readall())
-        logger.info(f"    '{pkl_blob_name}' descargado ({local_pkl_file_path.stat().st_size} bytes).")
+        logger.debug("  Directorio local para el índice asegurado: '%s'.", local_index_target_folder)
+
+        # Descargar .faiss y .pkl en paralelo (transferencias independientes, limitadas por red)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="faiss_blob_download") as executor:
+            download_futures = [
+                executor.submit(_download_blob_to_file, container_client, faiss_blob_name, local_faiss_file_path),
+                executor.submit(_download_blob_to_file, container_client, pkl_blob_name, local_pkl_file_path),
+            ]
+            for download_future in download_futures:
+                download_future.result() # Propaga la excepción de cualquiera de las descargas
         
-        logger.info(f"RAG_AZURE_DOWNLOAD: Descarga de índice '{faiss_index_filename_base}' desde Azure completada exitosamente.")
+        logger.info("RAG_AZURE_DOWNLOAD: Descarga de índice '%s' desde Azure completada exitosamente.", faiss_index_filename_base)
         return True
 
     except Exception as e_download:
-        logger.error(f"RAG_AZURE_DOWNLOAD: Error al descargar archivos FAISS desde Azure. Cuenta: '{storage_account_name_cfg}', Contenedor: '{container_name_cfg}', Índice base: '{faiss_index_filename_base}'. Error: {e_download}", exc_info=True)
+        logger.error("RAG_AZURE_DOWNLOAD: Error al descargar archivos FAISS desde Azure. Cuenta: '%s', Contenedor: '%s', Índice base: '%s'. Error: %s", storage_account_name_cfg, container_name_cfg, faiss_index_filename_base, e_download, exc_info=True)
         if local_faiss_file_path.exists(): local_faiss_file_path.unlink(missing_ok=True)
         if local_pkl_file_path.exists(): local_pkl_file_path.unlink(missing_ok=True)
         return False
 
+def _quantize_embedding_model(embeddings: Any, quantization: str) -> None:
+    """
+    Reduce la precisión del SentenceTransformer en CPU (en el mismo objeto):
+    "int8" aplica cuantización dinámica a las capas Linear; "bf16" convierte los pesos a bfloat16.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    client = getattr(embeddings, 'client', None) or getattr(embeddings, '_client', None)
+    if client is None:
+        return
+    if quantization == "int8":
+        torch.ao.quantization.quantize_dynamic(client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif quantization == "bf16":
+        client.to(torch.bfloat16)
+    else:
+        logger.warning("  EMBEDDING_QUANTIZATION desconocido: '%s'. Se mantiene FP32.", quantization)
+        return
+    logger.info("  Modelo de embeddings cuantizado a %s.", quantization)
+
+def _enable_inference_mode(embeddings: Any) -> None:
+    """
+    Deja el SentenceTransformer en modo evaluación y ejecuta cada encode() dentro de
+    torch.inference_mode(), sin contabilidad de autograd. Se envuelve la llamada (y no se usa
+    torch.set_grad_enabled(False)) porque ese ajuste es por hilo y los embeddings se calculan
+    en hilos de asyncio.to_thread.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    client = getattr(embeddings, 'client', None) or getattr(embeddings, '_client', None)
+    if client is None or not hasattr(client, 'encode'):
+        return
+    client.eval()
+    encode = client.encode
+
+    @wraps(encode)
+    def encode_in_inference_mode(*args: Any, **kwargs: Any) -> Any:
+        with torch.inference_mode():
+            return encode(*args, **kwargs)
+
+    client.encode = encode_in_inference_mode
+
+def _compile_embedding_model(embeddings: Any, warmup_runs: int = 3) -> None:
+    """
+    Compila el transformer del SentenceTransformer con torch.compile (formas dinámicas, porque
+    la longitud de las consultas varía) y lo calienta con algunas consultas para que la
+    compilación ocurra en el arranque y no en la primera petición. Si falla, se deja en modo eager.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    client = getattr(embeddings, 'client', None) or getattr(embeddings, '_client', None)
+    transformer = client[0] if client is not None and len(client) > 0 else None
+    original_model = getattr(transformer, 'auto_model', None)
+    if original_model is None:
+        return
+    try:
+        transformer.auto_model = torch.compile(original_model, dynamic=True)
+        for _ in range(warmup_runs):
+            embeddings.embed_query("calentamiento del modelo de embeddings")
+        logger.info("  Modelo de embeddings compilado con torch.compile.")
+    except Exception as e_compile:
+        transformer.auto_model = original_model
+        logger.warning("  torch.compile no disponible para el modelo de embeddings (%s). Se usa modo eager.", e_compile)
+
+@lru_cache(maxsize=4)
+def _get_embeddings(
+    model_name: str,
+    backend: str = "torch",
+    onnx_file_name: Optional[str] = None,
+    embedding_batch_size: int = 32,
+    quantization: str = "none",
+    torch_compile: bool = False
+) -> "HuggingFaceEmbeddings":
+    """
+    Carga el modelo de embeddings una sola vez por proceso, nombre de modelo y backend.
+    Con backend "onnx", sentence-transformers ejecuta el modelo con ONNX Runtime (exportándolo
+    la primera vez; onnx_file_name permite elegir una variante cuantizada, ej. "onnx/model_qint8_avx512.onnx").
+    Si ONNX no está disponible, se usa PyTorch.
+    """
+    # Podrías añadir un cache_folder para los embeddings si es necesario y no está configurado globalmente por transformers
+    # embeddings_cache_dir = settings.BASE_DIR / ".cache" / "embeddings_hf"
+    # embeddings_cache_dir.mkdir(parents=True, exist_ok=True)
+    model_kwargs: Dict[str, Any] = {'device': 'cpu'} # Forzar CPU para consistencia
+    if backend == "onnx":
+        model_kwargs['backend'] = "onnx"
+        if onnx_file_name:
+            model_kwargs['model_kwargs'] = {'file_name': onnx_file_name}
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    try:
+        embeddings = HuggingFaceEmbeddings(
+            model_name=model_name,
+            model_kwargs=model_kwargs,
+            # Igual que en app/utils/vectorize_data.py: las consultas se comparan con vectores normalizados.
+            # encode() ordena los textos por longitud y los procesa en sub-lotes de batch_size, así cada
+            # sub-lote se rellena solo hasta su consulta más larga (smart batching).
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': embedding_batch_size},
+            # cache_folder=str(embeddings_cache_dir) # Opcional
+        )
+    except Exception as e_backend:
+        if backend == "torch":
+            raise
+        # Requiere 'pip install optimum[onnxruntime]' (no incluido en requirements.txt)
+        logger.warning("  No se pudo cargar el backend '%s' para embeddings (%s). Usando PyTorch.", backend, e_backend)
+        return _get_embeddings(model_name, embedding_batch_size=embedding_batch_size, quantization=quantization, torch_compile=torch_compile)
+    if backend == "torch" and quantization != "none":
+        _quantize_embedding_model(embeddings, quantization)
+    _enable_inference_mode(embeddings)
+    if backend == "torch" and torch_compile:
+        _compile_embedding_model(embeddings)
+    return embeddings
+
+def _pq_subquantizers(dimension: int, max_subquantizers: int = 48) -> int:
+    """Mayor número de subcuantizadores PQ (<= max_subquantizers) que divide la dimensión."""
+    for m in range(min(max_subquantizers, dimension), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+def _quantize_faiss_index(vector_store_instance: Any, index_type: str) -> bool:
+    """
+    Reconstruye el índice plano cargado como IVF+PQ ("ivfpq"), con cuantización escalar de 8 bits
+    ("sq8") o con los vectores en FP16 ("fp16": sigue siendo búsqueda exacta por fuerza bruta, pero
+    mueve la mitad de bytes por producto escalar), conservando el orden de los vectores (y por
+    tanto index_to_docstore_id).
+    Devuelve True si el índice se reemplazó.
+    """
+    try:
+        import faiss
+    except ImportError:
+        logger.warning("    faiss no importable directamente; se mantiene el índice plano.")
+        return False
+
+    flat_index = vector_store_instance.index
+    dimension, num_vectors, metric = flat_index.d, flat_index.ntotal, flat_index.metric_type
+    if num_vectors == 0:
+        return False
+    vectors = flat_index.reconstruct_n(0, num_vectors)
+
+    if index_type == 'sq8':
+        quantized_index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+    elif index_type == 'fp16':
+        # Las consultas siguen en float32; FAISS convierte al comparar
+        quantized_index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, metric)
+    elif index_type == 'ivfpq':
+        nlist = max(1, int(4 * math.sqrt(num_vectors)))
+        # PQ con 8 bits necesita al menos 256 vectores de entrenamiento, e IVF ~39 por lista
+        if num_vectors < max(256, 39 * nlist):
+            logger.warning("    Solo %s vectores: insuficientes para entrenar IVF+PQ (nlist=%s). Se mantiene el índice plano.", num_vectors, nlist)
+            return False
+        coarse_quantizer = faiss.IndexFlat(dimension, metric)
+        quantized_index = faiss.IndexIVFPQ(coarse_quantizer, dimension, nlist, _pq_subquantizers(dimension), 8, metric)
+    else:
+        logger.warning("    FAISS_INDEX_TYPE desconocido: '%s'. Se mantiene el índice plano.", index_type)
+        return False
+
+    logger.info("    Cuantizando índice FAISS (%s vectores, d=%s) a '%s'...", num_vectors, dimension, index_type)
+    quantized_index.train(vectors)
+    quantized_index.add(vectors)
+    vector_store_instance.index = quantized_index
+    logger.info("    Índice FAISS cuantizado a %s.", type(quantized_index).__name__)
+    return True
+
+def _tune_faiss_index(vector_store_instance: Any) -> None:
+    """
+    Ajusta el índice FAISS cargado según su tipo: parámetros de búsqueda para índices
+    aproximados (IVF / HNSW) y, si RAG_USE_GPU está activo y hay GPU, lo mueve a la GPU.
+    Un índice plano (IndexFlat) se deja tal cual.
+    """
+    try:
+        import faiss
+    except ImportError:
+        logger.warning("    faiss no importable directamente; se omite el ajuste del índice.")
+        return
+
+    index = vector_store_instance.index
+    nprobe = getattr(settings, 'RAG_FAISS_NPROBE', 8)
+    k_for_search = getattr(settings, 'RAG_DEFAULT_K', 3) * getattr(settings, 'RAG_K_FETCH_MULTIPLIER', 4)
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        ivf_index.nprobe = min(nprobe, ivf_index.nlist)
+        ivf_index.parallel_mode = 1 # Una sola consulta también se reparte entre hilos (por listas invertidas)
+        logger.info("    Índice IVF detectado (%s listas). nprobe=%s.", ivf_index.nlist, ivf_index.nprobe)
+    elif hasattr(index, 'hnsw'):
+        # efSearch debe ser al menos el número de vecinos solicitados
+        index.hnsw.efSearch = max(index.hnsw.efSearch, nprobe * 8, k_for_search)
+        logger.info("    Índice HNSW detectado. efSearch=%s.", index.hnsw.efSearch)
+    else:
+        logger.info("    Índice FAISS de tipo %s (búsqueda exacta).", type(index).__name__)
+
+    if getattr(settings, 'RAG_USE_GPU', False):
+        num_gpus = faiss.get_num_gpus() if hasattr(faiss, 'get_num_gpus') else 0
+        if num_gpus > 0:
+            vector_store_instance.index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+            logger.info("    Índice FAISS transferido a GPU 0 (%s GPU disponibles).", num_gpus)
+        else:
+            logger.warning("    RAG_USE_GPU activo pero no hay GPU disponible para FAISS. Se usa CPU.")
+
+def _max_rss_mb() -> float:
+    """Pico de memoria residente del proceso en MB (ru_maxrss está en KB en Linux); 0 si no se puede medir."""
+    if not RESOURCE_OK:
+        return 0.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _stage_in_shared_memory(index_file_path: Path) -> Path:
+    """
+    Copia el archivo del índice a FAISS_SHM_DIR (tmpfs, por defecto /dev/shm) para que los workers
+    que lo mapean en memoria compartan la misma copia en RAM. Solo tiene sentido para índices que
+    FAISS realmente mapea (ver _read_faiss_index_mmap). El primer worker hace la copia (escritura
+    atómica con os.replace); los demás reutilizan la existente si coincide en tamaño y no es más
+    antigua. La copia queda en el tmpfs mientras viva el contenedor (se reemplaza si el índice cambia).
+    Devuelve la ruta original si no hay directorio compartido disponible.
+    """
+    shm_dir = Path(getattr(settings, 'FAISS_SHM_DIR', None) or "/dev/shm")
+    if not shm_dir.is_dir():
+        return index_file_path
+    shared_path = shm_dir / f"rag_{index_file_path.parent.name}_{index_file_path.name}"
+    source_stat = index_file_path.stat()
+    try:
+        shared_stat = shared_path.stat()
+        if shared_stat.st_size == source_stat.st_size and shared_stat.st_mtime >= source_stat.st_mtime:
+            return shared_path
+    except FileNotFoundError:
+        pass
+    temp_path = shared_path.with_name(f"{shared_path.name}.{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(index_file_path, temp_path)
+        os.replace(temp_path, shared_path)
+    except OSError:
+        # Por ejemplo /dev/shm lleno (64 MB por defecto en Docker): no dejar la copia parcial ocupando RAM
+        temp_path.unlink(missing_ok=True)
+        raise
+    logger.info("  Índice FAISS copiado a memoria compartida: '%s'.", shared_path)
+    return shared_path
+
+def _read_faiss_index_mmap(index_file_path: Path) -> Any:
+    """
+    Lee el índice con IO_FLAG_MMAP. FAISS solo mapea en memoria las listas invertidas de los índices
+    IVF y, con IO_FLAG_MMAP_IFC (faiss >= 1.11), los códigos de los índices planos (IndexFlatCodes:
+    flat, fp16, sq8); cualquier otro índice se lee completo en cada worker. Solo si el índice quedó
+    mapeado se copia a memoria compartida y se vuelve a mapear desde allí: con un índice leído
+    completo, la copia en /dev/shm sería una copia más en RAM.
+    """
+    import faiss
+    flat_codes_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+    mmap_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | flat_codes_flag
+    raw_index = faiss.read_index(str(index_file_path), mmap_flags)
+    is_mapped = faiss.try_extract_index_ivf(raw_index) is not None \
+        or (flat_codes_flag and isinstance(raw_index, faiss.IndexFlatCodes))
+    if not is_mapped:
+        logger.info("  faiss no admite mmap para el índice %s: se leyó completo.", type(raw_index).__name__)
+        return raw_index
+    try:
+        shared_path = _stage_in_shared_memory(index_file_path)
+    except OSError as e_stage:
+        logger.warning("  No se pudo copiar el índice FAISS a memoria compartida (%s). Se mapea desde '%s'.", e_stage, index_file_path)
+        return raw_index
+    if shared_path != index_file_path:
+        raw_index = faiss.read_index(str(shared_path), mmap_flags)
+    return raw_index
+
+# Registro fijo (little-endian) del docstore binario: posición y longitud del texto, longitud de
+# la metadata JSON que le sigue en el blob y huella del contenido para deduplicar.
+_BINARY_DOCSTORE_DTYPE = np.dtype([
+    ('start', '<i8'), ('length', '<i4'), ('meta_length', '<i4'), ('content_hash', '<u8')
+]) if LANGCHAIN_OK else None
+
+class _BinaryDocstore:
+    """
+    Docstore de solo lectura sobre tres archivos generados a partir del .pkl de Langchain:
+    '<index>.offsets.bin' (un registro fijo por id FAISS), '<index>.contents.bin' (texto UTF-8 y
+    metadata JSON concatenados) y '<index>.brands.json' (ids FAISS por marca). Los dos binarios se
+    mapean en memoria, así que el arranque no deserializa el corpus y los workers comparten las
+    páginas del sistema operativo; cada Document se construye solo cuando se recupera.
+    """
+
+    def __init__(self, folder: Path, index_name: str):
+        self.offsets = np.memmap(folder / f"{index_name}.offsets.bin", dtype=_BINARY_DOCSTORE_DTYPE, mode='r')
+        contents_path = folder / f"{index_name}.contents.bin"
+        with open(contents_path, "rb") as contents_file:
+            # mmap no admite archivos vacíos (índice sin documentos)
+            self.contents = mmap.mmap(contents_file.fileno(), 0, access=mmap.ACCESS_READ) if contents_path.stat().st_size else b""
+        with open(folder / f"{index_name}.brands.json", encoding="utf-8") as brands_file:
+            self.brand_ids: Dict[str, List[int]] = json.load(brands_file)
+        self.content_hashes = np.asarray(self.offsets['content_hash'], dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def get_doc(self, faiss_id: int) -> Optional[LangchainDocument]:
+        """Construye el Document del id FAISS leyendo solo su tramo del blob."""
+        start, length, meta_length, _content_hash = self.offsets[faiss_id].item()
+        if length < 0: # Id sin documento en el docstore original
+            return None
+        page_content = self.contents[start:start + length].decode("utf-8")
+        metadata = json.loads(self.contents[start + length:start + length + meta_length]) if meta_length else {}
+        return LangchainDocument(page_content=page_content, metadata=metadata)
+
+    def search(self, search: str) -> Any:
+        """Interfaz de Docstore de Langchain: los ids del docstore son los ids FAISS como texto."""
+        doc = self.get_doc(int(search))
+        return doc if doc is not None else f"ID {search} not found."
+
+    def index_to_docstore_id(self) -> Dict[int, str]:
+        faiss_ids = np.flatnonzero(self.offsets['length'] >= 0).tolist()
+        return dict(zip(faiss_ids, map(str, faiss_ids)))
+
+    def __reduce__(self):
+        # save_local (p. ej. al guardar un índice cuantizado) sigue escribiendo un .pkl estándar
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        return (InMemoryDocstore, ({docstore_id: self.search(docstore_id) for docstore_id in self.index_to_docstore_id().values()},))
+
+def _binary_docstore_exists(folder: Path, index_name: str) -> bool:
+    return all((folder / f"{index_name}.{suffix}").exists() for suffix in ("offsets.bin", "contents.bin", "brands.json"))
+
+def _faiss_index_files_exist(folder: Path, index_name: str) -> bool:
+    """True si el .faiss y el .pkl del índice existen y no están vacíos."""
+    try:
+        return all((folder / f"{index_name}.{suffix}").stat().st_size > 0 for suffix in ("faiss", "pkl"))
+    except FileNotFoundError:
+        return False
+
+def _save_quantized_index(vector_store: Any, folder: Path, index_name: str) -> None:
+    """
+    Guarda el índice cuantizado como '<index_name>.faiss/.pkl'. Cada worker escribe con un nombre
+    temporal propio (sufijo con el pid) y publica con os.replace: el .pkl primero y el .faiss al
+    final, así otro worker que arranca nunca elige un índice a medias. Si otro worker ya lo
+    publicó, no se vuelve a escribir.
+    """
+    if _faiss_index_files_exist(folder, index_name):
+        return
+    temp_name = f"{index_name}.tmp{os.getpid()}"
+    try:
+        vector_store.save_local(str(folder), index_name=temp_name)
+        os.replace(folder / f"{temp_name}.pkl", folder / f"{index_name}.pkl")
+        os.replace(folder / f"{temp_name}.faiss", folder / f"{index_name}.faiss")
+    finally:
+        for suffix in ("faiss", "pkl"):
+            (folder / f"{temp_name}.{suffix}").unlink(missing_ok=True)
+    logger.info("  Índice cuantizado guardado como '%s' en '%s'.", index_name, folder)
+
+def _export_binary_docstore(vector_store: Any, folder: Path, index_name: str) -> None:
+    """
+    Migración única: vuelca el docstore del vector store (cargado desde el .pkl) al formato de
+    _BinaryDocstore, alineado por id FAISS. Los archivos se escriben con sufijo temporal y se
+    renombran al final, para que otro worker nunca lea una versión a medias.
+    """
+    index_to_docstore_id = vector_store.index_to_docstore_id
+    num_ids = max(index_to_docstore_id, default=-1) + 1
+    offsets = np.zeros(num_ids, dtype=_BINARY_DOCSTORE_DTYPE)
+    offsets['length'] = -1
+    brand_ids: Dict[str, List[int]] = {}
+    pid_suffix = f".tmp{os.getpid()}"
+    contents_tmp = folder / f"{index_name}.contents.bin{pid_suffix}"
+    position = 0
+    with open(contents_tmp, "wb") as contents_file:
+        for faiss_id in range(num_ids):
+            docstore_id = index_to_docstore_id.get(faiss_id)
+            doc = vector_store.docstore.search(docstore_id) if docstore_id is not None else None
+            if not isinstance(doc, LangchainDocument):
+                continue
+            content_bytes = doc.page_content.encode("utf-8")
+            meta_bytes = json.dumps(doc.metadata, ensure_ascii=False, default=str).encode("utf-8") if doc.metadata else b""
+            content_hash = doc.metadata.get('_content_hash')
+            if content_hash is None:
+                content_hash = hash(doc.page_content)
+            offsets[faiss_id] = (position, len(content_bytes), len(meta_bytes), content_hash & 0xFFFFFFFFFFFFFFFF)
+            contents_file.write(content_bytes)
+            contents_file.write(meta_bytes)
+            position += len(content_bytes) + len(meta_bytes)
+            brand = doc.metadata.get('brand')
+            if brand:
+                brand_ids.setdefault(brand, []).append(faiss_id)
+    offsets_tmp = folder / f"{index_name}.offsets.bin{pid_suffix}"
+    offsets.tofile(offsets_tmp)
+    brands_tmp = folder / f"{index_name}.brands.json{pid_suffix}"
+    with open(brands_tmp, "w", encoding="utf-8") as brands_file:
+        json.dump(brand_ids, brands_file, ensure_ascii=False)
+    # brands.json se publica al final: _binary_docstore_exists solo es cierto con los tres completos
+    os.replace(contents_tmp, folder / f"{index_name}.contents.bin")
+    os.replace(offsets_tmp, folder / f"{index_name}.offsets.bin")
+    os.replace(brands_tmp, folder / f"{index_name}.brands.json")
+    logger.info("  Docstore binario de '%s' generado en '%s' (%s documentos, %.1f MB de texto).",
+                index_name, folder, int((offsets['length'] >= 0).sum()), position / (1024 * 1024))
+
+def _load_faiss_local(folder: Path, index_name: str, embedding_model_instance: Any,
+                      use_mmap: bool, use_binary_docstore: bool) -> Optional[Any]:
+    """
+    Carga el índice FAISS sin pasar por FAISS.load_local:
+    - use_mmap: si faiss lo admite para el tipo de índice (IVF, o índices planos con faiss >= 1.11),
+      el índice se mapea en memoria en lugar de leerlo completo; el sistema operativo trae las
+      páginas bajo demanda y los workers comparten la misma copia física (ver _read_faiss_index_mmap).
+    - use_binary_docstore: si ya existe el docstore binario (_BinaryDocstore) se usa en vez del .pkl;
+      si no, el .pkl se carga como lo hace FAISS.load_local.
+    Devuelve None si no es posible, para que se use la carga normal.
+    """
+    try:
+        import faiss
+        import pickle
+        rss_before = _max_rss_mb()
+        if use_mmap:
+            raw_index = _read_faiss_index_mmap(folder / f"{index_name}.faiss")
+        else:
+            raw_index = faiss.read_index(str(folder / f"{index_name}.faiss"))
+        if use_binary_docstore and _binary_docstore_exists(folder, index_name):
+            docstore = _BinaryDocstore(folder, index_name)
+            index_to_docstore_id = docstore.index_to_docstore_id()
+        else:
+            with open(folder / f"{index_name}.pkl", "rb") as pkl_file:
+                docstore, index_to_docstore_id = pickle.load(pkl_file)
+        vector_store_instance = FAISS(
+            embedding_function=embedding_model_instance,
+            index=raw_index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id
+        )
+        logger.info("  Índice FAISS '%s' cargado (mmap: %s, docstore: %s; RSS máx.: %.1f MB -> %.1f MB).",
+                    index_name, use_mmap, type(docstore).__name__, rss_before, _max_rss_mb())
+        return vector_store_instance
+    except Exception as e_local:
+        logger.warning("  No se pudo cargar el índice FAISS '%s' con mmap/docstore binario (%s). Se usa la carga normal.", index_name, e_local)
+        return None
+
+def _configure_inference_threads() -> None:
+    """
+    Reparte los núcleos entre los workers del servidor: fija los hilos de torch (embeddings)
+    y de OpenMP en FAISS para que los procesos no compitan por las mismas CPUs.
+    RAG_NUM_THREADS > 0 fuerza el valor; si no, se usa cpu_count // WEB_CONCURRENCY.
+    """
+    num_threads = getattr(settings, 'RAG_NUM_THREADS', 0)
+    if num_threads <= 0:
+        num_workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1") or 1))
+        num_threads = max(1, (os.cpu_count() or 4) // num_workers)
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+    except ImportError:
+        pass
+    try:
+        import faiss
+        faiss.omp_set_num_threads(num_threads)
+    except ImportError:
+        pass
+    logger.info("  Hilos para embeddings/FAISS por proceso: %s.", num_threads)
+
+def _warmup_rag_components(vector_store: Any, k: int, warmup_runs: int = 3) -> None:
+    """
+    Ejecuta algunas codificaciones y búsquedas sintéticas por el mismo camino que las consultas
+    reales (agrupador de consultas), para que los hilos de OpenMP de FAISS y de torch/MKL se creen
+    y calienten en el arranque y no en la primera petición de un usuario.
+    """
+    index = getattr(vector_store, 'index', None)
+    if index is None or not index.ntotal:
+        return
+    batcher = _get_query_batcher(vector_store)
+    started = time.perf_counter()
+    try:
+        for _ in range(warmup_runs):
+            batcher._encode(["calentamiento"] * min(8, batcher.max_batch_size))
+            index.search(np.zeros((8, index.d), dtype=np.float32), min(k, index.ntotal))
+        logger.info("  Calentamiento de embeddings/FAISS completado en %.1f ms.", (time.perf_counter() - started) * 1000)
+    except Exception as e_warmup:
+        logger.warning("  No se pudo calentar el modelo de embeddings/índice FAISS: %s", e_warmup)
+
 # --- ESTA ES LA FUNCIÓN QUE SE IMPORTA EN app/__init__.py ---
 def load_rag_components() -> Optional[VectorStoreRetriever]:
     """
@@ -158,6 +662,8 @@ def load_rag_components() -> Optional[VectorStoreRetriever]:
         logger.critical("RAG_LOADER: Configuración (settings) o logger principal no disponibles. No se pueden cargar componentes RAG.")
         return None
 
+    _configure_inference_threads()
+
     # Validar configuraciones necesarias de 'settings'
     embedding_model = getattr(settings, 'EMBEDDING_MODEL_NAME', None)
     faiss_index_name_base = getattr(settings, 'FAISS_INDEX_NAME', None) # ej: "index"
@@ -217,30 +723,62 @@ def load_rag_components() -> Optional[VectorStoreRetriever]:
     # 2. Cargar embeddings y el índice FAISS desde la ruta local
     try:
         logger.info(f"  Cargando modelo de embeddings: '{embedding_model}'...")
-        # Podrías añadir un cache_folder para los embeddings si es necesario y no está configurado globalmente por transformers
-        # embeddings_cache_dir = settings.BASE_DIR / ".cache" / "embeddings_hf"
-        # embeddings_cache_dir.mkdir(parents=True, exist_ok=True)
-        embedding_model_instance = HuggingFaceEmbeddings(
-            model_name=embedding_model,
-            model_kwargs={'device': 'cpu'}, # Forzar CPU para consistencia
-            # cache_folder=str(embeddings_cache_dir) # Opcional
+        embedding_model_instance = _get_embeddings(
+            embedding_model,
+            getattr(settings, 'EMBEDDING_BACKEND', 'torch'),
+            getattr(settings, 'EMBEDDING_ONNX_FILE_NAME', None),
+            getattr(settings, 'EMBEDDING_BATCH_SIZE', 32),
+            getattr(settings, 'EMBEDDING_QUANTIZATION', 'none'),
+            getattr(settings, 'EMBEDDING_TORCH_COMPILE', False)
         )
         logger.info("  Modelo de embeddings cargado exitosamente.")
 
-        logger.info(f"  Cargando índice FAISS desde '{local_index_dir_to_use}' (nombre base del índice: '{faiss_index_name_base}')...")
-        vector_store_instance = FAISS.load_local(
-            folder_path=str(local_index_dir_to_use), # Debe ser string
-            embeddings=embedding_model_instance,
-            index_name=faiss_index_name_base, # Importante: nombre base de los archivos .faiss y .pkl
-            allow_dangerous_deserialization=True # Necesario para índices creados con algunas versiones de Langchain/FAISS
-        )
-        logger.info(f"  Índice FAISS '{faiss_index_name_base}' cargado exitosamente desde '{local_index_dir_to_use}'.")
+        # Si se pidió un índice cuantizado y ya se convirtió en un arranque anterior, se carga directamente
+        faiss_index_type = getattr(settings, 'FAISS_INDEX_TYPE', 'flat')
+        quantized_index_name = f"{faiss_index_name_base}_{faiss_index_type}"
+        index_name_to_load = faiss_index_name_base
+        if faiss_index_type != 'flat' and _faiss_index_files_exist(local_index_dir_to_use, quantized_index_name):
+            index_name_to_load = quantized_index_name
+
+        logger.info(f"  Cargando índice FAISS desde '{local_index_dir_to_use}' (nombre base del índice: '{index_name_to_load}')...")
+        vector_store_instance = None
+        use_faiss_mmap = getattr(settings, 'FAISS_USE_MMAP', False)
+        use_binary_docstore = getattr(settings, 'FAISS_BINARY_DOCSTORE', False)
+        if use_faiss_mmap or use_binary_docstore:
+            vector_store_instance = _load_faiss_local(local_index_dir_to_use, index_name_to_load, embedding_model_instance,
+                                                      use_faiss_mmap, use_binary_docstore)
+        if vector_store_instance is None:
+            vector_store_instance = FAISS.load_local(
+                folder_path=str(local_index_dir_to_use), # Debe ser string
+                embeddings=embedding_model_instance,
+                index_name=index_name_to_load, # Importante: nombre base de los archivos .faiss y .pkl
+                allow_dangerous_deserialization=True # Necesario para índices creados con algunas versiones de Langchain/FAISS
+            )
+        logger.info(f"  Índice FAISS '{index_name_to_load}' cargado exitosamente desde '{local_index_dir_to_use}'.")
+        if use_binary_docstore and not isinstance(vector_store_instance.docstore, _BinaryDocstore):
+            try:
+                _export_binary_docstore(vector_store_instance, local_index_dir_to_use, index_name_to_load)
+            except Exception as e_export:
+                logger.warning("  No se pudo generar el docstore binario de '%s': %s", index_name_to_load, e_export)
+
+        if faiss_index_type != 'flat' and index_name_to_load != quantized_index_name:
+            if _quantize_faiss_index(vector_store_instance, faiss_index_type):
+                # Se guarda junto al original para que los siguientes arranques no vuelvan a entrenar.
+                # Un fallo al guardar no impide usar el índice ya cuantizado en memoria.
+                try:
+                    _save_quantized_index(vector_store_instance, local_index_dir_to_use, quantized_index_name)
+                except Exception as e_save:
+                    logger.warning("  No se pudo guardar el índice cuantizado '%s': %s", quantized_index_name, e_save)
         
         if hasattr(vector_store_instance, 'index') and vector_store_instance.index:
              logger.info(f"    Verificación: Número total de vectores en el índice FAISS cargado: {vector_store_instance.index.ntotal}")
+             _tune_faiss_index(vector_store_instance)
         else:
             logger.warning("    Advertencia: El índice FAISS se cargó, pero el objeto 'index' interno no está disponible o es None.")
 
+        # Agrupador de consultas y selectores FAISS por marca, preparados antes de la primera búsqueda
+        _get_query_batcher(vector_store_instance)
+
         # 3. Crear y Devolver el Retriever
         rag_k_default = getattr(settings, 'RAG_DEFAULT_K', 3)
         rag_k_mult = getattr(settings, 'RAG_K_FETCH_MULTIPLIER', 4)  # Aumentado de 2 a 4 para obtener más documentos
@@ -252,6 +790,7 @@ def load_rag_components() -> Optional[VectorStoreRetriever]:
             search_kwargs={'k': k_for_retriever_search}
         )
         logger.info("  Retriever FAISS creado exitosamente.")
+        _warmup_rag_components(vector_store_instance, k_for_retriever_search)
         logger.info("RAG_LOADER: ¡Componentes RAG (embeddings, vector store, retriever) cargados y listos!")
         return retriever_instance
         
@@ -259,6 +798,299 @@ def load_rag_components() -> Optional[VectorStoreRetriever]:
         logger.error(f"RAG_LOADER: Error CRÍTICO durante la carga local de embeddings o el índice FAISS desde '{local_index_dir_to_use}': {e_load_local}", exc_info=True)
         return None
 
+def _select_unique_docs(
+    docs: Iterable[LangchainDocument],
+    k: int,
+    target_brand: Optional[str] = None
+) -> List[LangchainDocument]:
+    """
+    Devuelve hasta k documentos sin contenido duplicado, en el orden recibido.
+    Si se indica target_brand, solo conserva los que tienen ese valor en la metadata 'brand'.
+    """
+    seen_content_hashes = set()
+    seen_add = seen_content_hashes.add
+
+    def keep(doc: LangchainDocument) -> bool:
+        if target_brand is not None and doc.metadata.get('brand') != target_brand:
+            return False
+        # Evitar duplicados de contenido exacto. Los índices nuevos traen la huella calculada en la
+        # vectorización ('_content_hash'); si falta, se usa el hash del texto.
+        content_hash = doc.metadata.get('_content_hash')
+        if content_hash is None:
+            content_hash = hash(doc.page_content)
+        if content_hash in seen_content_hashes:
+            return False
+        seen_add(content_hash)
+        return True
+
+    return list(islice(filter(keep, docs), k))
+
+class _QueryBatcher:
+    """
+    Agrupa las búsquedas RAG concurrentes sobre un mismo vector store: espera una ventana corta
+    (RAG_BATCH_MS), calcula los embeddings de todas las consultas pendientes en un solo lote
+    y las busca en el índice FAISS con una sola llamada. Tanto el modelo de embeddings como
+    FAISS son mucho más eficientes procesando un lote que consulta por consulta.
+    Las búsquedas por marca se resuelven solo sobre los vectores de esa marca (IDSelector).
+    """
+
+    def __init__(self, vector_store: Any, window_seconds: float, max_batch_size: int):
+        self.vector_store = vector_store
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        brand_ids, self._content_hashes, self._documents = self._scan_docstore()
+        self._brand_routes = self._build_brand_routes(brand_ids)
+        # Caché LRU de embeddings de consultas (las preguntas frecuentes se repiten mucho)
+        self.embedding_cache_size = getattr(settings, 'RAG_QUERY_EMBEDDING_CACHE_SIZE', 4096) if _RAG_SETTINGS_OK else 4096
+        self._embedding_cache: "OrderedDict[str, Any]" = OrderedDict() # Filas float32 de numpy
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._next_stats_log = 1000
+
+    def _scan_docstore(self) -> Tuple[Dict[str, List[int]], Any, Any]:
+        """
+        Recorre el docstore una sola vez y devuelve, alineados por id FAISS (estructura de arrays):
+        - los ids FAISS de cada marca normalizada (metadata 'brand'),
+        - un array uint64 con la huella del contenido, para deduplicar resultados con numpy,
+        - un array de objetos con el documento, para materializar resultados sin pasar por
+          index_to_docstore_id ni docstore.search.
+        """
+        docstore = self.vector_store.docstore
+        if isinstance(docstore, _BinaryDocstore):
+            # Marcas y huellas ya vienen precalculadas; los documentos se construyen bajo demanda
+            return docstore.brand_ids, docstore.content_hashes, None
+        brand_ids: Dict[str, List[int]] = {}
+        index_to_docstore_id = self.vector_store.index_to_docstore_id
+        num_ids = max(index_to_docstore_id, default=-1) + 1
+        content_hashes = np.zeros(num_ids, dtype=np.uint64)
+        documents = np.empty(num_ids, dtype=object)
+        for faiss_id, docstore_id in index_to_docstore_id.items():
+            doc = docstore.search(docstore_id)
+            if not isinstance(doc, LangchainDocument):
+                continue
+            documents[faiss_id] = doc
+            content_hash = doc.metadata.get('_content_hash') # Huella calculada al vectorizar
+            if content_hash is None:
+                content_hash = hash(doc.page_content)
+            content_hashes[faiss_id] = content_hash & 0xFFFFFFFFFFFFFFFF
+            brand = doc.metadata.get('brand')
+            if brand:
+                brand_ids.setdefault(brand, []).append(faiss_id)
+        return brand_ids, content_hashes, documents
+
+    def _build_brand_routes(self, brand_ids: Dict[str, List[int]]) -> Optional[Dict[str, Any]]:
+        """
+        Prepara, por marca normalizada, un IDSelector sobre el índice completo: IDSelectorRange si los
+        ids de la marca son consecutivos (lo habitual, se vectorizan juntos) o IDSelectorBatch si no.
+        No se copian vectores: un sub-índice por marca duplicaría el índice en cada worker y anularía
+        lo que se comparte con mmap / memoria compartida.
+        Devuelve None si faiss no está disponible, no admite selectores o el índice está en GPU
+        (RAG_USE_GPU): los índices planos en GPU no aceptan IDSelector.
+        """
+        try:
+            import faiss
+        except ImportError:
+            faiss = None
+        if faiss is None or not hasattr(faiss, 'SearchParameters'):
+            logger.warning("RAG_BATCH: faiss sin soporte de IDSelector; el filtro por marca usará el vector store.")
+            return None
+        if hasattr(faiss, 'GpuIndex') and isinstance(self.vector_store.index, faiss.GpuIndex):
+            logger.info("RAG_BATCH: Índice FAISS en GPU; el filtro por marca usará el vector store.")
+            return None
+        routes = {}
+        for brand, ids in brand_ids.items():
+            ids_array = np.unique(np.asarray(ids, dtype='int64'))
+            if int(ids_array[-1]) - int(ids_array[0]) + 1 == len(ids_array):
+                routes[brand] = faiss.IDSelectorRange(int(ids_array[0]), int(ids_array[-1]) + 1)
+            else:
+                routes[brand] = faiss.IDSelectorBatch(ids_array)
+        logger.info("RAG_BATCH: Selectores FAISS por marca construidos para %s marcas.", len(routes))
+        return routes
+
+    async def search(
+        self,
+        query: str,
+        k: int,
+        target_brand: Optional[str] = None,
+        fetch_k: Optional[int] = None
+    ) -> List[LangchainDocument]:
+        """
+        Encola la consulta y espera sus documentos (equivalente a vector_store.similarity_search,
+        con filter={'brand': target_brand} si se indica marca).
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future: asyncio.Future = loop.create_future()
+        self._queue.put_nowait((query, k, target_brand, fetch_k, future))
+        return await future
+
+    async def _run(self) -> None:
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            if self.window_seconds > 0:
+                await asyncio.sleep(self.window_seconds)
+            while len(batch) < self.max_batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            try:
+                results = await asyncio.to_thread(self._search_batch, batch)
+            except Exception as e_batch:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e_batch)
+                continue
+            for (*_, future), docs in zip(batch, results):
+                if not future.done():
+                    future.set_result(docs)
+
+    def _search_batch(self, batch: List[Tuple[str, int, Optional[str], Optional[int], asyncio.Future]]) -> List[List[LangchainDocument]]:
+        """Calcula los embeddings del lote en una sola llamada y busca los vectores en el índice."""
+        query_vectors = self._embed_queries([query for query, *_ in batch])
+
+        query_matrix = np.vstack(query_vectors) # Nueva matriz float32 contigua: la caché no se modifica
+        if getattr(self.vector_store, '_normalize_L2', False): # Igual que similarity_search_by_vector
+            query_matrix /= np.linalg.norm(query_matrix, axis=1, keepdims=True)
+
+        results: List[List[LangchainDocument]] = [[] for _ in batch]
+        # Las consultas sin marca se resuelven con un único index.search sobre la matriz de vectores:
+        # FAISS paraleliza internamente las búsquedas de un lote.
+        plain_rows = [row for row, (_query, _k, target_brand, *_) in enumerate(batch) if not target_brand]
+        if plain_rows:
+            max_k = max(batch[row][1] for row in plain_rows)
+            _distances, faiss_ids = self.vector_store.index.search(query_matrix[plain_rows], max_k)
+            for row, ids_for_row in zip(plain_rows, faiss_ids):
+                results[row] = self._docs_for_faiss_ids(self._unique_faiss_ids(ids_for_row, batch[row][1]))
+
+        # Las consultas con marca se agrupan por marca: una búsqueda con el selector de cada marca
+        brand_rows: Dict[str, List[int]] = {}
+        for row, (_query, _k, target_brand, *_) in enumerate(batch):
+            if target_brand:
+                brand_rows.setdefault(target_brand, []).append(row)
+        for target_brand, rows in brand_rows.items():
+            self._search_brand(batch, rows, query_matrix, query_vectors, target_brand, results)
+        return results
+
+    def _encode(self, texts: List[str]) -> Any:
+        """
+        Calcula los embeddings de `texts` como filas float32 de numpy. Si el vector store usa
+        HuggingFaceEmbeddings se llama directamente a SentenceTransformer.encode (con los mismos
+        encode_kwargs y el mismo reemplazo de saltos de línea que embed_documents), evitando
+        la conversión a listas de Python y de vuelta a numpy.
+        """
+        embeddings_model = getattr(self.vector_store, 'embeddings', None)
+        client = getattr(embeddings_model, 'client', None)
+        if client is not None and hasattr(client, 'encode'):
+            encode_kwargs = dict(getattr(embeddings_model, 'encode_kwargs', None) or {})
+            encode_kwargs['convert_to_numpy'] = True
+            vectors = client.encode([text.replace("\n", " ") for text in texts], **encode_kwargs)
+            return np.asarray(vectors, dtype=np.float32)
+        if embeddings_model is not None:
+            return np.asarray(embeddings_model.embed_documents(texts), dtype=np.float32)
+        # embedding_function como función simple
+        return np.asarray([self.vector_store.embedding_function(text) for text in texts], dtype=np.float32)
+
+    def _embed_queries(self, queries: List[str]) -> List[Any]:
+        """
+        Devuelve el embedding de cada consulta. Las ya vistas salen de la caché LRU (clave: texto
+        sin espacios en los extremos) y las demás se calculan juntas en una sola llamada al modelo.
+        Solo se ejecuta desde el hilo del lote en curso, así que la caché no necesita bloqueo.
+        """
+        cache = self._embedding_cache
+        keys = [query.strip() for query in queries]
+        missing = [key for key in dict.fromkeys(keys) if key not in cache]
+        self._cache_hits += len(keys) - len(missing)
+        self._cache_misses += len(missing)
+
+        if missing:
+            new_vectors = self._encode(missing)
+            if len(missing) > 1:
+                logger.debug("RAG_BATCH: %s consultas agrupadas en un solo lote de embeddings.", len(missing))
+            for key, vector in zip(missing, new_vectors):
+                cache[key] = vector
+
+        query_vectors = []
+        for key in keys:
+            cache.move_to_end(key)
+            query_vectors.append(cache[key])
+        while len(cache) > self.embedding_cache_size:
+            cache.popitem(last=False)
+
+        lookups = self._cache_hits + self._cache_misses
+        if lookups >= self._next_stats_log:
+            self._next_stats_log += 1000
+            logger.info("RAG_BATCH: Caché de embeddings de consultas: %s aciertos de %s (%.1f%%), %s entradas.",
+                        self._cache_hits, lookups, 100 * self._cache_hits / lookups, len(cache))
+        return query_vectors
+
+    def _search_brand(
+        self,
+        batch: List[Tuple[str, int, Optional[str], Optional[int], asyncio.Future]],
+        rows: List[int],
+        query_matrix: Any,
+        query_vectors: List[Any],
+        target_brand: str,
+        results: List[List[LangchainDocument]]
+    ) -> None:
+        """Resuelve las filas `rows` del lote buscando solo entre los vectores de `target_brand`."""
+        if self._brand_routes is None: # Sin soporte en faiss: filtro por metadato del vector store
+            for row in rows:
+                _query, k, _brand, fetch_k, _future = batch[row]
+                search_kwargs = {'fetch_k': fetch_k} if fetch_k else {}
+                results[row] = self.vector_store.similarity_search_by_vector(
+                    list(query_vectors[row]), k=k, filter={'brand': target_brand}, **search_kwargs
+                )
+            return
+        selector = self._brand_routes.get(target_brand)
+        if selector is None: # Ningún documento del índice es de esta marca
+            return
+        max_k = max(batch[row][1] for row in rows)
+        _distances, faiss_ids = self.vector_store.index.search(query_matrix[rows], max_k, params=self._search_params(selector))
+        for row, ids_for_row in zip(rows, faiss_ids):
+            results[row] = self._docs_for_faiss_ids(self._unique_faiss_ids(ids_for_row, batch[row][1]))
+
+    def _search_params(self, selector: Any) -> Any:
+        """Parámetros de búsqueda con el selector, conservando nprobe/efSearch ya ajustados en el índice."""
+        import faiss
+        index = self.vector_store.index
+        ivf_index = faiss.try_extract_index_ivf(index)
+        if ivf_index is not None:
+            return faiss.SearchParametersIVF(sel=selector, nprobe=ivf_index.nprobe)
+        if hasattr(index, 'hnsw'):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+        return faiss.SearchParameters(sel=selector)
+
+    def _unique_faiss_ids(self, faiss_ids: Any, k: int) -> Any:
+        """
+        Descarta el relleno (-1) y los ids con contenido repetido (conserva la primera aparición,
+        es decir, la más similar) y devuelve como máximo k ids, todo con operaciones vectorizadas.
+        """
+        valid_ids = faiss_ids[faiss_ids >= 0]
+        _unique_hashes, first_positions = np.unique(self._content_hashes[valid_ids], return_index=True)
+        return valid_ids[np.sort(first_positions)][:k]
+
+    def _docs_for_faiss_ids(self, faiss_ids: Any) -> List[LangchainDocument]:
+        """Documentos de una fila de ids ya filtrada por _unique_faiss_ids (indexación directa en el array)."""
+        if self._documents is None: # Docstore binario: solo se materializan los ids recuperados
+            docstore = self.vector_store.docstore
+            return [doc for doc in map(docstore.get_doc, faiss_ids.tolist()) if doc is not None]
+        return [doc for doc in self._documents[faiss_ids] if doc is not None]
+
+_QUERY_BATCHERS: "weakref.WeakKeyDictionary[Any, _QueryBatcher]" = weakref.WeakKeyDictionary()
+
+def _get_query_batcher(vector_store: Any) -> _QueryBatcher:
+    """Devuelve el agrupador de consultas asociado a un vector store (uno por índice cargado)."""
+    batcher = _QUERY_BATCHERS.get(vector_store)
+    if batcher is None:
+        batch_ms = getattr(settings, 'RAG_BATCH_MS', 10) if _RAG_SETTINGS_OK else 10
+        max_batch_size = getattr(settings, 'RAG_BATCH_MAX_SIZE', 16) if _RAG_SETTINGS_OK else 16
+        batcher = _QueryBatcher(vector_store, batch_ms / 1000, max_batch_size)
+        _QUERY_BATCHERS[vector_store] = batcher
+    return batcher
+
 async def search_relevant_documents(
     retriever_instance: VectorStoreRetriever, # Este es el objeto devuelto por load_rag_components
     user_query: str,
@@ -268,89 +1100,90 @@ async def search_relevant_documents(
     """
     Busca documentos relevantes usando el retriever y opcionalmente filtra por marca.
     """
-    logger.debug(f"RAG_SEARCH: Iniciando búsqueda. Query (preview): '{user_query[:70]}...', Marca Obj: '{target_brand}', K Final: {k_final}")
+    logger.debug("RAG_SEARCH: Iniciando búsqueda. Query (preview): '%s...', Marca Obj: '%s', K Final: %s", user_query[:70], target_brand, k_final)
 
     if not LANGCHAIN_OK or retriever_instance is None:
         logger.error("RAG_SEARCH: Langchain no disponible o retriever_instance es None. Devolviendo lista vacía.")
         return []
-    if not CONFIG_AND_LOGGER_OK_RAG or not settings: # Doble chequeo por si settings no está
+    if not _RAG_SETTINGS_OK:
         logger.error("RAG_SEARCH: Settings no disponible. Usando k por defecto. Funcionalidad RAG limitada.")
-        _k_final_to_use = k_final if k_final is not None and k_final > 0 else 3 # Fallback K
-    else:
-        _k_final_to_use = k_final if k_final is not None and k_final > 0 else getattr(settings, 'RAG_DEFAULT_K', 3)
+    _k_final_to_use = k_final if k_final is not None and k_final > 0 else _RAG_DEFAULT_K
     
-    logger.debug(f"  K final a usar para selección de documentos: {_k_final_to_use}")
+    logger.debug("  K final a usar para selección de documentos: %s", _k_final_to_use)
     
     relevant_docs_final: List[LangchainDocument] = []
     try:
         # El retriever ya tiene configurado su 'k' para la búsqueda inicial (k_for_retriever_search)
-        # get_relevant_documents usará ese 'k'
         retriever_k_cfg_val = "N/A"
         if hasattr(retriever_instance, 'search_kwargs') and isinstance(retriever_instance.search_kwargs, dict):
             retriever_k_cfg_val = retriever_instance.search_kwargs.get('k', "No definido en search_kwargs")
 
-        logger.debug(f"  Ejecutando retriever.get_relevant_documents (k del retriever: {retriever_k_cfg_val}) para query...")
-        
-        # La llamada a get_relevant_documents de Langchain es síncrona, por eso se usa to_thread
-        initial_docs_found: List[LangchainDocument] = await asyncio.to_thread(
-            retriever_instance.get_relevant_documents, 
-            user_query # El 'query' es el único argumento necesario aquí
-        )
-        num_initial_docs = len(initial_docs_found)
-        logger.info(f"  Retriever devolvió {num_initial_docs} documentos iniciales.")
-
-        if not initial_docs_found:
-            logger.info("  La búsqueda inicial del retriever no devolvió ningún documento.")
-            return []
-
-        # Filtrar y seleccionar los documentos finales
-        if target_brand: # target_brand debe ser el nombre normalizado
-            logger.info(f"  Filtrando {num_initial_docs} resultados por metadato 'brand' == '{target_brand}'...")
-            filtered_by_brand_docs = []
-            seen_content_in_brand_filter = set()
-            
-            for i, doc in enumerate(initial_docs_found):
+        vector_store = getattr(retriever_instance, 'vectorstore', None)
+        if target_brand and vector_store is not None: # target_brand debe ser el nombre normalizado
+            # El filtro por metadato 'brand' se aplica dentro de FAISS (IDSelector de la marca):
+            # solo se puntúan documentos de la marca y siempre se obtienen k si existen.
+            fetch_k = retriever_k_cfg_val if isinstance(retriever_k_cfg_val, int) else _k_final_to_use
+            logger.debug("  Ejecutando búsqueda FAISS (k=%s, fetch_k=%s) con filtro brand == '%s'...", _k_final_to_use, fetch_k, target_brand)
+            brand_docs: List[LangchainDocument] = await _get_query_batcher(vector_store).search(
+                user_query,
+                k=_k_final_to_use,
+                target_brand=target_brand,
+                fetch_k=max(fetch_k, _k_final_to_use)
+            )
+            relevant_docs_final = _select_unique_docs(brand_docs, _k_final_to_use)
+            logger.info("  Búsqueda filtrada por marca completada. %s docs para '%s' (objetivo k=%s).", len(relevant_docs_final), target_brand, _k_final_to_use)
+            if not relevant_docs_final:
+                logger.warning("  ADVERTENCIA RAG: No se encontraron docs para marca '%s'. "
+                               "Verifica que la metadata 'brand' en tus documentos coincida.", target_brand)
+        else:
+            initial_docs_found: List[LangchainDocument]
+            if vector_store is not None:
+                # Misma búsqueda por similitud que el retriever, directamente sobre el índice FAISS (sin la
+                # cadena de callbacks/Runnable de Langchain) y agrupada con las consultas concurrentes
+                fetch_k = retriever_k_cfg_val if isinstance(retriever_k_cfg_val, int) else _RAG_FETCH_K
+                logger.debug("  Ejecutando búsqueda FAISS directa (k=%s) para query...", fetch_k)
+                initial_docs_found = await _get_query_batcher(vector_store).search(user_query, k=fetch_k)
+            else:
+                logger.debug("  Ejecutando retriever.invoke (k del retriever: %s) para query...", retriever_k_cfg_val)
+                # La llamada al retriever de Langchain es síncrona, por eso se usa to_thread
+                initial_docs_found = await asyncio.to_thread(
+                    retriever_instance.invoke, 
+                    user_query # El 'query' es el único argumento necesario aquí
+                )
+            num_initial_docs = len(initial_docs_found)
+            logger.info("  Retriever devolvió %s documentos iniciales.", num_initial_docs)
+
+            if not initial_docs_found:
+                logger.info("  La búsqueda inicial del retriever no devolvió ningún documento.")
+                return []
+
+            # Filtrar y seleccionar los documentos finales
+            if target_brand: # target_brand debe ser el nombre normalizado
+                logger.info("  Filtrando %s resultados por metadato 'brand' == '%s'...", num_initial_docs, target_brand)
                 # Asumimos que la metadata 'brand' contiene el nombre normalizado de la marca
-                doc_brand_meta = doc.metadata.get('brand') 
-                # logger.debug(f"    Doc {i} - Brand en metadata: '{doc_brand_meta}', Content preview: '{doc.page_content[:50]}...'")
-                if doc_brand_meta == target_brand:
-                    if doc.page_content not in seen_content_in_brand_filter: # Evitar duplicados de contenido exacto
-                        filtered_by_brand_docs.append(doc)
-                        seen_content_in_brand_filter.add(doc.page_content)
-                    # else: logger.debug(f"      Doc {i} OMITIDO (contenido duplicado) para marca '{target_brand}'.")
-                
-                if len(filtered_by_brand_docs) >= _k_final_to_use: # Si ya tenemos suficientes para esta marca
-                    logger.debug(f"    Alcanzado límite de k_final ({_k_final_to_use}) para marca '{target_brand}'.")
-                    break
-            relevant_docs_final = filtered_by_brand_docs
-            logger.info(f"  Filtrado por marca completado. {len(relevant_docs_final)} docs para '{target_brand}' (objetivo k={_k_final_to_use}).")
-            if not relevant_docs_final and num_initial_docs > 0:
-                logger.warning(f"  ADVERTENCIA RAG: No se encontraron docs para marca '{target_brand}' tras filtrar {num_initial_docs} iniciales. "
-                               "Verifica que la metadata 'brand' en tus documentos coincida y que el retriever inicial traiga suficientes resultados.")
+                relevant_docs_final = _select_unique_docs(initial_docs_found, _k_final_to_use, target_brand)
+                logger.info("  Filtrado por marca completado. %s docs para '%s' (objetivo k=%s).", len(relevant_docs_final), target_brand, _k_final_to_use)
+                if not relevant_docs_final and num_initial_docs > 0:
+                    logger.warning("  ADVERTENCIA RAG: No se encontraron docs para marca '%s' tras filtrar %s iniciales. "
+                                   "Verifica que la metadata 'brand' en tus documentos coincida y que el retriever inicial traiga suficientes resultados.",
+                                   target_brand, num_initial_docs)
         
-        else: # Sin filtro de marca, tomar los k_final mejores resultados únicos de los iniciales
-            logger.info(f"  Búsqueda RAG global (sin filtro de marca). Tomando hasta k={_k_final_to_use} resultados únicos de {num_initial_docs} iniciales.")
-            unique_global_docs = []
-            seen_content_globally = set()
-            for i, doc in enumerate(initial_docs_found):
-                if doc.page_content not in seen_content_globally:
-                    unique_global_docs.append(doc)
-                    seen_content_globally.add(doc.page_content)
-                if len(unique_global_docs) >= _k_final_to_use: break
-            relevant_docs_final = unique_global_docs
-            logger.info(f"  Selección global completada. {len(relevant_docs_final)} documentos únicos seleccionados.")
+            else: # Sin filtro de marca, tomar los k_final mejores resultados únicos de los iniciales
+                logger.info("  Búsqueda RAG global (sin filtro de marca). Tomando hasta k=%s resultados únicos de %s iniciales.", _k_final_to_use, num_initial_docs)
+                relevant_docs_final = _select_unique_docs(initial_docs_found, _k_final_to_use)
+                logger.info("  Selección global completada. %s documentos únicos seleccionados.", len(relevant_docs_final))
 
     except AttributeError as ae_search: 
-        logger.error(f"RAG_SEARCH: AttributeError durante búsqueda (¿retriever mal configurado o settings es None?): {ae_search}", exc_info=True)
+        logger.error("RAG_SEARCH: AttributeError durante búsqueda (¿retriever mal configurado o settings es None?): %s", ae_search, exc_info=True)
         relevant_docs_final = []
     except Exception as e_search_unexp:
-        logger.error(f"RAG_SEARCH: Error inesperado durante la búsqueda: {e_search_unexp}", exc_info=True)
+        logger.error("RAG_SEARCH: Error inesperado durante la búsqueda: %s", e_search_unexp, exc_info=True)
         relevant_docs_final = []
 
-    logger.info(f"RAG_SEARCH: Búsqueda finalizada. Devolviendo {len(relevant_docs_final)} documentos.")
+    logger.info("RAG_SEARCH: Búsqueda finalizada. Devolviendo %s documentos.", len(relevant_docs_final))
     # if relevant_docs_final: # Loguear los documentos finales si es necesario para depuración
     #     for i, doc_f in enumerate(relevant_docs_final):
-    #          logger.debug(f"    Doc Final {i}: Metadata={doc_f.metadata}, Preview='{doc_f.page_content[:100]}...'")
+    #          logger.debug("    Doc Final %s: Metadata=%s, Preview='%s...'", i, doc_f.metadata, doc_f.page_content[:100])
     return relevant_docs_final
 
 
@@ -425,6 +1258,7 @@ async def verify_faiss_index_access() -> Dict[str, Any]:
         if LANGCHAIN_OK:
             try:
                 # Cargar modelo de embeddings
+                from langchain_community.embeddings import HuggingFaceEmbeddings
                 embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL_NAME)
                 
                 # Cargar el índice localmente
@@ -1,25 +1,28 @@
 # app/api/calendly.py
 import httpx
-import json 
+import orjson
+import sys
+import time
+import asyncio
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional
 from app.core.config import settings 
 from app.utils.logger import logger
 from datetime import datetime, date, timedelta, timezone
 import app.utils.validation_utils as local_validators # Para is_valid_email
-import locale
-import urllib.parse
+from urllib.parse import quote_plus
 from fastapi import APIRouter
 
-# --- Configuración de Locale ---
-try:
-    locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
-    logger.info("Locale configurado a 'es_ES.UTF-8' para formateo de fechas.")
-except locale.Error:
-    try:
-        locale.setlocale(locale.LC_TIME, 'Spanish_Spain.1252')
-        logger.info("Locale configurado a 'Spanish_Spain.1252' para formateo de fechas.")
-    except locale.Error:
-        logger.warning("No se pudo configurar locale a Español. Fechas de Calendly podrían mostrarse en inglés.")
+# --- Nombres de días y meses en español ---
+# Tablas fijas en lugar de locale.setlocale + strftime("%A"/"%B"): setlocale cambiaba el locale de
+# todo el proceso (no es seguro entre hilos), fallaba en imágenes Docker slim sin 'es_ES.UTF-8'
+# (y las fechas salían en inglés) y strftime pasaba por la maquinaria de locale de libc en cada slot.
+SPANISH_DAYS = ("lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "domingo")
+SPANISH_MONTHS = ("enero", "febrero", "marzo", "abril", "mayo", "junio",
+                  "julio", "agosto", "septiembre", "octubre", "noviembre", "diciembre")
+
+# Desde Python 3.11 datetime.fromisoformat acepta el sufijo 'Z' que usa Calendly
+_FROMISO_ACCEPTS_Z = sys.version_info >= (3, 11)
 
 # --- Cliente HTTP para Calendly API ---
 _BASE_URL_CALENDLY_API = "https://api.calendly.com"
@@ -27,15 +30,36 @@ _HTTP_TIMEOUT_CALENDLY = 20.0
 if settings and hasattr(settings, 'http_client_timeout') and isinstance(settings.http_client_timeout, (int, float)):
     _HTTP_TIMEOUT_CALENDLY = settings.http_client_timeout
 
+# Headers de autenticación: no cambian durante la vida del proceso, se construyen una sola vez
+# y se fijan en los clientes (las solicitudes ya no pasan headers=).
+_CALENDLY_HEADERS: Optional[Dict[str, str]] = (
+    {'Authorization': f'Bearer {settings.CALENDLY_API_KEY}', 'Content-Type': 'application/json'}
+    if settings and settings.CALENDLY_API_KEY else None
+)
+
 # Cliente global para endpoints relativos de Calendly (como /event_type_available_times)
 async_client_calendly_relative: Optional[httpx.AsyncClient] = None
+# Cliente global sin base_url para URIs absolutas (como las de tipos de evento), para reutilizar conexiones
+async_client_calendly_absolute: Optional[httpx.AsyncClient] = None
 
 def initialize_calendly_clients():
-    global async_client_calendly_relative
+    global async_client_calendly_relative, async_client_calendly_absolute
+    if async_client_calendly_absolute is None:
+        try:
+            async_client_calendly_absolute = httpx.AsyncClient(
+                headers=_CALENDLY_HEADERS,
+                timeout=_HTTP_TIMEOUT_CALENDLY,
+                limits=httpx.Limits(max_keepalive_connections=16)
+            )
+            logger.info("Cliente HTTP para URIs absolutas de Calendly API inicializado.")
+        except Exception as e_client:
+            logger.error(f"Error al inicializar el cliente HTTP para URIs absolutas de Calendly: {e_client}", exc_info=True)
+            async_client_calendly_absolute = None
     if async_client_calendly_relative is None:
         try:
             async_client_calendly_relative = httpx.AsyncClient(
                 base_url=_BASE_URL_CALENDLY_API,
+                headers=_CALENDLY_HEADERS,
                 timeout=_HTTP_TIMEOUT_CALENDLY
             )
             logger.info(f"Cliente HTTP para paths relativos de Calendly API inicializado. Base URL: {_BASE_URL_CALENDLY_API}")
@@ -43,31 +67,88 @@ def initialize_calendly_clients():
             logger.error(f"Error al inicializar el cliente HTTP para paths relativos de Calendly: {e_client}", exc_info=True)
             async_client_calendly_relative = None
 
+async def close_calendly_clients() -> None:
+    """Cierra los clientes HTTP de Calendly (se llama al apagar la aplicación)."""
+    global async_client_calendly_relative, async_client_calendly_absolute
+    for client in (async_client_calendly_relative, async_client_calendly_absolute):
+        if client is not None:
+            await client.aclose()
+    async_client_calendly_relative = None
+    async_client_calendly_absolute = None
+    logger.info("Clientes HTTP de Calendly cerrados.")
+
 if settings:
     initialize_calendly_clients()
 else:
     logger.error("Settings no disponibles, no se pudo inicializar cliente HTTP de Calendly.")
 
-async def _get_calendly_headers() -> Optional[Dict[str, str]]:
-    if not settings or not settings.CALENDLY_API_KEY:
-        logger.error("CALENDLY_API_KEY no configurada en settings.")
+# Valores de configuración usados en cada solicitud, resueltos una sola vez
+_CALENDLY_TZ: str = (getattr(settings, "CALENDLY_TIMEZONE", None) if settings else None) or "America/Mexico_City"
+_CALENDLY_USER_SLUG: Optional[str] = (getattr(settings, "CALENDLY_USER_SLUG", None) if settings else None) or None
+_FALLBACK_LINK_PREFIX = f"https://calendly.com/{_CALENDLY_USER_SLUG or 'tu_usuario_calendly'}/"
+_NO_EVENT_URI_LINK = f"https://calendly.com/{_CALENDLY_USER_SLUG or 'tu-usuario'}/#error-no-event-uri"
+_CALENDLY_TZ_QUERY = f"timezone={quote_plus(_CALENDLY_TZ)}" # Parámetro fijo del enlace, codificado una vez
+
+# --- Caché de detalles de tipos de evento ---
+# Los datos de un tipo de evento (p. ej. scheduling_url) casi no cambian: se guardan en memoria
+# con TTL para no repetir la llamada HTTPS en cada solicitud de enlace.
+_EVENT_TYPE_CACHE_TTL_SECONDS = 3600.0
+_EVENT_TYPE_CACHE_MAX_SIZE = 256
+_event_type_cache: "OrderedDict[str, tuple]" = OrderedDict() # uri -> (expira_en, resource_data)
+_event_type_locks: Dict[str, asyncio.Lock] = {} # Un lock por URI: una ráfaga de fallos hace una sola llamada
+
+def _get_cached_event_type(event_type_absolute_uri: str) -> Optional[Dict[str, Any]]:
+    cached = _event_type_cache.get(event_type_absolute_uri)
+    if cached is None:
         return None
-    return {'Authorization': f'Bearer {settings.CALENDLY_API_KEY}', 'Content-Type': 'application/json'}
+    expires_at, resource_data = cached
+    if time.monotonic() >= expires_at:
+        del _event_type_cache[event_type_absolute_uri]
+        return None
+    _event_type_cache.move_to_end(event_type_absolute_uri)
+    return resource_data
+
+def _store_cached_event_type(event_type_absolute_uri: str, resource_data: Dict[str, Any]) -> None:
+    _event_type_cache[event_type_absolute_uri] = (time.monotonic() + _EVENT_TYPE_CACHE_TTL_SECONDS, resource_data)
+    _event_type_cache.move_to_end(event_type_absolute_uri)
+    while len(_event_type_cache) > _EVENT_TYPE_CACHE_MAX_SIZE:
+        _event_type_cache.popitem(last=False)
 
 async def get_event_type_details(event_type_absolute_uri: str) -> Optional[Dict[str, Any]]:
-    """Obtiene detalles de un tipo de evento usando su URI absoluta."""
-    headers = await _get_calendly_headers()
-    if not headers: return None
+    """
+    Obtiene detalles de un tipo de evento usando su URI absoluta.
+    Las respuestas válidas se cachean _EVENT_TYPE_CACHE_TTL_SECONDS; los errores no se cachean.
+    """
     if not event_type_absolute_uri:
         logger.warning("get_event_type_details: event_type_absolute_uri no proporcionada.")
         return None
+    resource_data = _get_cached_event_type(event_type_absolute_uri)
+    if resource_data is not None:
+        return resource_data
+    lock = _event_type_locks.setdefault(event_type_absolute_uri, asyncio.Lock())
+    async with lock:
+        # Otra corrutina pudo haberlo obtenido mientras se esperaba el lock
+        resource_data = _get_cached_event_type(event_type_absolute_uri)
+        if resource_data is None:
+            resource_data = await _fetch_event_type_details(event_type_absolute_uri)
+            if resource_data is not None:
+                _store_cached_event_type(event_type_absolute_uri, resource_data)
+    return resource_data
+
+async def _fetch_event_type_details(event_type_absolute_uri: str) -> Optional[Dict[str, Any]]:
+    """Consulta a la API de Calendly los detalles de un tipo de evento (sin caché)."""
+    if async_client_calendly_absolute is None:
+        logger.error("Cliente HTTP absoluto de Calendly no inicializado. No se pueden obtener detalles del evento.")
+        return None
+    if _CALENDLY_HEADERS is None:
+        logger.error("CALENDLY_API_KEY no configurada en settings.")
+        return None
         
-    logger.debug(f"Obteniendo detalles del tipo de evento desde URL absoluta: {event_type_absolute_uri}")
+    logger.debug("Obteniendo detalles del tipo de evento desde URL absoluta: %s", event_type_absolute_uri)
     try:
-        async with httpx.AsyncClient(timeout=_HTTP_TIMEOUT_CALENDLY) as temp_client:
-            response = await temp_client.get(event_type_absolute_uri, headers=headers)
+        response = await async_client_calendly_absolute.get(event_type_absolute_uri)
         response.raise_for_status()
-        data = response.json()
+        data = orjson.loads(response.content)
         resource_data = data.get("resource")
         if resource_data:
             logger.info(f"Detalles del tipo de evento obtenidos para {event_type_absolute_uri.split('/')[-1]}")
@@ -82,6 +163,30 @@ async def get_event_type_details(event_type_absolute_uri: str) -> Optional[Dict[
         logger.error(f"Error inesperado obteniendo detalles de evento {event_type_absolute_uri}: {e}", exc_info=True)
         return None
 
+# Calendly limita cada consulta de horarios disponibles a un rango de 7 días: los rangos más largos
+# se dividen en ventanas que se consultan en paralelo, con un tope de solicitudes simultáneas
+# compartido por todo el proceso (límite de tasa de la API).
+_CALENDLY_MAX_WINDOW_DAYS = 7
+_CALENDLY_MAX_CONCURRENT_REQUESTS = 4
+_calendly_request_semaphore = asyncio.Semaphore(_CALENDLY_MAX_CONCURRENT_REQUESTS)
+
+def _split_date_range(start_date: date, end_date: date) -> List[tuple]:
+    """Divide [start_date, end_date] en ventanas de días consecutivas de hasta _CALENDLY_MAX_WINDOW_DAYS."""
+    # Se cuentan días de calendario (ambos extremos incluidos): cada ventana va de 00:00:00 a 23:59:59
+    if (end_date - start_date).days + 1 <= _CALENDLY_MAX_WINDOW_DAYS:
+        return [(start_date, end_date)]
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + timedelta(days=_CALENDLY_MAX_WINDOW_DAYS - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(days=1)
+    return windows
+
+async def _fetch_available_times(api_url_path: str, params: Dict[str, str]) -> httpx.Response:
+    async with _calendly_request_semaphore:
+        return await async_client_calendly_relative.get(api_url_path, params=params)
+
 async def get_available_slots(
     event_type_uri: str, 
     start_date_obj: Optional[date] = None, 
@@ -90,8 +195,9 @@ async def get_available_slots(
     if async_client_calendly_relative is None:
         logger.error("Cliente HTTP relativo de Calendly no inicializado. No se pueden obtener slots.")
         return None
-    headers = await _get_calendly_headers()
-    if not headers: return None 
+    if _CALENDLY_HEADERS is None:
+        logger.error("CALENDLY_API_KEY no configurada en settings.")
+        return None
     if not event_type_uri or not event_type_uri.startswith("https://api.calendly.com/event_types/"):
         logger.error(f"URI de tipo de evento inválida o no proporcionada: '{event_type_uri}'")
         return None
@@ -100,38 +206,41 @@ async def get_available_slots(
     days_to_check = settings.CALENDLY_DAYS_TO_CHECK if settings and hasattr(settings, 'calendly_days_to_check') and isinstance(settings.CALENDLY_DAYS_TO_CHECK, int) else 7
     effective_end_date = end_date_obj if end_date_obj is not None else effective_start_date + timedelta(days=days_to_check)
 
-    start_time_param = datetime.combine(effective_start_date, datetime.min.time()).isoformat(timespec='seconds')
-    end_time_param = datetime.combine(effective_end_date, datetime.max.time()).isoformat(timespec='seconds')
-    
-    invitee_target_timezone = getattr(settings, "CALENDLY_TIMEZONE", "America/Mexico_City") or "America/Mexico_City"
+    invitee_target_timezone = _CALENDLY_TZ
 
     api_url_path = "/event_type_available_times" 
-    params = {
-        "event_type": event_type_uri, 
-        "start_time": start_time_param,
-        "end_time": end_time_param,
-        "invitee_timezone": invitee_target_timezone
-    }
-    logger.info(f"Buscando slots Calendly. Path: {api_url_path}, Params: {params}")
+    params_per_window = [
+        {
+            "event_type": event_type_uri, 
+            # Mismo formato que datetime.combine(...).isoformat(timespec='seconds'), sin crear datetimes
+            "start_time": f"{window_start.isoformat()}T00:00:00",
+            "end_time": f"{window_end.isoformat()}T23:59:59",
+            "invitee_timezone": invitee_target_timezone
+        }
+        for window_start, window_end in _split_date_range(effective_start_date, effective_end_date)
+    ]
+    logger.info("Buscando slots Calendly. Path: %s, Ventanas: %s, Params: %s", api_url_path, len(params_per_window), params_per_window)
     
     try:
-        response = await async_client_calendly_relative.get(api_url_path, headers=headers, params=params)
-        if response.status_code == 404:
-            logger.error(f"Recurso no encontrado (404) para {event_type_uri} al buscar slots. URL: {response.url}. Respuesta: {response.text[:200]}")
-            return None 
-        response.raise_for_status() 
-        data = response.json()
-        available_times_collection = data.get("collection", [])
+        responses = await asyncio.gather(*(_fetch_available_times(api_url_path, params) for params in params_per_window))
+        available_times_collection = []
+        for response in responses:
+            if response.status_code == 404:
+                logger.error(f"Recurso no encontrado (404) para {event_type_uri} al buscar slots. URL: {response.url}. Respuesta: {response.text[:200]}")
+                return None 
+            response.raise_for_status() 
+            available_times_collection.extend(orjson.loads(response.content).get("collection", []))
         if not available_times_collection: logger.info(f"No slots para {event_type_uri}."); return [] 
         slots = []
         for time_info in available_times_collection:
             if time_info.get("status") == "available" and time_info.get("start_time"):
                 try:
-                    start_time_dt_aware = datetime.fromisoformat(time_info['start_time'].replace('Z', '+00:00'))
-                    formatted_time = start_time_dt_aware.strftime(f"%A, %d de %B, %H:%M ({invitee_target_timezone})")
-                    slots.append({"start_time_api": time_info['start_time'], "display_time": formatted_time})
-                except ValueError: # Fallback para formato de fecha por si strftime falla con locale
-                    formatted_time = start_time_dt_aware.strftime(f"%Y-%m-%d %H:%M ({invitee_target_timezone})")
+                    start_time_str = time_info['start_time']
+                    if not _FROMISO_ACCEPTS_Z and start_time_str.endswith('Z'):
+                        start_time_str = start_time_str[:-1] + '+00:00'
+                    dt = datetime.fromisoformat(start_time_str)
+                    formatted_time = (f"{SPANISH_DAYS[dt.weekday()]}, {dt.day:02d} de {SPANISH_MONTHS[dt.month - 1]}, "
+                                      f"{dt.hour:02d}:{dt.minute:02d} ({invitee_target_timezone})")
                     slots.append({"start_time_api": time_info['start_time'], "display_time": formatted_time})
                 except Exception as parse_err: 
                     logger.warning(f"Error parseando slot: {time_info}. Error: {parse_err}", exc_info=False)
@@ -156,7 +265,7 @@ async def get_scheduling_link(
     
     if not event_type_uri_from_settings:
         logger.error("get_scheduling_link: event_type_uri_from_settings no fue proporcionada.")
-        return f"https://calendly.com/{settings.CALENDLY_USER_SLUG if settings and settings.CALENDLY_USER_SLUG else 'tu-usuario'}/#error-no-event-uri"
+        return _NO_EVENT_URI_LINK
 
     event_details = await get_event_type_details(event_type_uri_from_settings)
     
@@ -165,36 +274,24 @@ async def get_scheduling_link(
         base_link = event_details["scheduling_url"]
     else:
         logger.error(f"No se pudo obtener scheduling_url base para: {event_type_uri_from_settings}")
-        user_slug = "tu_usuario_calendly" 
-        if settings and hasattr(settings, 'CALENDLY_USER_SLUG') and settings.CALENDLY_USER_SLUG:
-            user_slug = settings.CALENDLY_USER_SLUG
         try: event_slug_from_uri = event_type_uri_from_settings.split('/')[-1]; event_slug_from_uri = event_slug_from_uri.split('?')[0]
         except: event_slug_from_uri = "evento-generico"
-        logger.warning(f"Usando enlace de fallback. User: {user_slug}, Event Slug (inferido): {event_slug_from_uri}")
-        base_link = f"https://calendly.com/{user_slug}/{event_slug_from_uri}"
+        logger.warning(f"Usando enlace de fallback. Prefijo: {_FALLBACK_LINK_PREFIX}, Event Slug (inferido): {event_slug_from_uri}")
+        base_link = f"{_FALLBACK_LINK_PREFIX}{event_slug_from_uri}"
 
-    logger.debug(f"Enlace base de scheduling: {base_link}")
+    logger.debug("Enlace base de scheduling: %s", base_link)
     
-    params_for_link = {}
-    if name and name.strip(): params_for_link["name"] = name.strip()
-    if email and local_validators.is_valid_email(email): params_for_link["email"] = email.strip()
+    # Mismo resultado que urllib.parse.urlencode (que usa quote_plus) para este conjunto fijo de claves
+    query_parts = []
+    if name and name.strip(): query_parts.append(f"name={quote_plus(name.strip())}")
+    if email and local_validators.is_valid_email(email): query_parts.append(f"email={quote_plus(email.strip())}")
     
-    if settings and getattr(settings, "CALENDLY_TIMEZONE", None):
-        params_for_link["timezone"] = settings.CALENDLY_TIMEZONE
-        logger.debug(f"Añadiendo timezone='{settings.CALENDLY_TIMEZONE}' al enlace de Calendly.")
+    query_parts.append(_CALENDLY_TZ_QUERY)
+    logger.debug("Añadiendo timezone='%s' al enlace de Calendly.", _CALENDLY_TZ)
 
-    if params_for_link:
-        try:
-            query_string = urllib.parse.urlencode(params_for_link)
-            final_link = f"{base_link}?{query_string}"
-            logger.info(f"Enlace de scheduling con parámetros: {final_link}")
-            return final_link
-        except Exception as e_urlencode:
-            logger.error(f"Error codificando params para enlace Calendly: {e_urlencode}")
-            return base_link 
-    
-    logger.info(f"Enlace de scheduling sin parámetros adicionales: {base_link}")
-    return base_link
+    final_link = f"{base_link}?{'&'.join(query_parts)}"
+    logger.info("Enlace de scheduling con parámetros: %s", final_link)
+    return final_link
 
 # Configurar el router para los endpoints de Calendly
 router = APIRouter()
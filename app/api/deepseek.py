@@ -1,10 +1,20 @@
 # app/api/deepseek.py
 # Configurado para usar la API de DeepSeek directamente.
 
+import asyncio
+import logging
 import httpx
 from app.core.config import settings # Importar la instancia de settings
 from app.utils.logger import logger # Asumiendo que tienes un logger centralizado
-from typing import Optional, List, Dict, Any
+import orjson
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator
+
+# HTTP/2 en httpx requiere el paquete opcional 'h2' (pip install httpx[http2])
+try:
+    import h2 # noqa: F401
+    HTTP2_OK = True
+except ImportError:
+    HTTP2_OK = False
 
 # --- Configuración del Cliente HTTP para DeepSeek ---
 
@@ -32,37 +42,69 @@ _TIMEOUT_LLM = 30.0 # Fallback
 if settings and hasattr(settings, 'http_client_timeout'):
     _TIMEOUT_LLM = settings.http_client_timeout
 
-# Crear el cliente httpx para DeepSeek
+# Límites del pool de conexiones: las conexiones keep-alive se reutilizan entre solicitudes
+# (sin repetir el handshake TCP + TLS en cada llamada al LLM)
+_MAX_KEEPALIVE_CONNECTIONS_DEEPSEEK = 32
+_MAX_CONNECTIONS_DEEPSEEK = 64
+
+# Límite de llamadas simultáneas a DeepSeek: bajo picos de carga la cola queda en este proceso
+# en lugar de acumular 429 en el proveedor. Los 429/503 se reintentan respetando Retry-After.
+_DEEPSEEK_SEM = asyncio.Semaphore(int(getattr(settings, 'DEEPSEEK_MAX_CONCURRENCY', 16)) if settings else 16)
+_DEEPSEEK_MAX_RETRIES = 3
+_DEEPSEEK_RETRY_STATUS_CODES = (429, 503)
+_DEEPSEEK_MAX_RETRY_DELAY_SECONDS = 30.0
+
+# Crear el cliente httpx para DeepSeek (uno por proceso, compartido por todas las solicitudes)
 try:
     client = httpx.AsyncClient(
         base_url=_ACTUAL_ENDPOINT_DEEPSEEK, # Usar el endpoint completo calculado
-        timeout=_TIMEOUT_LLM
+        timeout=_TIMEOUT_LLM,
+        limits=httpx.Limits(
+            max_keepalive_connections=_MAX_KEEPALIVE_CONNECTIONS_DEEPSEEK,
+            max_connections=_MAX_CONNECTIONS_DEEPSEEK
+        ),
+        http2=HTTP2_OK
     )
-    logger.info(f"Cliente HTTP para DeepSeek inicializado. Base URL (Endpoint): {_ACTUAL_ENDPOINT_DEEPSEEK}, Timeout: {_TIMEOUT_LLM}s")
+    logger.info("Cliente HTTP para DeepSeek inicializado. Base URL (Endpoint): %s, Timeout: %ss, HTTP/2: %s",
+                _ACTUAL_ENDPOINT_DEEPSEEK, _TIMEOUT_LLM, HTTP2_OK)
 except Exception as e_client:
     logger.error(f"Error al inicializar el cliente HTTP para DeepSeek: {e_client}", exc_info=True)
     client = None
 
 
-async def get_deepseek_response(prompt_from_builder: str) -> Optional[str]:
+async def close_deepseek_client() -> None:
+    """Cierra el cliente HTTP compartido (se llama al apagar la aplicación)."""
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+        logger.info("Cliente HTTP para DeepSeek cerrado.")
+
+
+class DeepSeekRequestError(Exception):
+    """Error de configuración o de prompt detectado antes de llamar a DeepSeek (el mensaje es el texto a devolver)."""
+
+
+def _build_deepseek_request(prompt_from_builder: str) -> Tuple[Dict[str, str], Dict[str, Any]]:
     """
-    Obtiene una respuesta de un modelo de lenguaje a través de la API de DeepSeek.
+    Valida la configuración y construye (headers, payload) de la solicitud de chat con streaming.
+    Lanza DeepSeekRequestError si no se puede hacer la solicitud.
     """
     if client is None:
         logger.error("El cliente HTTP para DeepSeek no está inicializado.")
-        return "Error interno: Cliente LLM no disponible."
+        raise DeepSeekRequestError("Error interno: Cliente LLM no disponible.")
 
     if not settings:
         logger.error("Settings no disponibles. No se puede acceder a la configuración de DeepSeek.")
-        return "Error interno: Configuración no disponible."
+        raise DeepSeekRequestError("Error interno: Configuración no disponible.")
 
     # Validar que las configuraciones necesarias de DeepSeek estén presentes
     if not settings.deepseek_api_key:
         logger.error("DEEPSEEK_API_KEY no está configurada en settings.")
-        return "Error interno: Clave API para DeepSeek no configurada."
+        raise DeepSeekRequestError("Error interno: Clave API para DeepSeek no configurada.")
     if not settings.deepseek_model_chat:
         logger.error("DEEPSEEK_MODEL_CHAT no está configurado en settings.")
-        return "Error interno: Modelo de DeepSeek no configurado."
+        raise DeepSeekRequestError("Error interno: Modelo de DeepSeek no configurado.")
 
     api_key = settings.deepseek_api_key
     model_identifier = settings.deepseek_model_chat # Debería ser "deepseek-chat" según tu .env
@@ -75,16 +117,15 @@ async def get_deepseek_response(prompt_from_builder: str) -> Optional[str]:
     system_content: str = ""
     user_content: str = prompt_from_builder 
     try:
-        if "**Pregunta Usuario:**" in prompt_from_builder:
-            parts = prompt_from_builder.split("**Pregunta Usuario:**", 1)
-            system_content = parts[0].strip() 
-            user_content = parts[1].strip()
-            if "**Respuesta:**" in user_content:
-                user_content = user_content.split("**Respuesta:**", 1)[0].strip()
+        # partition devuelve una tupla sin crear listas (ni recorrer el prompt dos veces)
+        head, sep, tail = prompt_from_builder.partition("**Pregunta Usuario:**")
+        if sep:
+            system_content = head.strip()
+            user_content = tail.partition("**Respuesta:**")[0].strip()
         else:
             logger.debug("Delimitador '**Pregunta Usuario:**' no encontrado. Todo el prompt como 'user_content'.")
     except Exception as e_parse:
-        logger.warning(f"Error parseando prompt para system/user: {e_parse}. Usando prompt completo como user_content.")
+        logger.warning("Error parseando prompt para system/user: %s. Usando prompt completo como user_content.", e_parse)
         system_content = "" 
         user_content = prompt_from_builder
 
@@ -93,8 +134,8 @@ async def get_deepseek_response(prompt_from_builder: str) -> Optional[str]:
         messages.append({"role": "system", "content": system_content})
     
     if not user_content or not user_content.strip():
-        logger.error(f"User content vacío. Prompt original: '{prompt_from_builder[:100]}...'")
-        return "Error interno: Pregunta del usuario vacía."
+        logger.error("User content vacío. Prompt original: '%s...'", prompt_from_builder[:100])
+        raise DeepSeekRequestError("Error interno: Pregunta del usuario vacía.")
         
     messages.append({"role": "user", "content": user_content})
 
@@ -103,42 +144,91 @@ async def get_deepseek_response(prompt_from_builder: str) -> Optional[str]:
         "messages": messages,
         "max_tokens": settings.deepseek_max_tokens,
         "temperature": settings.deepseek_temperature,
-        "stream": False
+        "stream": True # Server-Sent Events: los tokens llegan a medida que se generan
     }
 
-    logger.info(f"Enviando solicitud a DeepSeek. Modelo: {model_identifier}, Endpoint efectivo: {_ACTUAL_ENDPOINT_DEEPSEEK}")
-    logger.debug(f"Path para POST: '{_POST_PATH_DEEPSEEK}'")
-    logger.debug(f"Payload messages para DeepSeek: {messages}")
-    logger.debug(f"Payload completo (sin API key): {payload}")
+    logger.info("Enviando solicitud a DeepSeek. Modelo: %s, Endpoint efectivo: %s", model_identifier, _ACTUAL_ENDPOINT_DEEPSEEK)
+    # El payload incluye todo el contexto RAG: solo se formatea si el nivel DEBUG está activo
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Path para POST: '%s'", _POST_PATH_DEEPSEEK)
+        logger.debug("Payload messages para DeepSeek: %s", messages)
+        logger.debug("Payload completo (sin API key): %s", payload)
+    return headers, payload
+
 
+async def stream_deepseek_response(prompt_from_builder: str) -> AsyncIterator[str]:
+    """
+    Obtiene la respuesta de DeepSeek en streaming y va entregando los fragmentos de texto
+    a medida que llegan (el primer token llega tras ~1 RTT en lugar de esperar la respuesta completa).
+    Lanza DeepSeekRequestError si la solicitud no se puede construir y las excepciones de httpx
+    (HTTPStatusError con el cuerpo ya leído, RequestError) si falla la llamada.
+    """
+    headers, payload = _build_deepseek_request(prompt_from_builder)
+    body = orjson.dumps(payload)
+    for attempt in range(_DEEPSEEK_MAX_RETRIES + 1):
+        retry_delay: Optional[float] = None
+        async with _DEEPSEEK_SEM:
+            # Si _ACTUAL_ENDPOINT_DEEPSEEK ya es la URL completa, _POST_PATH_DEEPSEEK será ""
+            async with client.stream("POST", _POST_PATH_DEEPSEEK, headers=headers, content=body) as response:
+                if response.status_code in _DEEPSEEK_RETRY_STATUS_CODES and attempt < _DEEPSEEK_MAX_RETRIES:
+                    retry_delay = _retry_delay_seconds(response, attempt)
+                else:
+                    if response.status_code >= 400:
+                        await response.aread() # Para que el cuerpo del error esté disponible fuera del contexto
+                        response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue # Líneas vacías o comentarios SSE (keep-alive)
+                        data = line[6:]
+                        if data == "[DONE]":
+                            break
+                        chunk = orjson.loads(data)
+                        if chunk.get("error"): # Error del proveedor después de haber respondido 200
+                            logger.error("Error de DeepSeek durante el streaming: %s", chunk["error"])
+                            raise DeepSeekRequestError("Error de comunicación con DeepSeek durante la respuesta.")
+                        choices = chunk.get("choices")
+                        if choices:
+                            content = (choices[0].get("delta") or {}).get("content")
+                            if content:
+                                yield content
+                    return
+        # La espera se hace fuera del semáforo para no bloquear a las demás solicitudes
+        logger.warning("DeepSeek respondió %s. Reintento %s/%s en %.1fs.",
+                       response.status_code, attempt + 1, _DEEPSEEK_MAX_RETRIES, retry_delay)
+        await asyncio.sleep(retry_delay)
+
+
+def _retry_delay_seconds(response: httpx.Response, attempt: int) -> float:
+    """Espera antes de reintentar: el Retry-After del proveedor (en segundos) o backoff exponencial."""
+    retry_after = response.headers.get("Retry-After")
     try:
-        # Si _ACTUAL_ENDPOINT_DEEPSEEK ya es la URL completa, _POST_PATH_DEEPSEEK será ""
-        response = await client.post(url=_POST_PATH_DEEPSEEK, headers=headers, json=payload)
-        
-        response.raise_for_status() 
-        
-        data = response.json()
-        logger.debug(f"Respuesta completa de DeepSeek (JSON): {data}")
-
-        if data.get("choices") and isinstance(data["choices"], list) and len(data["choices"]) > 0:
-            choice = data["choices"][0]
-            if isinstance(choice, dict) and choice.get("message") and isinstance(choice["message"], dict) and \
-               "content" in choice["message"] and isinstance(choice["message"]["content"], str):
-                
-                ai_message = choice["message"]["content"].strip()
-                logger.info(f"Respuesta de DeepSeek recibida (primeros 100 chars): '{ai_message[:100]}...'")
-                return ai_message
-            else:
-                logger.warning(f"Estructura inesperada en 'message' o 'content' en DeepSeek: {choice}")
-        else:
-            logger.warning(f"Respuesta de DeepSeek no contiene 'choices' válidas: {data}")
-        return "Modelo no generó respuesta válida."
+        delay = float(retry_after) if retry_after is not None else 2.0 ** attempt
+    except ValueError: # Retry-After también puede venir como fecha HTTP
+        delay = 2.0 ** attempt
+    return min(max(delay, 0.0), _DEEPSEEK_MAX_RETRY_DELAY_SECONDS)
+
 
+async def get_deepseek_response(prompt_from_builder: str) -> Optional[str]:
+    """
+    Obtiene una respuesta de un modelo de lenguaje a través de la API de DeepSeek.
+    Consume stream_deepseek_response y devuelve el texto completo (o un mensaje de error).
+    """
+    try:
+        fragments = [fragment async for fragment in stream_deepseek_response(prompt_from_builder)]
+        ai_message = "".join(fragments).strip()
+        if not ai_message:
+            logger.warning("Respuesta de DeepSeek sin contenido en los fragmentos recibidos.")
+            return "Modelo no generó respuesta válida."
+        logger.info("Respuesta de DeepSeek recibida (primeros 100 chars): '%s...'", ai_message[:100])
+        return ai_message
+
+    except DeepSeekRequestError as e_request:
+        return str(e_request)
     except httpx.HTTPStatusError as e_status:
         error_body = "No se pudo leer cuerpo del error."
         try:
-            error_body_bytes = await e_status.response.aread()
-            error_body = error_body_bytes.decode(errors='replace')
+            # El cuerpo ya se leyó antes de raise_for_status: .text usa el contenido cacheado
+            error_body = e_status.response.text
         except Exception as read_err:
             logger.error(f"Error adicional leyendo cuerpo de error HTTP de DeepSeek: {read_err}")
         logger.error(f"Error HTTP de DeepSeek: {e_status.response.status_code} - URL: {e_status.request.url} - Cuerpo: {error_body}", exc_info=False)
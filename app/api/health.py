@@ -6,11 +6,13 @@ import os
 import time
 import asyncio
 import logging
-from typing import Dict, Any, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+import orjson
+from typing import Dict, Any, Optional, Tuple
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from pydantic import BaseModel
 from datetime import datetime, timezone
-from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.core.config import settings
@@ -35,114 +37,158 @@ class HealthResponse(BaseModel):
 # Variables globales para tracking
 start_time = time.time()
 
-@health_router.get("/health", response_model=HealthResponse)
-async def health_check(db: AsyncSession = Depends(get_db)) -> HealthResponse:
+# Para confirmar que el índice está en el contenedor basta con ver algunos blobs: no se lista todo
+_MAX_BLOBS_TO_COUNT = 5
+
+# Consulta de verificación de la BD, construida una sola vez; con tiempo máximo para que una
+# base de datos colgada no congele el sondeo
+_PING_STMT = text("SELECT 1")
+_DB_PING_TIMEOUT_SECONDS = 2.0
+
+# Los sondeos externos (liveness, balanceadores, monitores) llaman /health con mucha frecuencia:
+# el resultado se reutiliza durante unos segundos en lugar de repetir las consultas a BD y Azure.
+# /health/deep siempre ejecuta la verificación completa.
+_HEALTH_CACHE_TTL_SECONDS = 10.0
+# Se guarda el JSON ya serializado: los aciertos de caché no pasan por Pydantic ni por el serializador de FastAPI
+_health_cache: Dict[str, Any] = {"expires": 0.0, "body": None}
+
+@health_router.get("/health", responses={200: {"model": HealthResponse}})
+async def health_check(db: AsyncSession = Depends(get_db)) -> Response:
     """
     Endpoint de verificación de salud de la aplicación.
-    Verifica el estado general y todos los componentes críticos.
+    Devuelve el último resultado si tiene menos de _HEALTH_CACHE_TTL_SECONDS.
     """
-    logger.info("Verificando estado de salud de la aplicación")
-    
-    # Resultados iniciales
-    components = {
-        "database": {"status": "unknown", "details": {}},
-        "azure_storage": {"status": "unknown", "details": {}},
-        "faiss_index": {"status": "unknown", "details": {}},
-        "huggingface": {"status": "unknown", "details": {}}
-    }
-    
-    # Estado general inicial
-    overall_status = "ok"
-    
-    # Verificar base de datos
+    now = time.monotonic()
+    if _health_cache["body"] is not None and now < _health_cache["expires"]:
+        return Response(content=_health_cache["body"], media_type="application/json")
+    return Response(content=await _run_health_checks(db), media_type="application/json")
+
+@health_router.get("/health/deep", responses={200: {"model": HealthResponse}})
+async def health_check_deep(db: AsyncSession = Depends(get_db)) -> Response:
+    """Verificación completa bajo demanda (sin caché); también actualiza la caché de /health."""
+    return Response(content=await _run_health_checks(db), media_type="application/json")
+
+# Cada verificación devuelve (componente, estado general que impone o None). Son independientes
+# entre sí, así que se ejecutan en paralelo y la latencia total es la de la más lenta.
+ComponentCheck = Tuple[Dict[str, Any], Optional[str]]
+
+async def _check_db(db: AsyncSession) -> ComponentCheck:
     try:
         # Ejecutar una consulta simple para verificar la conexión
-        result = await db.execute("SELECT 1 AS is_alive")
-        row = result.fetchone()
-        is_alive = row[0] if row else None
+        result = await asyncio.wait_for(db.execute(_PING_STMT), timeout=_DB_PING_TIMEOUT_SECONDS)
+        is_alive = result.scalar()
         
-        components["database"] = {
+        return {
             "status": "ok" if is_alive == 1 else "error",
             "details": {
                 "connection": "established",
                 "host": settings.PGHOST or "unknown",
                 "database": settings.PGDATABASE or "unknown"
             }
-        }
+        }, None
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout ({_DB_PING_TIMEOUT_SECONDS}s) verificando la conexión a la base de datos.")
+        return {
+            "status": "error",
+            "details": {"error": f"Timeout de {_DB_PING_TIMEOUT_SECONDS}s en la consulta de verificación"}
+        }, "error"
     except Exception as e:
         logger.error(f"Error verificando la conexión a la base de datos: {e}")
-        components["database"] = {
+        return {
             "status": "error",
             "details": {"error": str(e)}
-        }
-        overall_status = "error"
-    
-    # Verificar Azure Storage
+        }, "error"
+
+async def _check_azure() -> ComponentCheck:
     try:
-        if settings.AZURE_STORAGE_CONNECTION_STRING:
-            blob_service_client = BlobServiceClient.from_connection_string(settings.AZURE_STORAGE_CONNECTION_STRING)
+        if not settings.AZURE_STORAGE_CONNECTION_STRING:
+            return {
+                "status": "error",
+                "details": {"error": "AZURE_STORAGE_CONNECTION_STRING no está configurado"}
+            }, "error"
+        # Cliente asíncrono: la verificación no bloquea el event loop mientras espera a Azure
+        async with BlobServiceClient.from_connection_string(settings.AZURE_STORAGE_CONNECTION_STRING) as blob_service_client:
             container_client = blob_service_client.get_container_client(settings.CONTAINER_NAME)
             
             # Verificar existencia del contenedor
-            container_exists = container_client.exists()
+            container_exists = await container_client.exists()
             
-            # Verificar si los archivos del índice FAISS existen
-            blob_list = list(container_client.list_blobs(name_starts_with=settings.FAISS_FOLDER_NAME))
-            
-            components["azure_storage"] = {
-                "status": "ok" if container_exists else "error",
-                "details": {
-                    "container_exists": container_exists,
-                    "storage_account": settings.STORAGE_ACCOUNT_NAME or "unknown",
-                    "container_name": settings.CONTAINER_NAME or "unknown",
-                    "blobs_found": len(blob_list)
-                }
-            }
-        else:
-            components["azure_storage"] = {
-                "status": "error",
-                "details": {"error": "AZURE_STORAGE_CONNECTION_STRING no está configurado"}
+            # Verificar si los archivos del índice FAISS existen (hasta _MAX_BLOBS_TO_COUNT + 1)
+            blobs_found = 0
+            if container_exists:
+                async for _blob in container_client.list_blobs(name_starts_with=settings.FAISS_FOLDER_NAME):
+                    blobs_found += 1
+                    if blobs_found > _MAX_BLOBS_TO_COUNT:
+                        break
+        
+        return {
+            "status": "ok" if container_exists else "error",
+            "details": {
+                "container_exists": container_exists,
+                "storage_account": settings.STORAGE_ACCOUNT_NAME or "unknown",
+                "container_name": settings.CONTAINER_NAME or "unknown",
+                "blobs_found": blobs_found
             }
-            overall_status = "error"
+        }, None
     except Exception as e:
         logger.error(f"Error verificando Azure Storage: {e}")
-        components["azure_storage"] = {
+        return {
             "status": "error", 
             "details": {"error": str(e)}
-        }
-        overall_status = "error"
-    
-    # Verificar índice FAISS
+        }, "error"
+
+async def _check_faiss() -> ComponentCheck:
     try:
         faiss_status = await verify_faiss_index_access()
-        components["faiss_index"] = {
+        return {
             "status": "ok" if faiss_status["success"] else "error",
             "details": faiss_status
-        }
-        if not faiss_status["success"]:
-            overall_status = "degraded"
+        }, None if faiss_status["success"] else "degraded"
     except Exception as e:
         logger.error(f"Error verificando índice FAISS: {e}")
-        components["faiss_index"] = {
+        return {
             "status": "error",
             "details": {"error": str(e)}
-        }
-        overall_status = "degraded"
-    
+        }, "degraded"
+
+async def _check_hf() -> ComponentCheck:
     # Verificar HuggingFace (simple check)
     try:
-        components["huggingface"] = {
+        return {
             "status": "ok" if settings.HUGGINGFACE_TOKEN else "warning",
             "details": {
                 "token_configured": bool(settings.HUGGINGFACE_TOKEN),
                 "embedding_model": settings.EMBEDDING_MODEL_NAME
             }
-        }
+        }, None
     except Exception as e:
-        components["huggingface"] = {
+        return {
             "status": "error",
             "details": {"error": str(e)}
-        }
+        }, None
+
+async def _run_health_checks(db: AsyncSession) -> bytes:
+    """
+    Verifica el estado general y todos los componentes críticos (en paralelo).
+    Devuelve el HealthResponse serializado a JSON.
+    """
+    logger.info("Verificando estado de salud de la aplicación")
+    
+    component_names = ("database", "azure_storage", "faiss_index", "huggingface")
+    results = await asyncio.gather(_check_db(db), _check_azure(), _check_faiss(), _check_hf(), return_exceptions=True)
+    
+    # Estado general: se aplica en el mismo orden que antes (BD, Azure, FAISS)
+    overall_status = "ok"
+    components: Dict[str, Dict[str, Any]] = {}
+    for name, result in zip(component_names, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Error inesperado verificando '{name}': {result}")
+            components[name] = {"status": "error", "details": {"error": str(result)}}
+            overall_status = "error"
+            continue
+        components[name], status_override = result
+        if status_override:
+            overall_status = status_override
     
     # Crear respuesta
     response = HealthResponse(
@@ -157,7 +203,10 @@ async def health_check(db: AsyncSession = Depends(get_db)) -> HealthResponse:
     # Log para diagnóstico
     logger.info(f"Health check completado. Estado: {overall_status}")
     
-    return response
+    body = orjson.dumps(response.model_dump())
+    _health_cache["body"] = body
+    _health_cache["expires"] = time.monotonic() + _HEALTH_CACHE_TTL_SECONDS
+    return body
 
 # Endpoint más simple para heartbeats
 @health_router.get("/ping")
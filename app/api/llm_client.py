@@ -1,15 +1,25 @@
 import httpx
-import json
-from typing import Optional, List, Dict, Any
+import asyncio
+import hashlib
+import logging
+import orjson
+from collections import OrderedDict
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple, Union
 from urllib.parse import urlparse # Para validación de URL
 
+# HTTP/2 en httpx requiere el paquete 'h2' (incluido en requirements.txt)
+try:
+    import h2 # noqa: F401
+    HTTP2_OK = True
+except ImportError:
+    HTTP2_OK = False
+
 # Intenta importar settings y logger
 try:
     from app.core.config import settings
     from app.utils.logger import logger
     SETTINGS_LOADED = True
 except ImportError:
-    import logging
     logger = logging.getLogger("app.api.llm_client_fallback")
     if not logger.hasHandlers():
         _h = logging.StreamHandler()
@@ -25,6 +35,11 @@ except ImportError:
 DEFAULT_OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 DEFAULT_LLM_TIMEOUT = 30.0  # Segundos
 CHAT_COMPLETIONS_ENDPOINT_PATH = "/chat/completions" # Path relativo al base_url
+# Pool de conexiones: todas las llamadas van al mismo host, así que se mantienen conexiones
+# vivas (y con HTTP/2 muchas solicitudes comparten una sola conexión TLS)
+LLM_MAX_KEEPALIVE_CONNECTIONS = 50
+LLM_MAX_CONNECTIONS = 100
+LLM_KEEPALIVE_EXPIRY = 60.0 # Segundos
 
 def _get_validated_base_url() -> str:
     """Obtiene y valida la URL base de OpenRouter desde la configuración."""
@@ -57,6 +72,31 @@ def _get_validated_base_url() -> str:
         logger.error(f"  Error validando la URL base '{base_url_candidate}': {e_url}. Usando URL por defecto: {DEFAULT_OPENROUTER_BASE_URL}")
         return DEFAULT_OPENROUTER_BASE_URL
 
+# --- Configuración del LLM y headers estáticos ---
+# Se leen de settings una sola vez: no cambian durante la vida del proceso, y así cada solicitud
+# no repite los getattr ni reconstruye el diccionario de headers.
+_OPENROUTER_API_KEY: Optional[str] = getattr(settings, 'OPENROUTER_API_KEY', None) if settings else None
+_MODEL_ID: Optional[str] = getattr(settings, 'OPENROUTER_MODEL_CHAT', None) if settings else None
+_LLM_TEMP = float(getattr(settings, 'LLM_TEMPERATURE', 0.2)) if settings else 0.2
+_LLM_MAX_TOKENS = int(getattr(settings, 'LLM_MAX_TOKENS', 200)) if settings else 200
+
+# Headers recomendados por OpenRouter
+# !!! REEMPLAZA "https://tu-proyecto.com" con tu URL real o repo !!!
+_SITE_URL_FOR_HEADER = str(getattr(settings, 'PROJECT_SITE_URL', "https://github.com/tu_usuario/tu_proyecto")) # Convertir HttpUrl a string
+_APP_NAME_FOR_HEADER = getattr(settings, 'PROJECT_NAME', "ChatbotMultimarca")
+_STATIC_HEADERS: Dict[str, str] = {
+    "Content-Type": "application/json",
+    "HTTP-Referer": _SITE_URL_FOR_HEADER,
+    "X-Title": _APP_NAME_FOR_HEADER
+}
+if _OPENROUTER_API_KEY:
+    _STATIC_HEADERS["Authorization"] = f"Bearer {_OPENROUTER_API_KEY}"
+
+# --- Control de admisión ---
+# Limita las llamadas simultáneas a OpenRouter: bajo ráfagas de mensajes la cola queda en este
+# proceso en lugar de provocar 429 (y reintentos con latencia completa) en el proveedor.
+_LLM_SEM = asyncio.Semaphore(int(getattr(settings, 'LLM_MAX_CONCURRENCY', 6)) if settings else 6)
+
 # --- Client Initialization ---
 # Esta sección se ejecuta una vez cuando el módulo se importa.
 _llm_client_instance: Optional[httpx.AsyncClient] = None
@@ -67,11 +107,18 @@ try:
 
         _llm_client_instance = httpx.AsyncClient(
             base_url=_OPENROUTER_API_BASE_URL, # httpx manejará la unión con el path del endpoint
-            timeout=_LLM_HTTP_TIMEOUT
+            timeout=_LLM_HTTP_TIMEOUT,
+            headers=_STATIC_HEADERS, # Se envían en cada solicitud sin pasarlos en post()
+            http2=HTTP2_OK,
+            limits=httpx.Limits(
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                max_connections=LLM_MAX_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+            )
         )
         logger.info(
             f"Cliente HTTP Async para LLM (OpenRouter) inicializado exitosamente. "
-            f"Base URL: '{_OPENROUTER_API_BASE_URL}', Timeout: {_LLM_HTTP_TIMEOUT}s"
+            f"Base URL: '{_OPENROUTER_API_BASE_URL}', Timeout: {_LLM_HTTP_TIMEOUT}s, HTTP/2: {HTTP2_OK}"
         )
     else:
         logger.error("Settings no cargados. El cliente HTTP para LLM no se pudo inicializar.")
@@ -82,158 +129,217 @@ except Exception as e_client_init:
     _llm_client_instance = None
 
 
-async def get_llm_response(prompt_from_builder: str) -> Optional[str]:
+async def close_llm_client() -> None:
+    """Cierra el cliente HTTP compartido y su pool de conexiones (se llama al apagar la aplicación)."""
+    global _llm_client_instance
+    if _llm_client_instance is not None:
+        await _llm_client_instance.aclose()
+        _llm_client_instance = None
+        logger.info("Cliente HTTP para LLM (OpenRouter) cerrado.")
+
+
+# Delimitadores del prompt que arma `rag_prompt_builder`: la parte "system" es todo ANTES de
+# _SYSTEM_MARKER_END y la parte "user" es lo que sigue, hasta _USER_MARKER_END.
+_SYSTEM_MARKER_END = "**Pregunta del Usuario:**" # Lo que sigue es la pregunta del usuario
+_USER_MARKER_END = "**Tu Respuesta como" # Lo que sigue es donde el LLM debe empezar a escribir
+
+def _split_prompt(prompt: str) -> Tuple[str, str]:
     """
-    Obtiene una respuesta de un modelo de lenguaje a través de OpenRouter.
-    Devuelve el texto de la respuesta o un mensaje de error como string.
+    Separa el prompt en (system_content, user_content) con una sola pasada por delimitador
+    (str.partition), sin listas intermedias. Si el delimitador de system no está, todo el
+    prompt es del usuario.
     """
-    logger.debug(f"get_llm_response: Iniciando. Preview del prompt recibido (primeros 200 chars): '{prompt_from_builder[:200]}...'")
+    head, sep, tail = prompt.partition(_SYSTEM_MARKER_END)
+    if not sep:
+        return "", prompt.strip()
+    return head.strip(), tail.partition(_USER_MARKER_END)[0].strip()
+
+def _messages_from_prompt(prompt: str) -> Optional[List[Dict[str, str]]]:
+    """Convierte el prompt como string en la lista de mensajes system/user. None si la parte del usuario queda vacía."""
+    system_content, user_content = _split_prompt(prompt)
+    if system_content:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("  Prompt dividido: System content (len %d): '%s...', User content (len %d): '%s...'",
+                         len(system_content), system_content[:100], len(user_content), user_content[:100])
+    else:
+        logger.debug("  Delimitador para system content ('%s') no encontrado. Todo el prompt se usará como 'user_content'.", _SYSTEM_MARKER_END)
+
+    if not user_content: # user_content no debería estar vacío después de la lógica anterior
+        logger.error("  Error Crítico: El contenido del usuario (user_content) está vacío después del parseo. Prompt original (preview): '%s...'", prompt[:100])
+        return None
+
+    messages: List[Dict[str, str]] = []
+    if system_content: # Solo añadir system message si tiene contenido
+        messages.append({"role": "system", "content": system_content})
+    messages.append({"role": "user", "content": user_content})
+    return messages
+
+class LLMRequestError(Exception):
+    """La solicitud al LLM no se pudo construir o enviar; el mensaje es el que se devuelve al usuario."""
 
+
+def _build_llm_payload(prompt_from_builder: Union[str, List[Dict[str, str]]]) -> Dict[str, Any]:
+    """Valida la configuración y arma el payload (con streaming) para OpenRouter. Lanza LLMRequestError."""
     if _llm_client_instance is None:
         logger.error("  Error: El cliente HTTP para LLM (OpenRouter) no está inicializado. No se puede hacer la solicitud.")
-        return "Error interno: Cliente LLM no disponible."
+        raise LLMRequestError("Error interno: Cliente LLM no disponible.")
 
     if not SETTINGS_LOADED or not settings:
         logger.error("  Error: Settings no disponibles. No se puede acceder a la configuración del LLM.")
-        return "Error interno: Configuración de la aplicación no disponible."
-
-    # Validar configuración esencial del LLM desde settings
-    openrouter_api_key = getattr(settings, 'OPENROUTER_API_KEY', None)
-    openrouter_model_id = getattr(settings, 'OPENROUTER_MODEL_CHAT', None)
-    llm_temp = float(getattr(settings, 'LLM_TEMPERATURE', 0.2)) # Default a 0.7 si no está
-    llm_max_t = int(getattr(settings, 'LLM_MAX_TOKENS', 200))    # Default a 512 si no está
+        raise LLMRequestError("Error interno: Configuración de la aplicación no disponible.")
 
-    if not openrouter_api_key:
+    # Validar configuración esencial del LLM (resuelta una sola vez al importar el módulo)
+    if not _OPENROUTER_API_KEY:
         logger.error("  Error: OPENROUTER_API_KEY no está configurada en settings.")
-        return "Error interno: Clave API para OpenRouter no configurada."
-    if not openrouter_model_id:
+        raise LLMRequestError("Error interno: Clave API para OpenRouter no configurada.")
+    if not _MODEL_ID:
         logger.error("  Error: OPENROUTER_MODEL_CHAT (identificador del modelo) no está configurado en settings.")
-        return "Error interno: Modelo de OpenRouter no configurado."
-
-    # Headers recomendados por OpenRouter
-    # !!! REEMPLAZA "https://tu-proyecto.com" con tu URL real o repo !!!
-    site_url_for_header = getattr(settings, 'PROJECT_SITE_URL', "https://github.com/tu_usuario/tu_proyecto")
-    site_url_str = str(site_url_for_header)  # Convertir HttpUrl a string
-    app_name_for_header = getattr(settings, 'PROJECT_NAME', "ChatbotMultimarca")
-
-    headers = {
-        "Authorization": f"Bearer {openrouter_api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": site_url_str,  # Usar el string en lugar del objeto HttpUrl
-        "X-Title": app_name_for_header       
+        raise LLMRequestError("Error interno: Modelo de OpenRouter no configurado.")
+
+    if isinstance(prompt_from_builder, str):
+        messages = _messages_from_prompt(prompt_from_builder)
+        if messages is None:
+            raise LLMRequestError("Error interno: La pregunta del usuario resultó vacía después del procesamiento.")
+    else:
+        # Mensajes ya estructurados: se envían tal cual, sin parsear
+        messages = prompt_from_builder
+        if not messages:
+            logger.error("  Error Crítico: La lista de mensajes para el LLM está vacía.")
+            raise LLMRequestError("Error interno: La pregunta del usuario resultó vacía después del procesamiento.")
+
+    payload = {
+        "model": _MODEL_ID,
+        "messages": messages,
+        "max_tokens": _LLM_MAX_TOKENS,
+        "temperature": _LLM_TEMP,
+        "stream": True # Los tokens llegan por SSE a medida que el modelo los genera
+        # Puedes añadir otros parámetros como "top_p", "presence_penalty", etc. si es necesario
     }
-    logger.debug(f"  Headers para OpenRouter (sin API Key): Referer='{site_url_for_header}', X-Title='{app_name_for_header}'")
 
-    # Preparar el payload de mensajes (system y user)
-    system_content: str = ""
-    user_content: str = prompt_from_builder.strip() # Por defecto, todo el prompt es del usuario
+    logger.info("  Enviando solicitud a OpenRouter. Modelo: '%s', Temp: %s, MaxTokens: %s.", _MODEL_ID, _LLM_TEMP, _LLM_MAX_TOKENS)
+    # Loguear el payload de mensajes es muy útil (solo se serializa si el nivel DEBUG está activo)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("  Payload messages para OpenRouter: %s", orjson.dumps(messages, option=orjson.OPT_INDENT_2).decode('utf-8'))
+        # Loguear el payload completo (sin API key) también puede ser útil si se sospecha de otros parámetros
+        logger.debug("  Payload completo para OpenRouter (sin API key implícita): %s",
+                     orjson.dumps(payload, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8'))
+    return payload
 
-    # Intento de separar el prompt en "system" y "user" si los delimitadores están presentes
-    # Esto es específico para cómo `rag_prompt_builder` estructura el prompt.
-    # Asumimos que la parte "system" es todo ANTES de "**Pregunta del Usuario:**"
-    # y la parte "user" es todo DESPUÉS de "**Pregunta del Usuario:**" y ANTES de "**Tu Respuesta como...**"
-    
-    system_marker_end = "**Pregunta del Usuario:**" # Lo que sigue es la pregunta del usuario
-    user_marker_end = "**Tu Respuesta como" # Lo que sigue es donde el LLM debe empezar a escribir
 
-    try:
-        if system_marker_end in prompt_from_builder:
-            parts = prompt_from_builder.split(system_marker_end, 1)
-            system_content = parts[0].strip()
-            
-            # La parte del usuario está en parts[1], pero necesitamos quitar lo que viene después de la pregunta real.
-            if len(parts) > 1 and parts[1]:
-                user_part_full = parts[1].strip()
-                if user_marker_end in user_part_full:
-                    user_content = user_part_full.split(user_marker_end, 1)[0].strip()
-                else:
-                    user_content = user_part_full # Tomar todo si el marcador de respuesta no está
-            else: # No debería pasar si system_marker_end está, pero por si acaso
-                user_content = "" 
-            
-            logger.debug(f"  Prompt dividido: System content (len {len(system_content)}): '{system_content[:100]}...', User content (len {len(user_content)}): '{user_content[:100]}...'")
-        else:
-            logger.debug("  Delimitador para system content ('**Pregunta del Usuario:**') no encontrado. Todo el prompt se usará como 'user_content'.")
-            # system_content ya es "" y user_content es prompt_from_builder.strip()
-    except Exception as e_parse_prompt:
-        logger.warning(f"  Advertencia: Ocurrió un error al intentar parsear el prompt para system/user: {e_parse_prompt}. Se usará el prompt completo como user_content.", exc_info=True)
-        system_content = "" # Resetear por si acaso
-        user_content = prompt_from_builder.strip()
+async def stream_llm_response(prompt_from_builder: Union[str, List[Dict[str, str]]]) -> AsyncIterator[str]:
+    """
+    Obtiene la respuesta de OpenRouter en streaming y va entregando los fragmentos de texto
+    a medida que llegan (el primer token llega tras ~1 RTT en lugar de esperar la respuesta completa).
+    El cupo de concurrencia se mantiene mientras dura el stream.
+    Lanza LLMRequestError si la solicitud no se puede construir y las excepciones de httpx
+    (HTTPStatusError con el cuerpo ya leído, RequestError) si falla la llamada.
+    """
+    payload = _build_llm_payload(prompt_from_builder)
+    # orjson serializa el payload (con el contexto RAG) más rápido que el json interno de httpx
+    body = orjson.dumps(payload)
+    async with _LLM_SEM:
+        # La URL completa es base_url (del cliente) + CHAT_COMPLETIONS_ENDPOINT_PATH
+        async with _llm_client_instance.stream("POST", CHAT_COMPLETIONS_ENDPOINT_PATH, content=body) as response:
+            logger.debug("  Respuesta HTTP recibida de OpenRouter. Status: %s", response.status_code)
+            if response.status_code >= 400:
+                await response.aread() # Para que el cuerpo del error esté disponible fuera del contexto
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data: "):
+                    continue # Líneas vacías o comentarios SSE (": OPENROUTER PROCESSING")
+                data = line[6:]
+                if data == "[DONE]":
+                    break
+                chunk = orjson.loads(data)
+                if chunk.get("error"): # Error del proveedor después de haber respondido 200
+                    logger.error("  Error de OpenRouter durante el streaming: %s", chunk["error"])
+                    raise LLMRequestError("Error de comunicación con el servicio LLM. Por favor, revisa los logs para más detalles.")
+                choices = chunk.get("choices")
+                if choices:
+                    first_choice = choices[0]
+                    content = (first_choice.get("delta") or {}).get("content")
+                    if content:
+                        yield content
+                    finish_reason = first_choice.get("finish_reason")
+                    if finish_reason:
+                        # ej. finish_reason == "length" indica una respuesta truncada por max_tokens
+                        logger.info("  Stream de OpenRouter finalizado. Finish reason: '%s'.", finish_reason)
 
 
-    messages: List[Dict[str, str]] = []
-    if system_content: # Solo añadir system message si tiene contenido
-        messages.append({"role": "system", "content": system_content})
-    
-    if not user_content: # user_content no debería estar vacío después de la lógica anterior
-        logger.error(f"  Error Crítico: El contenido del usuario (user_content) está vacío después del parseo. Prompt original (preview): '{prompt_from_builder[:100]}...'")
-        return "Error interno: La pregunta del usuario resultó vacía después del procesamiento."
-        
-    messages.append({"role": "user", "content": user_content})
+# --- Caché de respuestas ---
+# Muchos mensajes se repiten tal cual (saludos, preguntas frecuentes): con una temperatura baja
+# la respuesta es prácticamente determinista y se sirve de memoria sin llamar a OpenRouter.
+# Con temperaturas mayores no se cachea, para no perder la variedad de las respuestas.
+_LLM_CACHE_MAX_SIZE = 1024
+_LLM_CACHE_MAX_TEMPERATURE = 0.3
+_LLM_CACHE_ENABLED = _LLM_TEMP <= _LLM_CACHE_MAX_TEMPERATURE
+_llm_response_cache: "OrderedDict[bytes, str]" = OrderedDict() # digest del prompt -> respuesta
 
-    payload = {
-        "model": openrouter_model_id,
-        "messages": messages,
-        "max_tokens": llm_max_t,
-        "temperature": llm_temp,
-        "stream": False # No estamos usando streaming aquí
-        # Puedes añadir otros parámetros como "top_p", "presence_penalty", etc. si es necesario
-    }
+def _llm_cache_key(prompt_from_builder: Union[str, List[Dict[str, str]]]) -> bytes:
+    """Digest (blake2b de 16 bytes) del modelo, max_tokens y el prompt o los mensajes."""
+    return hashlib.blake2b(orjson.dumps([_MODEL_ID, _LLM_MAX_TOKENS, prompt_from_builder]), digest_size=16).digest()
+
+def _get_cached_llm_response(cache_key: bytes) -> Optional[str]:
+    cached = _llm_response_cache.get(cache_key)
+    if cached is not None:
+        _llm_response_cache.move_to_end(cache_key)
+    return cached
 
-    logger.info(f"  Enviando solicitud a OpenRouter. Modelo: '{openrouter_model_id}', Temp: {llm_temp}, MaxTokens: {llm_max_t}.")
-    # Loguear el payload de mensajes es muy útil
-    logger.debug(f"  Payload messages para OpenRouter: {json.dumps(messages, ensure_ascii=False, indent=2)}")
-    # Loguear el payload completo (sin API key) también puede ser útil si se sospecha de otros parámetros
-    payload_for_log = payload.copy() # No loguear la API Key si estuviera en el payload (no está aquí)
-    logger.debug(f"  Payload completo para OpenRouter (sin API key implícita): {json.dumps(payload_for_log, ensure_ascii=False, indent=2)}")
+def _store_cached_llm_response(cache_key: bytes, ai_response_text: str) -> None:
+    _llm_response_cache[cache_key] = ai_response_text
+    _llm_response_cache.move_to_end(cache_key)
+    while len(_llm_response_cache) > _LLM_CACHE_MAX_SIZE:
+        _llm_response_cache.popitem(last=False)
 
+async def get_llm_response(prompt_from_builder: Union[str, List[Dict[str, str]]]) -> Optional[str]:
+    """
+    Obtiene una respuesta de un modelo de lenguaje a través de OpenRouter.
+    Acepta la lista de mensajes ya estructurada ({"role", "content"}) que arma
+    `build_llm_messages`, o (por compatibilidad) el prompt completo como string, que se
+    separa en system/user con los delimitadores.
+    Consume stream_llm_response y devuelve el texto completo o un mensaje de error como string.
+    Con temperatura <= _LLM_CACHE_MAX_TEMPERATURE las respuestas válidas se cachean (LRU);
+    los errores no se cachean.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        prompt_preview = prompt_from_builder if isinstance(prompt_from_builder, str) else prompt_from_builder[-1:]
+        logger.debug("get_llm_response: Iniciando. Preview del prompt recibido (primeros 200 chars): '%s...'", str(prompt_preview)[:200])
+
+    cache_key: Optional[bytes] = None
+    if _LLM_CACHE_ENABLED:
+        cache_key = _llm_cache_key(prompt_from_builder)
+        cached_response = _get_cached_llm_response(cache_key)
+        if cached_response is not None:
+            logger.info("  Respuesta del LLM servida desde caché. Respuesta (preview): '%s...'", cached_response[:150])
+            return cached_response
 
     try:
-        # La URL completa es base_url (del cliente) + CHAT_COMPLETIONS_ENDPOINT_PATH
-        response = await _llm_client_instance.post(CHAT_COMPLETIONS_ENDPOINT_PATH, headers=headers, json=payload)
-        
-        logger.debug(f"  Respuesta HTTP recibida de OpenRouter. Status: {response.status_code}")
-        response.raise_for_status() # Lanza HTTPStatusError si status >= 400
-        
-        response_data = response.json()
-        # logger.debug(f"  Respuesta JSON completa de OpenRouter: {json.dumps(response_data, ensure_ascii=False, indent=2)}") # Loguear JSON completo puede ser muy verboso
-
-        # Extraer el contenido del mensaje de la respuesta
-        if response_data.get("choices") and isinstance(response_data["choices"], list) and len(response_data["choices"]) > 0:
-            first_choice = response_data["choices"][0]
-            if isinstance(first_choice, dict) and first_choice.get("message") and \
-               isinstance(first_choice["message"], dict) and "content" in first_choice["message"] and \
-               isinstance(first_choice["message"]["content"], str):
-                
-                ai_response_text = first_choice["message"]["content"].strip()
-                finish_reason = first_choice.get("finish_reason", "N/A")
-                logger.info(f"  Respuesta de OpenRouter procesada exitosamente. Finish reason: '{finish_reason}'. Respuesta (preview): '{ai_response_text[:150]}...'")
-                
-                # Aquí podrías añadir lógica para manejar diferentes finish_reasons si es necesario
-                # ej. if finish_reason == "length": logger.warning("  Respuesta truncada por max_tokens.")
-                
-                return ai_response_text
-            else:
-                logger.warning(f"  Estructura inesperada en 'choices[0].message' o 'content' en la respuesta de OpenRouter. Choice[0]: {first_choice}")
-        else:
-            logger.warning(f"  La respuesta de OpenRouter no contiene 'choices' válidas o la lista está vacía. Respuesta Data: {response_data}")
-        
-        # Si no se pudo extraer la respuesta por estructura inesperada
-        return "Error: El modelo LLM no generó una respuesta con el formato esperado."
+        fragments = [fragment async for fragment in stream_llm_response(prompt_from_builder)]
+        ai_response_text = "".join(fragments).strip()
+        if not ai_response_text:
+            logger.warning("  La respuesta en streaming de OpenRouter no contiene texto en los fragmentos recibidos.")
+            return "Error: El modelo LLM no generó una respuesta con el formato esperado."
+        logger.info("  Respuesta de OpenRouter procesada exitosamente. Respuesta (preview): '%s...'", ai_response_text[:150])
+        if cache_key is not None:
+            _store_cached_llm_response(cache_key, ai_response_text)
+        return ai_response_text
+
+    except LLMRequestError as e_request:
+        return str(e_request)
 
     except httpx.HTTPStatusError as e_status:
         error_body_text = "No se pudo leer el cuerpo del error HTTP."
         try:
-            # Intentar leer el cuerpo de la respuesta de error de forma asíncrona
-            error_response_content = await e_status.response.aread()
-            error_body_text = error_response_content.decode(errors='replace') # Decodificar bytes a string
+            # stream_llm_response ya leyó el cuerpo antes de raise_for_status: .text usa el contenido
+            # cacheado (sin otro aread) y solo se decodifica la preview que se loguea
+            error_body_text = e_status.response.text[:500]
         except Exception as e_read_body:
             logger.error(f"  Error adicional al intentar leer el cuerpo de la respuesta de error HTTP de OpenRouter: {e_read_body}")
         
         logger.error(
             f"  Error HTTP de OpenRouter: Status Code {e_status.response.status_code}. "
             f"URL: {e_status.request.url}. "
-            f"Cuerpo de la Respuesta de Error (preview): {error_body_text[:500]}...", # Loguear solo una preview
+            f"Cuerpo de la Respuesta de Error (preview): {error_body_text}...", # Loguear solo una preview
             exc_info=False # El traceback de HTTPStatusError no es tan útil como el cuerpo del error
         )
         # Devolver un mensaje de error más informativo al usuario/sistema
@@ -247,10 +353,9 @@ async def get_llm_response(prompt_from_builder: str) -> Optional[str]:
         logger.error(f"  Error de red/solicitud al llamar a OpenRouter. URL: {e_req.request.url if e_req.request else 'N/A'}. Error: {e_req}", exc_info=True)
         return "Error de red al contactar el servicio LLM. Verifica tu conexión y la disponibilidad del servicio."
     
-    except json.JSONDecodeError as e_json:
-        # Esto podría pasar si la respuesta no es JSON válido a pesar de un status 200
-        logger.error(f"  Error al decodificar la respuesta JSON de OpenRouter. Status: {response.status_code if 'response' in locals() else 'N/A'}. Error: {e_json}", exc_info=True)
-        # logger.debug(f"   Contenido que falló la decodificación JSON: {response.text if 'response' in locals() else 'N/A'}")
+    except orjson.JSONDecodeError as e_json:
+        # Esto podría pasar si un evento del stream no es JSON válido a pesar de un status 200
+        logger.error(f"  Error al decodificar un fragmento JSON del stream de OpenRouter. Error: {e_json}", exc_info=True)
         return "Error: La respuesta del servicio LLM no pudo ser interpretada (formato JSON inválido)."
 
     except Exception as e_unexpected: # Captura cualquier otra excepción no prevista
@@ -2,7 +2,7 @@
 import os
 import logging
 from pathlib import Path
-from typing import Optional, Dict, Any, List, Set
+from typing import Optional, Dict, Any, List, Set, Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import PostgresDsn, validator, Field, HttpUrl
 from datetime import datetime, timezone
@@ -72,9 +72,25 @@ class Settings(BaseSettings):
     FAISS_FOLDER_PATH: Optional[Path] = None # Se calculará en model_post_init
     LOCAL_FAISS_CACHE_PATH: Optional[Path] = None # Opcional, para override de dónde se guarda/busca localmente
     EMBEDDING_MODEL_NAME: str = Field(default='sentence-transformers/paraphrase-multilingual-mpnet-base-v2', validation_alias="EMBEDDING_MODEL_NAME")
+    EMBEDDING_BACKEND: Literal["torch", "onnx"] = Field(default="torch", validation_alias="EMBEDDING_BACKEND") # "onnx" requiere optimum[onnxruntime]
+    EMBEDDING_ONNX_FILE_NAME: Optional[str] = Field(default=None, validation_alias="EMBEDDING_ONNX_FILE_NAME") # Ej: onnx/model_qint8_avx512.onnx
+    EMBEDDING_QUANTIZATION: Literal["none", "int8", "bf16"] = Field(default="none", validation_alias="EMBEDDING_QUANTIZATION") # Precisión del modelo de embeddings en CPU
+    EMBEDDING_TORCH_COMPILE: bool = Field(default=False, validation_alias="EMBEDDING_TORCH_COMPILE") # Requiere compilador C++ en el contenedor
+    EMBEDDING_BATCH_SIZE: int = Field(default=32, gt=0, validation_alias="EMBEDDING_BATCH_SIZE") # Sub-lotes (ordenados por longitud) al calcular embeddings
     RAG_DEFAULT_K: int = Field(default=3, gt=0, validation_alias="RAG_DEFAULT_K")
     RAG_K_FETCH_MULTIPLIER: int = Field(default=2, gt=0, validation_alias="RAG_K_FETCH_MULTIPLIER")
     RAG_MIN_CONTEXT_LENGTH_THRESHOLD: int = Field(default=50, validation_alias="RAG_MIN_CONTEXT_LENGTH_THRESHOLD")
+    FAISS_INDEX_TYPE: Literal["flat", "fp16", "ivfpq", "sq8"] = Field(default="flat", validation_alias="FAISS_INDEX_TYPE") # Cuantización del índice al cargar
+    FAISS_USE_MMAP: bool = Field(default=False, validation_alias="FAISS_USE_MMAP") # Mapear el índice en memoria (IVF, o planos con faiss >= 1.11) en vez de leerlo completo
+    FAISS_SHM_DIR: Optional[Path] = Field(default=None, validation_alias="FAISS_SHM_DIR") # tmpfs compartido por los workers (por defecto /dev/shm)
+    FAISS_BINARY_DOCSTORE: bool = Field(default=False, validation_alias="FAISS_BINARY_DOCSTORE") # Docstore en archivos binarios mapeados en memoria en vez del .pkl
+    RAG_USE_GPU: bool = Field(default=False, validation_alias="RAG_USE_GPU") # Mover el índice FAISS a GPU si hay una disponible (requiere faiss-gpu en lugar de faiss-cpu)
+    RAG_FAISS_NPROBE: int = Field(default=8, gt=0, validation_alias="RAG_FAISS_NPROBE") # Listas a visitar en índices IVF (efSearch en HNSW)
+    RAG_NUM_THREADS: int = Field(default=0, ge=0, validation_alias="RAG_NUM_THREADS") # 0 = núcleos / WEB_CONCURRENCY
+    RAG_BATCH_MS: int = Field(default=10, ge=0, validation_alias="RAG_BATCH_MS") # Ventana para agrupar consultas RAG concurrentes
+    RAG_BATCH_MAX_SIZE: int = Field(default=16, gt=0, validation_alias="RAG_BATCH_MAX_SIZE")
+    RAG_QUERY_EMBEDDING_CACHE_SIZE: int = Field(default=4096, ge=0, validation_alias="RAG_QUERY_EMBEDDING_CACHE_SIZE") # Embeddings de consultas en caché LRU
+    PROMPT_CACHE_SIZE: int = Field(default=512, ge=0, validation_alias="PROMPT_CACHE_SIZE") # 0 desactiva la caché de prompts
 
     # --- LLM y OpenRouter ---
     OPENROUTER_API_KEY: Optional[str] = Field(default=None, validation_alias="OPENROUTER_API_KEY")
@@ -83,6 +99,8 @@ class Settings(BaseSettings):
     LLM_TEMPERATURE: float = Field(default=0.5, ge=0.0, le=2.0, validation_alias="LLM_TEMPERATURE")
     LLM_MAX_TOKENS: int = Field(default=150, gt=0, validation_alias="LLM_MAX_TOKENS")
     LLM_HTTP_TIMEOUT: float = Field(default=45.0, gt=0, validation_alias="LLM_HTTP_TIMEOUT")
+    LLM_MAX_CONCURRENCY: int = Field(default=6, gt=0, validation_alias="LLM_MAX_CONCURRENCY") # Llamadas simultáneas máximas a OpenRouter por proceso
+    DEEPSEEK_MAX_CONCURRENCY: int = Field(default=16, gt=0, validation_alias="DEEPSEEK_MAX_CONCURRENCY") # Llamadas simultáneas máximas a DeepSeek por proceso
 
     # --- Meta (WhatsApp/Messenger) ---
     WHATSAPP_PHONE_NUMBER_ID: Optional[str] = Field(default=None, validation_alias="WHATSAPP_PHONE_NUMBER_ID")
@@ -254,7 +254,7 @@ from app.api.meta import send_whatsapp_message
 from app.api.calendly import get_available_slots, get_scheduling_link
 from app.api.llm_client import get_llm_response
 from app.ai.rag_retriever import search_relevant_documents
-from app.ai.rag_prompt_builder import build_llm_prompt, BRAND_PROFILES
+from app.ai.rag_prompt_builder import build_llm_messages, BRAND_PROFILES
 
 RESET_KEYWORDS = {"menu", "menú", "inicio", "reset", "/reset", "/menu", "volver", "cambiar marca", "salir", "cancelar", "principal"}
 OPT_OUT_KEYWORDS = {"stop", "parar", "baja", "unsubscribe", "no quiero mensajes", "cancelar mensajes", "detener mensajes", "adios", "adiós", "gracias por tu ayuda"}
@@ -612,7 +612,7 @@ async def handle_whatsapp_message(
         logger.info(f"CONTEXTO_RAG_PARA_LLM: '''{context_from_docs}'''")
 
         # Construir el prompt para el LLM - usando brand_name_display para acceder al perfil correcto
-        full_prompt = build_llm_prompt(
+        llm_messages = build_llm_messages(
             brand_name=brand_name_display, # Nombre legible de la marca en lugar del normalizado
             user_query=user_input_text,
             context=context_from_docs,
@@ -623,7 +623,7 @@ async def handle_whatsapp_message(
 
         try:
             # Obtener respuesta del LLM
-            llm_api_response = await get_llm_response(full_prompt)
+            llm_api_response = await get_llm_response(llm_messages)
             
             bot_response = "No pude generar una respuesta en este momento. ¿Podrías intentar reformular tu pregunta o escribir 'menú' para otras opciones?"
             if llm_api_response:
@@ -758,7 +758,7 @@ async def handle_whatsapp_message(
         # Log del contexto RAG para verificación
         logger.info(f"CONTEXTO_RAG_PARA_LLM (desde STAGE_PROVIDING_SCHEDULING_INFO): '''{context_from_docs}'''")
 
-        full_prompt = build_llm_prompt(
+        llm_messages = build_llm_messages(
             brand_name=brand_name_display,  # Usar el nombre original para correcta selección de perfil
             user_query=user_input_text,
             context=context_from_docs,
@@ -766,9 +766,9 @@ async def handle_whatsapp_message(
             user_collected_name=current_user_state_obj.collected_name if current_user_state_obj else None,
             is_first_turn=True # Permitir saludo inicial cuando viene de scheduling
         )
-        logger.debug(f"Prompt LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para {user_key}:\n{full_prompt[:500]}...")
+        logger.debug(f"Prompt LLM (desde STAGE_PROVIDING_SCHEDULING_INFO) para {user_key}:\n{llm_messages[-1]['content'][:500]}...")
         try:
-            llm_api_response = await get_llm_response(full_prompt)
+            llm_api_response = await get_llm_response(llm_messages)
             bot_response = llm_api_response or "No pude generar una respuesta. Intenta de nuevo."
             await send_whatsapp_message(from_phone, bot_response)
             add_to_conversation_history(user_key, "assistant", bot_response)
@@ -868,7 +868,7 @@ async def handle_whatsapp_message(
         is_first_interaction = not conversation_history or len(conversation_history) <= 2
         
         # Usar el nombre original de la marca para la búsqueda del perfil
-        full_prompt = build_llm_prompt(
+        llm_messages = build_llm_messages(
             brand_name=brand_name_display,  # Usar el nombre original, no el normalizado
             user_query=user_input_text,
             context=context_from_docs,
@@ -876,11 +876,11 @@ async def handle_whatsapp_message(
             user_collected_name=current_user_state_obj.collected_name if current_user_state_obj else None,
             is_first_turn=is_first_interaction # Determina dinámicamente si es primer turno
         )
-        logger.debug(f"Prompt completo para LLM (usuario {user_key} en STAGE_MAIN_CHAT_RAG):\n{full_prompt[:500]}...") # Loggear solo una parte
+        logger.debug(f"Prompt completo para LLM (usuario {user_key} en STAGE_MAIN_CHAT_RAG):\n{llm_messages[-1]['content'][:500]}...") # Loggear solo una parte
 
         try:
             # Obtener respuesta del LLM
-            llm_api_response = await get_llm_response(full_prompt)
+            llm_api_response = await get_llm_response(llm_messages)
             
             bot_response = "No pude generar una respuesta en este momento. ¿Podrías intentar reformular tu pregunta o escribir 'menú' para otras opciones?"
             if llm_api_response:
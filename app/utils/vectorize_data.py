@@ -1,4 +1,5 @@
 import logging
+import hashlib
 from pathlib import Path
 import sys
 import os # Importado para os.environ.get, aunque ahora no lo usaremos en la línea problemática
@@ -161,6 +162,9 @@ try:
         add_start_index=True,
     )
     chunked_documents = text_splitter.split_documents(all_documents)
+    # Huella de 64 bits del contenido de cada chunk: el retriever deduplica resultados con ella sin volver a hashear el texto
+    for chunk in chunked_documents:
+        chunk.metadata['_content_hash'] = int.from_bytes(hashlib.blake2b(chunk.page_content.encode('utf-8'), digest_size=8).digest(), 'big')
     vectorizer_logger.info(f"Número total de chunks creados: {len(chunked_documents)}")
     if not chunked_documents:
         vectorizer_logger.error("La división no produjo ningún chunk. Revisa los documentos de entrada y la configuración del splitter.")
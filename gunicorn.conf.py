@@ -4,6 +4,8 @@ import multiprocessing
 # Gunicorn config
 bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
 workers = multiprocessing.cpu_count() * 2 + 1
+# Los workers heredan el entorno: el RAG reparte los hilos de torch/FAISS entre ellos
+os.environ.setdefault("WEB_CONCURRENCY", str(workers))
 worker_class = "uvicorn.workers.UvicornWorker"
 timeout = 600
 keepalive = 5